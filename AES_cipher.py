@@ -1,19 +1,124 @@
-from Crypto.Cipher import AES as AES_
+from Crypto.Cipher import AES as AES_, ChaCha20_Poly1305 as ChaCha20_Poly1305_
 from Crypto.Util.Padding import pad, unpad
 
 class AES:
+    # Legacy suite, no integrity check, kept for peers that do not negotiate suites
+    suite = "AES-256-CBC"
+
     def __init__(self, key: bytes) -> None:
         self.key = key
 
+    def next_send(self) -> tuple[bytes, bytes | None]:
+        return self.key, None
+
+    def next_recv(self) -> tuple[bytes, bytes | None]:
+        return self.key, None
+
     def encrypt(self, data: bytes):
-        cipher = AES_.new(self.key, AES_.MODE_CBC)
-        ct_bytes = cipher.encrypt(pad(data, AES_.block_size))
+        return encrypt_record(self.suite, self.key, None, data)
+
+    def decrypt(self, data: bytes):
+        return decrypt_record(self.suite, self.key, None, data)
+
+class AEAD:
+    suite = ""
+
+    def __init__(self, send_key: bytes, send_iv: bytes, recv_key: bytes, recv_iv: bytes) -> None:
+        self._send_key = send_key
+        self._send_iv = int.from_bytes(send_iv, "big")
+        self._recv_key = recv_key
+        self._recv_iv = int.from_bytes(recv_iv, "big")
+
+        # Every record in a direction gets the next sequence number, so nonces never repeat and records cannot be reordered or replayed
+        self._send_seq = 0
+        self._recv_seq = 0
+
+    def next_send(self) -> tuple[bytes, bytes]:
+        nonce = (self._send_iv ^ self._send_seq).to_bytes(12, "big")
+
+        self._send_seq += 1
 
-        return bytes(cipher.iv) + ct_bytes
+        return self._send_key, nonce
+
+    def next_recv(self) -> tuple[bytes, bytes]:
+        nonce = (self._recv_iv ^ self._recv_seq).to_bytes(12, "big")
+
+        self._recv_seq += 1
+
+        return self._recv_key, nonce
+
+    def encrypt(self, data: bytes):
+        return encrypt_record(self.suite, *self.next_send(), data)
 
     def decrypt(self, data: bytes):
-        iv = data[:16]
-        ct = data[16:]
-        cipher = AES_.new(self.key, AES_.MODE_CBC, iv)
+        return decrypt_record(self.suite, *self.next_recv(), data)
+
+class AES_GCM(AEAD):
+    suite = "AES-256-GCM"
+
+class ChaCha20_Poly1305(AEAD):
+    suite = "CHACHA20-POLY1305"
+
+SUITES: dict[str, type[AES] | type[AEAD]] = {
+    "AES-256-GCM": AES_GCM,
+    "CHACHA20-POLY1305": ChaCha20_Poly1305,
+    "AES-256-CBC": AES,
+}
+
+# Preference order, GCM first since it runs on AES-NI where available
+DEFAULT_SUITES = ["AES-256-GCM", "CHACHA20-POLY1305", "AES-256-CBC"]
+
+def _aead(suite: str, key: bytes, nonce: bytes):
+    if suite == "AES-256-GCM":
+        return AES_.new(key, AES_.MODE_GCM, nonce = nonce)
+
+    if suite == "CHACHA20-POLY1305":
+        return ChaCha20_Poly1305_.new(key = key, nonce = nonce)
+
+    raise ValueError(f"unknown cipher suite {suite!r}")
+
+def encrypt_record(suite: str, key: bytes, nonce: bytes | None, data: bytes) -> bytearray:
+    """Helper function to encrypt one record with an explicit key and nonce, picklable so it can run in a worker process"""
+
+    # Records are written into one preallocated buffer instead of joining IV, ciphertext and tag afterwards
+    if suite == "AES-256-CBC":
+        cipher = AES_.new(key, AES_.MODE_CBC)
+
+        aligned = len(data) - len(data) % AES_.block_size
+        tail = pad(bytes(memoryview(data)[aligned:]), AES_.block_size)
+
+        record = bytearray(16 + aligned + len(tail))
+        view = memoryview(record)
+
+        view[:16] = cipher.iv
+
+        cipher.encrypt(memoryview(data)[:aligned], output = view[16:16 + aligned])
+        cipher.encrypt(tail, output = view[16 + aligned:])
+
+        return record
+
+    cipher = _aead(suite, key, nonce)
+
+    record = bytearray(len(data) + 16)
+    view = memoryview(record)
+
+    cipher.encrypt(data, output = view[:len(data)])
+
+    view[len(data):] = cipher.digest()
+
+    return record
+
+def decrypt_record(suite: str, key: bytes, nonce: bytes | None, data: bytes) -> bytes:
+    """Helper function to decrypt one record with an explicit key and nonce, raises `ValueError` if an AEAD record was tampered with"""
+
+    view = memoryview(data)
+
+    if suite == "AES-256-CBC":
+        cipher = AES_.new(key, AES_.MODE_CBC, bytes(view[:16]))
+
+        return unpad(cipher.decrypt(view[16:]), AES_.block_size)
+
+    if len(data) < 16:
+        raise ValueError("record is shorter than its tag")
 
-        return unpad(cipher.decrypt(ct), AES_.block_size)
\ No newline at end of file
+    return _aead(suite, key, nonce).decrypt_and_verify(view[:-16], view[-16:])
\ No newline at end of file
@@ -2,6 +2,9 @@ import typing
 
 VERSION = "QSTP/1"
 
+# Streamed bodies are sent as one message per chunk after the head, an empty message ends the body
+CHUNK_SIZE = 1 << 16
+
 status_codes = {
       1: "CONNECTION REFUSED",
     100: "SERVER OK",
@@ -13,9 +16,11 @@ status_codes = {
     204: "UNKNOWN PATH",
     205: "UNAUTHENTICATED",
     206: "UNAUTHORIZED",
+    207: "NOT MODIFIED",
     300: "OK",
     301: "INCOMPLETE",
     302: "UNKNOWN HOST",
+    303: "UPSTREAM TIMEOUT",
 }
 
 METHODS = {
@@ -25,6 +30,127 @@ METHODS = {
     "PATCH",
 }
 
+IDEMPOTENT_METHODS = {
+    "GET",
+}
+
+class BodyStream:
+    # on_close runs once the body was read to its end, on_abort once it was closed before that
+    def __init__(self, pull: typing.Callable[[], bytes | None], apull: typing.Callable[[], typing.Awaitable[bytes | None]] | None = None, on_close: typing.Callable[[], None] | None = None, on_abort: typing.Callable[[], None] | None = None) -> None:
+        self._pull = pull
+        self._apull = apull
+        self._on_close = on_close
+        self._on_abort = on_abort
+        self._buffer = b""
+
+        self.done = False
+
+    def _end(self, chunk: bytes | None) -> bytes:
+        self.done = True
+
+        if chunk is None:
+            raise ConnectionError("tunnel closed in the middle of a chunked body")
+
+        if self._on_close:
+            self._on_close()
+
+        return b""
+
+    def _next(self) -> bytes:
+        if self.done:
+            return b""
+
+        if not (chunk := self._pull()):
+            return self._end(chunk)
+
+        return chunk
+
+    async def _anext(self) -> bytes:
+        if self.done:
+            return b""
+
+        if not (chunk := await self._apull()):
+            return self._end(chunk)
+
+        return chunk
+
+    def __iter__(self) -> typing.Iterator[bytes]:
+        if self._buffer:
+            chunk, self._buffer = self._buffer, b""
+
+            yield chunk
+
+        while (chunk := self._next()):
+            yield chunk
+
+    async def __aiter__(self) -> typing.AsyncIterator[bytes]:
+        if self._buffer:
+            chunk, self._buffer = self._buffer, b""
+
+            yield chunk
+
+        while (chunk := await self._anext()):
+            yield chunk
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0:
+            return b"".join(self)
+
+        while len(self._buffer) < size and (chunk := self._next()):
+            self._buffer += chunk
+
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+
+        return data
+
+    # A stream of func(chunk) for every chunk of this one, its end and errors carry over
+    def map(self, func: typing.Callable[[bytes], bytes]) -> "BodyStream":
+        chunks = iter(self)
+        achunks = aiter(self)
+
+        def pull() -> bytes:
+            return func(chunk) if (chunk := next(chunks, b"")) else b""
+
+        async def apull() -> bytes:
+            return func(chunk) if (chunk := await anext(achunks, b"")) else b""
+
+        return BodyStream(pull, apull if self._apull else None, on_abort = self.close)
+
+    # Gives up on the rest of the body, whatever it was coming in on cannot carry anything else before its end so it is not read further
+    def close(self):
+        if self.done:
+            return
+
+        self.done = True
+
+        if self._on_abort:
+            self._on_abort()
+
+    def drain(self):
+        for _ in self:
+            pass
+
+    async def adrain(self):
+        async for _ in self:
+            pass
+
+def iter_chunks(body: bytes | typing.BinaryIO | typing.Iterable[bytes], chunk_size: int = CHUNK_SIZE) -> typing.Iterator[bytes]:
+    """Helper function to split a body into the chunks of a streamed message"""
+
+    if isinstance(body, (bytes, bytearray)):
+        for i in range(0, len(body), chunk_size):
+            yield bytes(body[i:i + chunk_size])
+
+    elif hasattr(body, "read") and not isinstance(body, BodyStream):
+        while (chunk := body.read(chunk_size)):
+            yield chunk
+
+    else:
+        for chunk in body:
+            # An empty chunk would end the body early
+            if chunk:
+                yield chunk
+
 def parse_headers(headers: str) -> dict[str, str]:
         headers_out = {}
 
@@ -35,8 +161,207 @@ def parse_headers(headers: str) -> dict[str, str]:
 
         return headers_out
 
-class Request:
-    def __init__(self, address: tuple[str, int], method: str, path: str, headers: dict[str, str] | None = None, data: bytes | None = None) -> None:
+def index_frame(frame: bytes) -> tuple[str, int, int, list[tuple[int, int, int]]]:
+    """Helper function to index a frame without copying it, returns (info line, head end, body start, header line offsets), raises `ValueError` on a header line without a colon"""
+
+    if (head_end := frame.find(b"\n\n")) == -1:
+        head_end = body_start = len(frame)
+
+    else:
+        body_start = head_end + 2
+
+    if (info_end := frame.find(b"\n", 0, head_end)) == -1:
+        info_end = head_end
+
+    header_lines = []
+    start = info_end + 1
+
+    # Each header line is kept as (start, colon, end) offsets into the frame, decoded only when asked for
+    while start < head_end:
+        if (end := frame.find(b"\n", start, head_end)) == -1:
+            end = head_end
+
+        if (colon := frame.find(b":", start, end)) == -1:
+            raise ValueError("header line without a colon!")
+
+        header_lines.append((start, colon, end))
+
+        start = end + 1
+
+    return frame[:info_end].decode(), head_end, body_start, header_lines
+
+def is_chunked(head: bytes) -> bool:
+    """Helper function to tell from the head of a request or response whether chunks follow it, without parsing the rest of the frame"""
+
+    try:
+        _, _, _, header_lines = index_frame(head)
+
+    except (ValueError, UnicodeDecodeError):
+        return False
+
+    # Later lines win, like they do in a parsed message
+    for start, colon, end in reversed(header_lines):
+        if bytes(head[start:colon]).strip() == b"transfer-encoding":
+            return bytes(head[colon + 1:end]).strip() == b"chunked"
+
+    return False
+
+# Marks parts of a parsed frame that have not been decoded yet
+_LAZY = object()
+
+# Shared by requests and responses, data may be bytes, a binary file, an iterable of chunks or a BodyStream
+class Message:
+    _frame = None
+    _dirty = True
+
+    def _attach(self, frame: bytes, head_end: int, body_start: int, header_lines: list[tuple[int, int, int]]):
+        # Parsed messages keep their frame, headers and body are only decoded and sliced when asked for
+        self._frame = frame
+        self._head_end = head_end
+        self._body_start = body_start
+        self._header_lines = header_lines
+        self._frame_info = self._info_line()
+
+        self._headers = _LAZY
+        self._parsed_headers = None
+        self._data = _LAZY
+        self._extra: list[tuple[str, str]] = []
+
+        self._dirty = False
+
+    @property
+    def headers(self) -> dict[str, str] | None:
+        if self._headers is _LAZY:
+            frame = self._frame
+
+            headers = {frame[start:colon].decode().strip(): frame[colon + 1:end].decode().strip() for start, colon, end in self._header_lines}
+
+            headers.update(self._extra)
+
+            self._headers = headers or None
+
+            # Compared in to_frame() to tell whether the caller changed the dict
+            self._parsed_headers = dict(headers)
+
+        return self._headers
+
+    @headers.setter
+    def headers(self, headers: dict[str, str] | None):
+        self._headers = headers
+        self._dirty = True
+
+    def get_header(self, name: str, default: str | None = None) -> str | None:
+        if self._headers is not _LAZY:
+            return self._headers.get(name, default) if self._headers else default
+
+        for k, v in reversed(self._extra):
+            if k == name:
+                return v
+
+        frame = self._frame
+        key = name.encode()
+
+        # Later lines win, like they do in the dict
+        for start, colon, end in reversed(self._header_lines):
+            if frame[start:colon].strip() == key:
+                return frame[colon + 1:end].decode().strip()
+
+        return default
+
+    def set_header(self, name: str, value: str):
+        # A new header on an untouched frame is spliced in by to_frame() instead of rebuilding the head
+        if self._headers is _LAZY and self.get_header(name) is None:
+            self._extra.append((name, value))
+
+            return
+
+        if self.headers is None:
+            self.headers = {}
+
+        self.headers[name] = value
+
+    @property
+    def data(self) -> bytes | None:
+        if self._data is _LAZY:
+            self._data = self._frame[self._body_start:] or None
+
+        elif self.streamed:
+            # Handlers that want the whole body get it buffered on first access
+            self._data = b"".join(iter_chunks(self._data)) or None
+
+        return self._data
+
+    @data.setter
+    def data(self, data: bytes | typing.BinaryIO | typing.Iterable[bytes] | BodyStream | None):
+        self._data = data
+        self._dirty = True
+
+    @property
+    def streamed(self) -> bool:
+        return self._data is not None and self._data is not _LAZY and not isinstance(self._data, (bytes, bytearray))
+
+    @property
+    def stream(self) -> BodyStream | None:
+        if not self.streamed:
+            return None
+
+        if not isinstance(self._data, BodyStream):
+            chunks = iter_chunks(self._data)
+
+            self._data = BodyStream(lambda: next(chunks, b""))
+
+        return self._data
+
+    @property
+    def chunked(self) -> bool:
+        return self.get_header("transfer-encoding") == "chunked"
+
+    def _data_repr(self) -> str:
+        if self.streamed:
+            return ", data = <stream>"
+
+        return f", data = {self.data[:50]}{"..." if len(self.data) > 50 else ""}" if self.data else ""
+
+    def _head(self, chunked: bool = False) -> bytes:
+        headers = {k: v for k, v in self.headers.items() if k != "transfer-encoding"} if self.headers else {}
+
+        if chunked:
+            headers["transfer-encoding"] = "chunked"
+
+        return f"{self._info_line()}{("\n" + "\n".join(f"{k}: {v}" for k, v in headers.items())) if headers else ""}".encode()
+
+    def _unchanged(self) -> bool:
+        if self._frame is None or self._dirty or self._info_line() != self._frame_info:
+            return False
+
+        return self._headers is _LAZY or self._headers == self._parsed_headers
+
+    def to_frame(self) -> bytes:
+        # An untouched parsed frame goes back out as it came in, plus any headers added with set_header()
+        if self._unchanged():
+            if not self._extra:
+                return self._frame
+
+            view = memoryview(self._frame)
+
+            return b"".join([view[:self._head_end], "".join(f"\n{k}: {v}" for k, v in self._extra).encode(), view[self._head_end:]])
+
+        return self._head() + (b"\n\n" + self.data if self.data else b"")
+
+    def to_frames(self, chunk_size: int = CHUNK_SIZE) -> typing.Iterator[bytes]:
+        if not self.streamed:
+            yield self.to_frame()
+
+            return
+
+        yield self._head(True)
+
+        yield from iter_chunks(self._data, chunk_size)
+
+        yield b""
+
+class Request(Message):
+    def __init__(self, address: tuple[str, int], method: str, path: str, headers: dict[str, str] | None = None, data: bytes | typing.BinaryIO | typing.Iterable[bytes] | None = None) -> None:
         if method not in METHODS:
             raise ValueError(f"{method} is not a method")
 
@@ -47,30 +372,18 @@ class Request:
         self.data = data
 
     def __repr__(self) -> str:
-        return f"{self.__class__.__name__}(address = {self.address}, method = {self.method!r}, path = {self.path!r}{f", headers = {self.headers}" if self.headers else ""}{f", data = {self.data[:50]}{"..." if len(self.data) > 50 else ""}" if self.data else ""})"
-
-    def to_frame(self) -> bytes:
-        head = f"{VERSION} {self.method} {self.path}{("\n" + "\n".join(f"{k}: {v}" for k, v in self.headers.items())) if self.headers else ""}"
+        return f"{self.__class__.__name__}(address = {self.address}, method = {self.method!r}, path = {self.path!r}{f", headers = {self.headers}" if self.headers else ""}{self._data_repr()})"
 
-        return head.encode() + (b"\n\n" + self.data if self.data else b"")
+    def _info_line(self) -> str:
+        return f"{VERSION} {self.method} {self.path}"
 
     @staticmethod
     def from_frame(frame: bytes, address: tuple[str, int]) -> "Request | Response":
-        frame_split = frame.split(b"\n\n", 1)
-
-        if len(frame_split) == 1:
-            frame_split = [frame_split[0], b""]
-
-        head, data = frame_split
-
-        head = head.decode()
-
-        head_split = head.split("\n", 1)
-
-        if len(head_split) == 1:
-            head_split = [head_split[0], ""]
+        try:
+            info_line, head_end, body_start, header_lines = index_frame(frame)
 
-        info_line, headers_raw = head_split
+        except (ValueError, UnicodeDecodeError):
+            return Response(201)
 
         info_line_split = info_line.split(" ", 2)
 
@@ -85,10 +398,14 @@ class Request:
         if method not in METHODS:
             return Response(203)
 
-        return Request(address, method, path, parse_headers(headers_raw) if headers_raw else None, data if data else None)
+        req = Request(address, method, path)
+
+        req._attach(frame, head_end, body_start, header_lines)
 
-class Response:
-    def __init__(self, status_code: int, headers: dict | None = None, data: bytes | None = None) -> None:
+        return req
+
+class Response(Message):
+    def __init__(self, status_code: int, headers: dict | None = None, data: bytes | typing.BinaryIO | typing.Iterable[bytes] | None = None) -> None:
         if status_code not in status_codes.keys():
             raise ValueError(f"{status_code} is not a valid status code")
 
@@ -97,30 +414,14 @@ class Response:
         self.data = data
 
     def __repr__(self) -> str:
-        return f"{self.__class__.__name__}(status_code = {self.status_code}{f", headers = {self.headers}" if self.headers else ""}{f", data = {self.data[:50]}{"..." if len(self.data) > 50 else ""}" if self.data else ""})"
-
-    def to_frame(self) -> bytes:
-        head = f"{VERSION} {self.status_code} {status_codes[self.status_code]}{("\n" + "\n".join(f"{k}: {v}" for k, v in self.headers.items())) if self.headers else ""}"
+        return f"{self.__class__.__name__}(status_code = {self.status_code}{f", headers = {self.headers}" if self.headers else ""}{self._data_repr()})"
 
-        return head.encode() + (b"\n\n" + self.data if self.data else b"")
+    def _info_line(self) -> str:
+        return f"{VERSION} {self.status_code} {status_codes[self.status_code]}"
 
     @staticmethod
     def from_frame(frame: bytes) -> "Response":
-        frame_split = frame.split(b"\n\n", 1)
-
-        if len(frame_split) == 1:
-            frame_split = [frame_split[0], b""]
-
-        head, data = frame_split
-
-        head = head.decode()
-
-        head_split = head.split("\n", 1)
-
-        if len(head_split) == 1:
-            head_split = [head_split[0], ""]
-
-        info_line, headers_raw = head_split
+        info_line, head_end, body_start, header_lines = index_frame(frame)
 
         info_line_split = info_line.split(" ", 2)
 
@@ -138,4 +439,8 @@ class Response:
         except ValueError:
             raise ValueError("invalid status code!")
 
-        return Response(status_code, parse_headers(headers_raw) if headers_raw else None, data if data else None)
\ No newline at end of file
+        resp = Response(status_code)
+
+        resp._attach(frame, head_end, body_start, header_lines)
+
+        return resp
\ No newline at end of file
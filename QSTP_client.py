@@ -1,26 +1,178 @@
-import typing
-import client, QSTP
+import typing, threading
+import client, tunnel_pool, keypool, QSTP, mux, compression
 
 class QSTP_Client:
-    def __init__(self) -> None:
-        self._client = client.Client()
+    def __init__(self, keep_alive: bool = False, pool: tunnel_pool.TunnelPool | None = None, pinned_keys: dict[tuple[str, int], bytes] | None = None, keypairs: keypool.KeypairPool | None = None, multiplex: bool = False, max_streams: int = mux.DEFAULT_STREAMS, connect_timeout: float | None = None, response_timeout: float | None = None, encodings: typing.Iterable[str] | None = None) -> None:
+        self.keep_alive = keep_alive
+        self.pool = pool
+
+        self.multiplex = multiplex
+        self.max_streams = max_streams
+
+        # Encodings asked for with accept-encoding, in order of preference, compressed responses are inflated before they are returned
+        self.encodings = [name for name in encodings if name in compression.CODECS] if encodings is not None else None
+
+        # A connect that times out answers CONNECTION REFUSED, a response that does raises TimeoutError
+        self.connect_timeout = connect_timeout
+        self.response_timeout = response_timeout
+
+        self._client = client.Client(keep_alive = keep_alive, pinned_keys = pinned_keys, keypairs = keypairs, connect_timeout = connect_timeout, response_timeout = response_timeout)
+
+        # Chunked body of the last response over _client, until it is read to its end the tunnel belongs to it
+        self._body: QSTP.BodyStream | None = None
+
+        # One multiplexed tunnel per server, shared by every thread using this client
+        self._keypairs = keypairs
+        self._tunnels: dict[tuple[str, int], client.Client | None] = {}
+        self._tunnels_lock = threading.Lock()
+
+    def _tunnel(self, address: tuple[str, int]) -> client.Client | None:
+        with self._tunnels_lock:
+            if address not in self._tunnels:
+                cl = client.Client(keep_alive = True, keypairs = self._keypairs, max_streams = self.max_streams, connect_timeout = self.connect_timeout, response_timeout = self.response_timeout).connect(address)
+
+                # Servers that do not multiplex are remembered as None and served over plain tunnels
+                if not cl.multiplexed:
+                    cl.close()
+
+                    cl = None
+
+                self._tunnels[address] = cl
+
+            return self._tunnels[address]
+
+    def _decode(self, resp: QSTP.Response) -> QSTP.Response:
+        # Clients that did not ask for compression pass bodies on as they came, a proxy relays them to the client that did
+        if self.encodings:
+            compression.decode(resp)
+
+        return resp
+
+    def _request_stream(self, cl: client.Client, request: QSTP.Request, stream: bool, replay_safe: bool) -> QSTP.Response:
+        tunnel, first = cl.request_stream(request.to_frames() if request.streamed else request.to_frame(), replay_safe)
+
+        try:
+            resp = QSTP.Response.from_frame(first)
+
+        except BaseException:
+            tunnel.finish()
+
+            raise
+
+        if not resp.chunked:
+            tunnel.finish()
+
+            return self._decode(resp)
+
+        # Only this stream is held by the chunked body, other requests keep using the tunnel
+        resp.data = QSTP.BodyStream(tunnel.recv, on_close = tunnel.finish, on_abort = tunnel.finish)
+
+        self._decode(resp)
+
+        if not stream:
+            resp.data = resp.stream.read() or None
+
+        return resp
+
+    # deadlines overrides (connect_timeout, response_timeout) for this request, multiplexed tunnels keep the ones they were opened with
+    def request_obj(self, request: QSTP.Request, stream: bool = False, deadlines: tuple[float | None, float | None] | None = None) -> QSTP.Response:
+        # Only idempotent requests may ride in a replayable 0-RTT first flight
+        replay_safe = request.method in QSTP.IDEMPOTENT_METHODS
+
+        if self.encodings and request.get_header("accept-encoding") is None:
+            request.set_header("accept-encoding", ", ".join(self.encodings))
+
+        if self.multiplex:
+            try:
+                if (cl := self._tunnel(request.address)) is not None:
+                    return self._request_stream(cl, request, stream, replay_safe)
+
+            except ConnectionRefusedError:
+                return QSTP.Response(1)
 
-    def request_obj(self, request: QSTP.Request) -> QSTP.Response:
         try:
-            return QSTP.Response.from_frame(self._client.connect(request.address).do_request(request.to_frame()))
+            if self.pool is not None:
+                cl = self.pool.acquire(request.address, deadlines)
+
+            else:
+                # An unfinished body keeps the old client and its tunnel, reusing either would read its chunks as the next response
+                if self._body is not None and not self._body.done:
+                    self._client.close()
+
+                    self._client = client.Client(keep_alive = self.keep_alive, tickets = self._client.tickets, pinned_keys = self._client.pinned_keys, keypairs = self._client.keypairs)
+
+                self._body = None
+
+                self._client.connect_timeout, self._client.response_timeout = deadlines or (self.connect_timeout, self.response_timeout)
+
+                # Reuse the open session when keep-alive is on and the request goes to the same server
+                if not (self.keep_alive and self._client.connected and self._client.remote_address == request.address):
+                    self._client.close()
+                    self._client.connect(request.address)
+
+                cl = self._client
+
+            try:
+                resp = QSTP.Response.from_frame(cl.open_request(request.to_frames() if request.streamed else request.to_frame(), replay_safe))
+
+            except BaseException:
+                cl.close()
+
+                raise
 
         except ConnectionRefusedError:
             return QSTP.Response(1)
+
+        def done():
+            cl.finish()
+
+            if self.pool is not None:
+                self.pool.release(cl)
+
+        # The rest of an abandoned body would be read as the next response, the tunnel goes with it
+        def abort():
+            cl.close()
+
+            if self.pool is not None:
+                self.pool.release(cl)
+
+        if not resp.chunked:
+            done()
+
+            return self._decode(resp)
+
+        # The tunnel stays with the response until its chunked body has been read to the end
+        resp.data = body = QSTP.BodyStream(cl.recv, on_close = done, on_abort = abort)
+
+        if self.pool is None:
+            self._body = body
+
+        self._decode(resp)
+
+        if not stream:
+            resp.data = resp.stream.read() or None
+
+        return resp
+
+    def close(self):
+        self._client.close()
+
+        with self._tunnels_lock:
+            for cl in self._tunnels.values():
+                if cl is not None:
+                    cl.close()
+
+            self._tunnels.clear()
         
-    def request(self, address: tuple[str, int], method: str, path: str, headers: dict[str, str] | None = None, data: bytes | None = None) -> QSTP.Response:
-        return self.request_obj(QSTP.Request(address, method, path, headers, data))
+    def request(self, address: tuple[str, int], method: str, path: str, headers: dict[str, str] | None = None, data: bytes | typing.BinaryIO | typing.Iterable[bytes] | None = None, stream: bool = False) -> QSTP.Response:
+        return self.request_obj(QSTP.Request(address, method, path, headers, data), stream)
 
 if __name__ == "__main__":
     import sys, time
 
     address = ("localhost", int(sys.argv[1]))
 
-    client_ = QSTP_Client()
+    client_ = QSTP_Client(keep_alive = True)
 
     requests = [
         # (address, "GET", "/test", {"Host": "server1.com"}, b"test data from client looking for server 1"),
@@ -41,4 +193,6 @@ if __name__ == "__main__":
         print(f"{(t2 - t1) * 1000 :.5f}ms")
 
         if i + 1 != len(requests):
-            time.sleep(0.5)
\ No newline at end of file
+            time.sleep(0.5)
+
+    client_.close()
\ No newline at end of file
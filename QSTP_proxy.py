@@ -1,9 +1,9 @@
 import typing
-import proxy, QSTP
+import proxy, tunnel_pool, QSTP, metrics
 
 class QSTP_Proxy:
-    def __init__(self) -> None:
-        self._proxy = proxy.Proxy()
+    def __init__(self, pool: tunnel_pool.TunnelPool | None = None, registry: metrics.Registry | None = None) -> None:
+        self._proxy = proxy.Proxy(pool = pool, registry = registry)
 
         self._cl_handler = None
         self._sv_handler = None
@@ -1,27 +1,173 @@
-import typing
-import QSTP_server, QSTP_client, QSTP
+import typing, time
+import QSTP_server, QSTP_client, tunnel_pool, QSTP, balancer, cache, coalesce, hedge, metrics
 
 class QSTP_ReverseProxy:
-    def __init__(self, debug: bool = False) -> None:
-        self._server = QSTP_server.QSTP_Server()
+    def __init__(self, debug: bool = False, pool: tunnel_pool.TunnelPool | None = None, response_cache: cache.ResponseCache | None = None, registry: metrics.Registry | None = None, metrics_path: str | None = None) -> None:
+        # A GET for metrics_path is answered by the proxy itself whatever its Host, with the metrics of the proxy and its server
+        self._server = QSTP_server.QSTP_Server(registry = registry, metrics_path = metrics_path)
         self._debug = debug
 
+        self.registry = self._server.registry
+
+        self._upstream_latency = self.registry.histogram("qstp_upstream_seconds", "Time until an upstream answered with the head of its response", ("route", "upstream"))
+        self._upstream_responses = self.registry.counter("qstp_upstream_responses_total", "Upstream answers per status code, 1 for a refused connection and 303 for a timeout", ("route", "status"))
+
+        self.pool = pool or tunnel_pool.TunnelPool()
+        self._owns_pool = pool is None
+        self._client = QSTP_client.QSTP_Client(pool = self.pool)
+
+        self.route_table = {}
+        self._balancers: dict[str, balancer.Balancer] = {}
+
+        # Upstreams decide what is cached through cache-control and etag on their responses
+        self.cache = response_cache
+
+        # Routes with "coalesce" send concurrent identical GETs upstream once
+        self.flights = coalesce.SingleFlight()
+
+        # Routes with "hedge" settings send a slow GET to a second upstream as well and answer with whichever responds first
+        self._hedgers: dict[str, hedge.Hedger] = {}
+
+    def _hedged_forward(self, rq: QSTP.Request, route: str) -> QSTP.Response:
+        if (hedger := self._hedgers.get(route)) is None or rq.method not in QSTP.IDEMPOTENT_METHODS or rq.chunked:
+            return self._forward(rq, route)
+
+        # Both attempts share the upstreams they used, so the hedge goes somewhere else
+        tried = []
+
+        def attempt(is_hedge: bool) -> QSTP.Response:
+            if not is_hedge:
+                return self._forward(rq, route, tried)
+
+            # Each attempt sets the address of its own request
+            return self._forward(QSTP.Request(rq.address, rq.method, rq.path, dict(rq.headers or {}), rq.data), route, tried, spare = True)
+
+        return hedger.do(attempt)
+
+    def _coalesced_forward(self, rq: QSTP.Request, route: str, host: str) -> QSTP.Response:
+        if not self.route_table[route].get("coalesce") or rq.method not in QSTP.IDEMPOTENT_METHODS or rq.chunked:
+            return self._hedged_forward(rq, route)
+
+        return self.flights.do(self.flights.key(host, rq), lambda: self._hedged_forward(rq, route))
+
+    def _cached_forward(self, rq: QSTP.Request, route: str, host: str) -> QSTP.Response:
+        # Upstreams only compress for clients that ask, without the header secrets in a response cannot leak through its compressed size
+        if self.route_table[route].get("compress") is False and rq.get_header("accept-encoding") is not None:
+            del rq.headers["accept-encoding"]
+
+        if self.cache is None:
+            return self._coalesced_forward(rq, route, host)
+
+        if rq.method not in QSTP.IDEMPOTENT_METHODS or rq.chunked:
+            # A write to a path makes whatever was cached for it out of date, for clients that sent other key headers than the writer too
+            self.cache.invalidate_path(host, rq.path)
+
+            return self._forward(rq, route)
+
+        key = self.cache.key(host, rq)
+
+        if (entry := self.cache.lookup(key)) is not None:
+            if entry.fresh:
+                if self._debug:
+                    print("Cache hit")
+
+                return entry.response()
+
+            # Ask the upstream whether the stored body is still current, it answers 207 NOT MODIFIED without the body if so.
+            # The client's own if-none-match stays on rq, it decides whether the client gets a 207 as well
+            if entry.etag is not None:
+                rq = QSTP.Request(rq.address, rq.method, rq.path, {**(rq.headers or {}), "if-none-match": entry.etag}, rq.data)
+
+        resp = self._coalesced_forward(rq, route, host)
+
+        if entry is not None and resp.status_code == 207:
+            if self._debug:
+                print("Cache revalidated")
+
+            return self.cache.refresh(entry, resp).response()
+
+        self.cache.store(key, resp)
+
+        return resp
+
+    def _forward(self, rq: QSTP.Request, name: str, tried: list[balancer.Upstream] | None = None, spare: bool = False) -> QSTP.Response:
+        bal = self._balancers[name]
+        tried = tried if tried is not None else []
+        start_tried = len(tried)
+
+        # Answers like a refused connection when every upstream of the route has an open circuit, so the caller fails over right away
+        resp = QSTP.Response(1)
+
+        # Refused upstreams are taken out of rotation and the request goes to the next one, nothing of it was sent yet
+        while (upstream := bal.acquire(tried, spare)) is not None:
+            tried.append(upstream)
+
+            rq.address = upstream.address
+
+            if self._debug:
+                print(f"Using Upstream address {upstream.address}")
+
+            start = time.monotonic()
+
+            try:
+                resp = self._client.request_obj(rq, stream = True, deadlines = (upstream.connect_timeout, upstream.response_timeout))
+
+            except TimeoutError:
+                bal.release(upstream)
+
+                self._upstream_responses.inc((name, "303"))
+
+                if self._debug:
+                    print(f"No response from {upstream.address} in time")
+
+                # The upstream may have acted on the request already, so it is not sent anywhere else
+                return QSTP.Response(303)
+
+            except BaseException:
+                bal.release(upstream)
+
+                raise
+
+            self._upstream_responses.inc((name, str(resp.status_code)))
+
+            if resp.status_code != 1:
+                latency = time.monotonic() - start
+
+                self._upstream_latency.observe(latency, (name, f"{upstream.address[0]}:{upstream.address[1]}"))
+
+                bal.release(upstream, latency, resp.status_code == 101)
+
+                return resp
+
+            bal.release(upstream)
+
+            if self._debug:
+                print(f"Connection refused by {upstream.address}")
+
+        if self._debug and len(tried) == start_tried:
+            print(f"Every upstream of {name} has an open circuit")
+
+        return resp
+
     def serve(self, address: tuple[str, int]):
         @self._server.handle_data
         def _data_handler(rq: QSTP.Request) -> QSTP.Response:
             if self._debug:
                 print(f" -- START LOG -- \nRequest from {rq.address}")
 
-            if rq.headers is None or (host := rq.headers.get("Host")) is None:
+            # Only Host is looked at, so the frame is forwarded without being decoded or rebuilt
+            if (host := rq.get_header("Host")) is None:
                 if self._debug:
                     print("Response 301, no Host specified")
 
                 return QSTP.Response(301)
 
-            rq.headers["Proxied-For"] = f"{rq.address[0]}:{rq.address[1]}"
+            rq.set_header("Proxied-For", f"{rq.address[0]}:{rq.address[1]}")
             
-            if (upstream := self.route_table.get(host)) is None:
-                if (fallback := self.route_table.get("FALLBACK")) is None:
+            route = host
+
+            if route not in self._balancers:
+                if "FALLBACK" not in self._balancers:
                     if self._debug:
                         print("Response 302, Host not found in route table and FALLBACK not defined")
 
@@ -30,27 +176,18 @@ class QSTP_ReverseProxy:
                 if self._debug:
                     print("Using FALLBACK address")
 
-                rq.address = ((addr := fallback["location"].split(":"))[0], int(addr[1]))
+                route = "FALLBACK"
 
-            else:
-                rq.address = ((addr := upstream["location"].split(":"))[0], int(addr[1]))
-
-                if self._debug:
-                    print(f"Using Upstream address {addr}")
-
-            resp = QSTP_client.QSTP_Client().request_obj(rq)
+            resp = self._cached_forward(rq, route, host)
 
             if self._debug:
                 print(f"Response code: {resp.status_code}")
 
-            if resp.status_code == 1:
+            if resp.status_code == 1 and route != "FALLBACK" and "FALLBACK" in self._balancers:
                 if self._debug:
                     print("Connection refused... trying FALLBACK")
 
-                if (fallback := self.route_table.get("FALLBACK")) is not None:
-                    rq.address = ((addr := fallback["location"].split(":"))[0], int(addr[1]))
-
-                    resp = QSTP_client.QSTP_Client().request_obj(rq)
+                resp = self._cached_forward(rq, "FALLBACK", host)
 
             if self._debug:
                 print(f"Final Response code: {resp.status_code}")
@@ -62,11 +199,34 @@ class QSTP_ReverseProxy:
     def close(self):
         self._server.close()
 
-    def set_routing(self, route_table: dict[str, dict[str, str]]):
+        for bal in self._balancers.values():
+            bal.close()
+
+        # A pool handed in by the application may be shared with other proxies, leave it to its owner
+        if self._owns_pool:
+            self.pool.close()
+
+    # Each route has a "location" or a list of "upstreams" with an optional "policy", "cooldown" and "health" probe settings,
+    # "connect_timeout", "response_timeout" and "breaker" settings, "coalesce": True lets concurrent identical GETs on the route share one upstream request,
+    # "hedge" holds Hedger settings for routes with several upstreams, "compress": False keeps responses on the route uncompressed
+    def set_routing(self, route_table: dict[str, dict[str, typing.Any]]):
+        balancers = {host: balancer.Balancer.from_route(route) for host, route in route_table.items()}
+
+        for host, route in route_table.items():
+            if (health := route.get("health")) is not None:
+                balancers[host].start_health_checks(health.get("interval", 2.0), health.get("path", "/"), None if host == "FALLBACK" else host, health.get("rise", 2), health.get("fall", 2))
+
+        old, self._balancers = self._balancers, balancers
+
+        self._hedgers = {host: hedge.Hedger(**route["hedge"]) for host, route in route_table.items() if "hedge" in route}
+
         self.route_table = route_table
 
+        for bal in old.values():
+            bal.close()
+
 if __name__ == "__main__":
-    reverse_proxy = QSTP_ReverseProxy(debug = True)
+    reverse_proxy = QSTP_ReverseProxy(debug = True, response_cache = cache.ResponseCache(), metrics_path = "/metrics")
 
     reverse_proxy.set_routing({
         "server1.com": {
@@ -74,11 +234,21 @@ if __name__ == "__main__":
         },
 
         "server2.com": {
-            "location": "localhost:8082",
+            "upstreams": [
+                {"location": "localhost:8082", "weight": 2},
+                "localhost:8083",
+            ],
+            "policy": "p2c",
+            "health": {"path": "/", "interval": 2.0},
+            "coalesce": True,
+            "response_timeout": 10.0,
+            "breaker": {"error_rate": 0.5, "slow_call": 2.0, "open_for": 10.0},
+            "hedge": {"quantile": 0.95, "budget": 0.05},
         },
 
         "FALLBACK": {
-            "location": "localhost:8081"
+            "location": "localhost:8081",
+            "compress": False,
         }
     })
 
@@ -1,108 +1,260 @@
-import typing, rich.console
-import server, QSTP
+import typing, asyncio, inspect, time, rich.console
+import server, async_server, router, QSTP, compression, metrics
 
 class QSTP_Server:
-    def __init__(self) -> None:
-        self._server = server.Server()
-        self._router = Router()
+    def __init__(self, transport: server.Server | async_server.AsyncServer | None = None, encodings: typing.Iterable[str] | None = None, min_compress_size: int = compression.DEFAULT_MIN_SIZE, registry: metrics.Registry | None = None, metrics_path: str | None = None) -> None:
+        self.registry = registry or metrics.REGISTRY
+
+        self._server = transport or server.Server(registry = self.registry)
+        self._router = router.Router()
+
+        self._phases = self.registry.histogram("qstp_phase_seconds", "Time spent in each phase of serving a request", ("phase",))
+        self._responses = self.registry.counter("qstp_responses_total", "Responses sent per status code", ("status",))
+
+        # GET requests for metrics_path are answered with every metric of the registry in the Prometheus text format
+        self.metrics_path = metrics_path
 
-        self.route = self._router.route
         self._handler = None
 
-        @self._server.handle_data
-        def _data_handler(frame: bytes, addr: tuple[str, int]) -> bytes:
-            req = QSTP.Request.from_frame(frame, addr)
+        # Encodings offered to clients that send accept-encoding, in order of preference, None leaves every body as it is
+        self.encodings = [name for name in encodings if name in compression.CODECS] if encodings is not None else None
+        self.min_compress_size = min_compress_size
+
+        self._uncompressed = set()
+
+        # The asyncio engine awaits async def handlers natively instead of running them on a thread
+        if isinstance(self._server, async_server.AsyncServer):
+            self._server.handle_stream(self._async_data_handler)
+
+        else:
+            self._server.handle_stream(self._data_handler)
+
+    # compress = False keeps the responses of a route uncompressed, for routes that send secrets next to data a client controls
+    def route(self, route_descriptor: str, methods: list[str] | None = None, compress: bool = True):
+        register = self._router.route(route_descriptor, methods)
+
+        def decorator(func: typing.Callable[[QSTP.Request, dict[str, typing.Any]], QSTP.Response]):
+            if not compress:
+                self._uncompressed.add(func)
+
+            return register(func)
+
+        return decorator
+
+    def _encoding(self, req: QSTP.Request, target: tuple[typing.Callable, tuple] | None) -> str | None:
+        if not self.encodings or (target is not None and target[0] in self._uncompressed):
+            return None
+
+        return compression.choose(req.get_header("accept-encoding"), self.encodings)
+
+    def _metrics(self, req: QSTP.Request) -> QSTP.Response:
+        return QSTP.Response(200, headers = {"content-type": metrics.CONTENT_TYPE}, data = self.registry.render().encode())
+
+    def _resolve(self, req: QSTP.Request) -> tuple[typing.Callable, tuple] | None:
+        # Checked before the handler, a catch-all handler like the reverse proxy's would pass it on
+        if self.metrics_path is not None and req.method == "GET" and req.path == self.metrics_path:
+            return self._metrics, (req,)
+
+        if self._handler:
+            return self._handler, (req,)
+
+        elif (ret := self._router.match_route(req.path, req.method)):
+            return ret[0], (req, ret[1])
+
+        return None
+
+    @staticmethod
+    def _frames(resp: QSTP.Response, body: QSTP.BodyStream | None) -> typing.Iterator[bytes]:
+        yield from resp.to_frames()
+
+        # Whatever the handler left of a chunked request is read off so the next request starts in the right place
+        if body is not None:
+            body.drain()
+
+    @staticmethod
+    def _conditional(req: QSTP.Request, resp: QSTP.Response) -> QSTP.Response:
+        # A client that already holds this version of the body only gets the validators back
+        if resp.status_code != 200 or resp.streamed or (etag := resp.get_header("etag")) is None or req.get_header("if-none-match") != etag:
+            return resp
 
-            if isinstance(req, QSTP.Response):
-                return req.to_frame()
+        headers = {"etag": etag}
 
+        if (cache_control := resp.get_header("cache-control")) is not None:
+            headers["cache-control"] = cache_control
+
+        return QSTP.Response(207, headers = headers)
+
+    def _data_handler(self, frame: bytes, addr: tuple[str, int], session: server.Session) -> bytes | typing.Iterator[bytes]:
+        start = time.perf_counter()
+
+        req = QSTP.Request.from_frame(frame, addr)
+
+        self._phases.observe(time.perf_counter() - start, ("parse",))
+
+        if isinstance(req, QSTP.Response):
+            self._responses.inc((str(req.status_code),))
+
+            return req.to_frame()
+
+        body = None
+
+        # Chunked bodies are pulled from the tunnel as the handler reads them, async def handlers read them with async for
+        if req.chunked:
+            req.data = body = QSTP.BodyStream(session.recv, lambda: asyncio.to_thread(session.recv))
+
+        # A server that compresses responses also takes compressed requests, they are inflated before the handler sees them
+        if self.encodings is not None:
             try:
-                if self._handler:
-                    return self._handler(req).to_frame()
+                compression.decode(req)
 
-                elif (ret := self._router.match_route(req.path, req.method)):
-                    return ret[0](req, ret[1]).to_frame()
+            except ValueError:
+                if body is not None:
+                    body.drain()
 
-                else:
-                    return QSTP.Response(204, headers = {"request-method": req.method, "request-path": req.path}).to_frame()
-            
-            except:
-                rich.console.Console().print_exception()
+                self._responses.inc(("201",))
 
-                return QSTP.Response(101).to_frame()
+                return QSTP.Response(201).to_frame()
 
-    def serve(self, address: tuple[str, int]):
-        self._server.serve(address)
+        target = None
 
-    def close(self):
-        self._server.close()
+        try:
+            start = time.perf_counter()
 
-    def handle_data(self, func: typing.Callable[[QSTP.Request], QSTP.Response]) -> typing.Callable[[QSTP.Request], QSTP.Response]:
-        self._handler = func
+            target = self._resolve(req)
 
-        return func
+            self._phases.observe(time.perf_counter() - start, ("route",))
 
-class Router:
-    def __init__(self) -> None:
-        self.handlers: dict[str, dict[str, typing.Callable[[QSTP.Request, dict[str, str]], QSTP.Response]]] = {}
+            if target is None:
+                resp = QSTP.Response(204, headers = {"request-method": req.method, "request-path": req.path})
 
-        for method in QSTP.METHODS:
-            self.handlers[method] = {}
+            else:
+                start = time.perf_counter()
 
-    def route(self, route_descriptor: str, methods: list[str] | None = None):
-        def decorator(func: typing.Callable[[QSTP.Request, dict[str, str]], QSTP.Response]):
-            methods_ = methods or ["GET"]
+                resp = target[0](*target[1])
 
-            for method in methods_:
-                if method not in QSTP.METHODS:
-                    raise Exception(f"Unknown method {method!r}")
+                # async def handlers still work on the threaded engine, each call gets its own event loop
+                if inspect.isawaitable(resp):
+                    resp = asyncio.run(resp)
 
-                self.handlers[method][route_descriptor] = func
+                # Up to the head of a streamed response, its chunks are timed as they are sent
+                self._phases.observe(time.perf_counter() - start, ("handler",))
 
-            return func
+        except:
+            rich.console.Console().print_exception()
 
-        return decorator
+            resp = QSTP.Response(101)
+
+        resp = self._conditional(req, resp)
+
+        self._responses.inc((str(resp.status_code),))
+
+        if (encoding := self._encoding(req, target)) is not None:
+            compression.encode(resp, encoding, self.min_compress_size)
+
+        if resp.streamed:
+            return self._frames(resp, body)
+
+        if body is not None:
+            body.drain()
 
-    def match_route(self, route_descriptor: str, method: str) -> tuple[typing.Callable[[QSTP.Request, dict[str, str]], QSTP.Response], dict[str, str]] | None:
-        if method not in QSTP.METHODS:
-            raise Exception(f"Unknown method {method!r}")
+        return resp.to_frame()
 
-        for defined_route, func in self.handlers[method].items():
-            path_defined = []
-            path_try = []
+    async def _async_data_handler(self, frame: bytes, addr: tuple[str, int], session: async_server.AsyncSession) -> bytes | typing.Iterator[bytes]:
+        start = time.perf_counter()
 
-            for part in defined_route.split("/"):
-                if part.startswith("<") and part.endswith(">"):
-                    path_defined.append((1, part[1:-1]))
+        req = QSTP.Request.from_frame(frame, addr)
 
-                elif part:
-                    path_defined.append((0, part))
+        self._phases.observe(time.perf_counter() - start, ("parse",))
 
-            path_try = list(filter(lambda x: bool(x), route_descriptor.split("/")))
+        if isinstance(req, QSTP.Response):
+            self._responses.inc((str(req.status_code),))
 
-            if len(path_defined) != len(path_try):
-                continue
+            return req.to_frame()
 
-            variables = {}
+        body = None
 
-            for defined, test in zip(path_defined, path_try):
-                if defined[0] == 0 and defined[1] == test:
-                    continue
+        # async def handlers read chunked bodies with async for, blocking handlers can read them like a file
+        if req.chunked:
+            req.data = body = QSTP.BodyStream(session.recv, session.arecv)
 
-                elif defined[0] == 1:
-                    variables[defined[1]] = test
+        if self.encodings is not None:
+            try:
+                compression.decode(req)
+
+            except ValueError:
+                if body is not None:
+                    await body.adrain()
+
+                self._responses.inc(("201",))
+
+                return QSTP.Response(201).to_frame()
+
+        target = None
+
+        try:
+            start = time.perf_counter()
+
+            target = self._resolve(req)
+
+            self._phases.observe(time.perf_counter() - start, ("route",))
+
+            if target is None:
+                resp = QSTP.Response(204, headers = {"request-method": req.method, "request-path": req.path})
+
+            else:
+                func, args = target
+
+                start = time.perf_counter()
+
+                if inspect.iscoroutinefunction(func):
+                    resp = await func(*args)
 
                 else:
-                    break
+                    # Blocking handlers run on a worker thread so they do not stall the event loop
+                    resp = await asyncio.to_thread(func, *args)
+
+                self._phases.observe(time.perf_counter() - start, ("handler",))
+
+        except:
+            rich.console.Console().print_exception()
+
+            resp = QSTP.Response(101)
+
+        resp = self._conditional(req, resp)
+
+        self._responses.inc((str(resp.status_code),))
+
+        if (encoding := self._encoding(req, target)) is not None:
+            # Compressing a large body would stall the event loop, streamed bodies are only compressed as they are sent
+            if resp.streamed:
+                compression.encode(resp, encoding, self.min_compress_size)
 
             else:
-                return func, variables
+                await asyncio.to_thread(compression.encode, resp, encoding, self.min_compress_size)
+
+        if resp.streamed:
+            return self._frames(resp, body)
+
+        if body is not None:
+            await body.adrain()
+
+        return resp.to_frame()
 
+    def serve(self, address: tuple[str, int], processes: int | None = None):
+        self._server.serve(address, processes = processes)
+
+    def close(self):
+        self._server.close()
+
+    def handle_data(self, func: typing.Callable[[QSTP.Request], QSTP.Response | typing.Awaitable[QSTP.Response]]) -> typing.Callable[[QSTP.Request], QSTP.Response | typing.Awaitable[QSTP.Response]]:
+        self._handler = func
+
+        return func
 
 if __name__ == "__main__":
     import time, os, hashlib, sys
 
-    sv = QSTP_Server()
+    sv = QSTP_Server(async_server.AsyncServer() if "--asyncio" in sys.argv else None)
 
     @sv.route("/")
     def index(rq: QSTP.Request, _) -> QSTP.Response:
@@ -139,6 +291,26 @@ if __name__ == "__main__":
     def echo(rq: QSTP.Request, _) -> QSTP.Response:
         return QSTP.Response(200, headers = rq.headers, data = rq.data)
 
+    @sv.route("/async_time_test")
+    async def async_time_test(rq: QSTP.Request, _) -> QSTP.Response:
+        await asyncio.sleep(int(rq.data) if rq.data else 1)
+
+        return QSTP.Response(200, headers = rq.headers)
+
+    @sv.route("/download/<filename>")
+    def download(rq: QSTP.Request, args: dict[str, str]) -> QSTP.Response:
+        path = f"{os.getcwd()}/filetest/{os.path.basename(args["filename"])}"
+
+        if not os.path.isfile(path):
+            return QSTP.Response(204)
+
+        # An open file is sent chunk by chunk and closed once it has been read to the end
+        def chunks():
+            with open(path, "rb") as f:
+                yield from QSTP.iter_chunks(f)
+
+        return QSTP.Response(200, headers = {"content-length": str(os.path.getsize(path))}, data = chunks())
+
     @sv.route("/argtest/<arg1>")
     def argtest(rq: QSTP.Request, args: dict[str, str]) -> QSTP.Response:
         print(args)
@@ -161,17 +333,22 @@ if __name__ == "__main__":
         if not (content_hash := rq.headers.get("content-hash")):
             return QSTP.Response(201, data = b"Need content-hash header!")
 
-        if not (content := rq.data):
-            return QSTP.Response(201, data = b"Need file content!")
+        file_len = 0
+        file_hash = hashlib.sha256()
+
+        # Chunked uploads are written as they arrive instead of being held in memory
+        with open(f"{os.getcwd()}/filetest/SERVER_OUTPUT__{filename}", "wb") as f:
+            for chunk in (rq.stream or [rq.data or b""]):
+                file_len += len(chunk)
+                file_hash.update(chunk)
 
-        file_len = len(content)
-        file_hash = hashlib.sha256(content).hexdigest()
+                f.write(chunk)
 
-        print(f"data lengths match: {file_len == int(content_len)}")
-        print(f"data hashes match: {file_hash == content_hash}")
+        if not file_len:
+            return QSTP.Response(201, data = b"Need file content!")
 
-        with open(f"{os.getcwd()}/filetest/SERVER_OUTPUT__{filename}", "wb") as f:
-            f.write(content)
+        print(f"data lengths match: {file_len == int(content_len)}")
+        print(f"data hashes match: {file_hash.hexdigest() == content_hash}")
 
         return QSTP.Response(200)
 
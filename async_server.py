@@ -0,0 +1,355 @@
+import asyncio, inspect, socket, traceback, typing, multiprocessing, concurrent.futures
+import AES_cipher, handshake, tickets, prefork, util, header_table
+
+class AsyncSession:
+    def __init__(self, server: "AsyncServer", reader: asyncio.StreamReader, writer: asyncio.StreamWriter, cipher: AES_cipher.AES | AES_cipher.AEAD, extensions: dict[str, int] | None = None) -> None:
+        self._server = server
+        self._reader = reader
+        self._writer = writer
+        self._cipher = cipher
+
+        self._encoder, self._decoder = header_table.codec(extensions or {})
+
+        # Whether the head of the current response went out, an error after it is sent as a plain message
+        self.head_sent = False
+
+    async def arecv(self) -> bytes | None:
+        cipher_text = await asyncio.wait_for(self._server._recv_msg(self._reader, self._server.max_frame_size), self._server.idle_timeout)
+
+        if cipher_text is None:
+            return None
+
+        return await self._server._decrypt(self._cipher, cipher_text)
+
+    def recv(self) -> bytes | None:
+        try:
+            asyncio.get_running_loop()
+
+        except RuntimeError:
+            # Blocking handlers run on worker threads and wait for the event loop to read the next message
+            return asyncio.run_coroutine_threadsafe(self.arecv(), self._server._loop).result()
+
+        raise RuntimeError("blocking read on the event loop, read chunked bodies with async for in async handlers")
+
+    async def send(self, data: bytes):
+        await self._server._send_msg(self._writer, await self._server._encrypt(self._cipher, data))
+
+    # The first message of a request or response is its head, only heads go through the header table
+    async def arecv_head(self) -> bytes | None:
+        if (data := await self.arecv()) is None or self._decoder is None:
+            return data
+
+        return self._decoder.decode(data)
+
+    async def send_head(self, data: bytes):
+        self.head_sent = True
+
+        await self.send(self._encoder.encode(data) if self._encoder else data)
+
+class AsyncServer:
+    def __init__(self, kem_alg: str = "ML-KEM-512", idle_timeout: float | None = 5.0, max_requests: int | None = 100, ticket_keys: tickets.TicketKeys | None = None, static_key: tuple[bytes, bytes] | None = None, replay_window: float = 10.0, crypto_processes: int | None = None, offload_threshold: int = 1 << 20, suites: list[str] | None = None, max_frame_size: int | None = util.MAX_FRAME_SIZE, header_table_size: int | None = header_table.DEFAULT_TABLE_SIZE, handshake_timeout: float | None = 5.0) -> None:
+        self.kem_alg = kem_alg
+        self.idle_timeout = idle_timeout
+
+        # Seconds a connection has for its whole handshake, one that never sends its hello is closed
+        self.handshake_timeout = handshake_timeout
+        self.max_requests = max_requests
+        self.ticket_keys = ticket_keys
+
+        self.static_key = static_key
+        self._replay_cache = handshake.ReplayCache(replay_window) if static_key else None
+
+        # Cipher suites accepted from clients in order of preference
+        self.suites = suites or AES_cipher.DEFAULT_SUITES
+
+        self.max_frame_size = max_frame_size
+
+        # Clients that ask for it send heads in the binary header format with a table of this many bytes per direction
+        self.header_table_size = header_table_size
+
+        self.crypto_processes = crypto_processes
+        self.offload_threshold = offload_threshold
+
+        self._executor = None
+        self._handler = None
+        self._handler_streams = False
+        self._stopped = False
+        self._loop = None
+        self._stop_event = None
+        self._supervisor = None
+
+    @property
+    def static_public_key(self) -> bytes | None:
+        return self.static_key[0] if self.static_key else None
+
+    @property
+    def extensions(self) -> dict[str, int]:
+        # Multiplexed tunnels are only served by the threaded engine
+        return {"headers": self.header_table_size} if self.header_table_size is not None else {}
+
+    @staticmethod
+    async def _recv_msg(reader: asyncio.StreamReader, max_frame_size: int | None = util.MAX_FRAME_SIZE) -> bytes | None:
+        try:
+            msg_len = util.HEADER.unpack(await reader.readexactly(4))[0]
+
+            util.check_frame_size(msg_len, max_frame_size)
+
+            return await reader.readexactly(msg_len)
+
+        except asyncio.IncompleteReadError:
+            return None
+
+    @staticmethod
+    async def _send_msg(writer: asyncio.StreamWriter, msg: bytes):
+        # Handed to the transport as separate buffers, it sends them with one scatter-gather call where it can
+        writer.writelines([util.HEADER.pack(len(msg)), msg])
+
+        await writer.drain()
+
+    async def _init_kem_tunnel(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> tuple[AES_cipher.AES | AES_cipher.AEAD | None, bytes | None, dict[str, int]]:
+        # A rejected ticket or early data is followed by a full handshake on the same connection
+        for _ in range(2):
+            try:
+                hello = await self._recv_msg(reader, handshake.MAX_HELLO_SIZE)
+
+            except ValueError:
+                # A hello over the size limit
+                return None, None, {}
+
+            if hello is None:
+                return None, None, {}
+
+            if self._executor is not None:
+                # Wait for the worker process on a thread so the loop keeps serving other sessions
+                reply, cipher, early_data, extensions = await asyncio.to_thread(handshake.accept, hello, self.kem_alg, self.ticket_keys, self.static_key, self._replay_cache, self._executor, self.suites, self.extensions)
+
+            else:
+                reply, cipher, early_data, extensions = handshake.accept(hello, self.kem_alg, self.ticket_keys, self.static_key, self._replay_cache, None, self.suites, self.extensions)
+
+            await self._send_msg(writer, reply)
+
+            if cipher is not None:
+                return cipher, early_data, extensions
+
+        return None, None, {}
+
+    async def _encrypt(self, cipher: AES_cipher.AES | AES_cipher.AEAD, data: bytes) -> bytes:
+        if self._executor is not None and len(data) >= self.offload_threshold:
+            return await self._loop.run_in_executor(self._executor, AES_cipher.encrypt_record, cipher.suite, *cipher.next_send(), data)
+
+        return cipher.encrypt(data)
+
+    async def _decrypt(self, cipher: AES_cipher.AES | AES_cipher.AEAD, data: bytes) -> bytes:
+        if self._executor is not None and len(data) >= self.offload_threshold:
+            return await self._loop.run_in_executor(self._executor, AES_cipher.decrypt_record, cipher.suite, *cipher.next_recv(), data)
+
+        return cipher.decrypt(data)
+
+    async def _call_handler(self, req: bytes, addr: tuple[str, int], session: AsyncSession) -> bytes | typing.Iterable[bytes] | typing.AsyncIterable[bytes]:
+        if not self._handler:
+            return req
+
+        # Stream handlers pull the rest of a chunked request from the session themselves
+        args = (req, addr, session) if self._handler_streams else (req, addr)
+
+        if inspect.iscoroutinefunction(self._handler):
+            return await self._handler(*args)
+
+        # Blocking handlers run on a worker thread so they do not stall every other session
+        return await asyncio.to_thread(self._handler, *args)
+
+    @staticmethod
+    async def _send_resp(session: AsyncSession, resp: bytes | typing.Iterable[bytes] | typing.AsyncIterable[bytes]):
+        if isinstance(resp, (bytes, bytearray)):
+            await session.send_head(resp)
+
+            return
+
+        # The first message of a streamed response is its head
+        send = session.send_head
+
+        if hasattr(resp, "__aiter__"):
+            async for msg in resp:
+                await send(msg)
+
+                send = session.send
+
+        else:
+            # Chunks may be read from files or pulled from the client, get each one on a worker thread
+            chunks = iter(resp)
+
+            while (msg := await asyncio.to_thread(next, chunks, None)) is not None:
+                await send(msg)
+
+                send = session.send
+
+    async def _handle_session(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        addr = writer.get_extra_info("peername")[:2]
+
+        try:
+            try:
+                cipher, req, extensions = await asyncio.wait_for(self._init_kem_tunnel(reader, writer), self.handshake_timeout)
+
+            except TimeoutError:
+                return
+
+            if cipher is None:
+                return
+
+            session = AsyncSession(self, reader, writer, cipher, extensions)
+
+            requests = 0
+
+            while self.max_requests is None or requests < self.max_requests:
+                # 0-RTT early data is the first request of the session
+                if req is None:
+                    try:
+                        req = await session.arecv_head()
+
+                    except TimeoutError:
+                        break
+
+                    except ValueError:
+                        # Tampered or out of order record or a head the header table cannot decode, the session cannot be trusted any more
+                        break
+
+                    if req is None:
+                        break
+
+                requests += 1
+
+                session.head_sent = False
+
+                try:
+                    # A streamed response is sent as one message per chunk
+                    await self._send_resp(session, await self._call_handler(req, addr, session))
+
+                except Exception:
+                    # The client hung up part way through the response, like one that stops reading a streamed body, and there is no one left to tell
+                    if writer.is_closing():
+                        return
+
+                    try:
+                        if session.head_sent:
+                            await session.send(b"SERVER ERROR")
+
+                        else:
+                            await session.send_head(b"SERVER ERROR")
+
+                    except (ConnectionError, TimeoutError):
+                        return
+
+                    # Nothing awaits the session task, so the error is logged here like the threaded server's workers do
+                    traceback.print_exc()
+
+                    return
+
+                req = None
+
+        finally:
+            writer.close()
+
+    async def serve_async(self, address: tuple[str, int], connections: int = 10, reuse_port: bool = False, sock: socket.socket | None = None):
+        self.address = address
+
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+
+        self._sessions: set[asyncio.Task] = set()
+
+        if self.crypto_processes:
+            self._executor = concurrent.futures.ProcessPoolExecutor(self.crypto_processes, multiprocessing.get_context("spawn"))
+
+        def callback(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            task = self._loop.create_task(self._handle_session(reader, writer))
+
+            self._sessions.add(task)
+            task.add_done_callback(self._sessions.discard)
+
+        if sock is not None:
+            sv = await asyncio.start_server(callback, sock = sock)
+
+        else:
+            sv = await asyncio.start_server(callback, address[0], address[1], backlog = connections, reuse_port = reuse_port or None)
+
+        if self._stopped:
+            self._stop_event.set()
+
+        async with sv:
+            await self._stop_event.wait()
+
+        if self._sessions:
+            await asyncio.wait(self._sessions.copy(), timeout = 5)
+
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def _stop_worker(self):
+        self._stopped = True
+
+        # Safe to call from handler threads, signal handlers and the event loop itself
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
+
+    def serve(self, address: tuple[str, int], connections: int = 10, processes: int | None = None):
+        if not processes:
+            asyncio.run(self.serve_async(address, connections))
+
+            return
+
+        self.address = address
+        self._supervisor = prefork.Supervisor(processes)
+
+        # Each worker would keep its own replay cache and a flight replayed to another worker would be accepted again,
+        # so pre-forked servers refuse early data and clients fall back to a full handshake
+        if processes > 1:
+            self._replay_cache = None
+
+        if prefork.REUSE_PORT:
+            # Every worker binds its own socket and the kernel spreads connections across them
+            self._supervisor.run(lambda: asyncio.run(self.serve_async(address, connections, reuse_port = True)), self._stop_worker)
+
+        else:
+            sock = socket.create_server(address, backlog = connections)
+
+            self._supervisor.run(lambda: asyncio.run(self.serve_async(address, connections, sock = sock)), self._stop_worker)
+
+            sock.close()
+
+    def close(self):
+        self._stop_worker()
+
+        # In pre-forked mode this stops every worker, not only the process it is called in
+        if self._supervisor is not None:
+            self._supervisor.stop()
+
+    def handle_data(self, func: typing.Callable[[bytes, tuple[str, int]], bytes | typing.Awaitable[bytes]]) -> typing.Callable[[bytes, tuple[str, int]], bytes | typing.Awaitable[bytes]]:
+        self._handler = func
+        self._handler_streams = False
+
+        return func
+
+    def handle_stream(self, func: typing.Callable[[bytes, tuple[str, int], AsyncSession], typing.Any]) -> typing.Callable[[bytes, tuple[str, int], AsyncSession], typing.Any]:
+        self._handler = func
+        self._handler_streams = True
+
+        return func
+
+if __name__ == "__main__":
+    server = AsyncServer()
+
+    @server.handle_data
+    async def handle(frame: bytes, addr: tuple[str, int]) -> bytes:
+        print(f"connection from {addr}")
+
+        if len(frame) < 100:
+            print(f"data = {frame}")
+
+        else:
+            print(f"data = {frame[:100]}...")
+
+        print(f"{len(frame) = }")
+
+        return f"{addr[0]}:{addr[1]}".encode()
+
+    server.serve(("0.0.0.0", 8080))
\ No newline at end of file
@@ -0,0 +1,203 @@
+import random, threading, time, typing
+import QSTP_client, breaker
+
+POLICIES = ("round_robin", "least_outstanding", "p2c")
+
+# Weight of the newest sample in the latency average
+LATENCY_DECAY = 0.3
+
+# Deadlines in seconds for connecting to an upstream (handshake included) and for every read of its response
+DEFAULT_CONNECT_TIMEOUT = 3.0
+DEFAULT_RESPONSE_TIMEOUT = 30.0
+
+def parse_location(location: str) -> tuple[str, int]:
+    """Helper function to turn a `host:port` location from the route table into an address"""
+
+    host, port = location.rsplit(":", 1)
+
+    return host, int(port)
+
+class Upstream:
+    def __init__(self, address: tuple[str, int], weight: int = 1, connect_timeout: float | None = DEFAULT_CONNECT_TIMEOUT, response_timeout: float | None = DEFAULT_RESPONSE_TIMEOUT, circuit: breaker.CircuitBreaker | None = None) -> None:
+        if weight < 1:
+            raise ValueError(f"upstream weight must be at least 1, not {weight}")
+
+        self.address = address
+        self.weight = weight
+
+        self.connect_timeout = connect_timeout
+        self.response_timeout = response_timeout
+
+        # Failing or slow upstreams trip their circuit and get no requests until trial requests find them recovered
+        self.circuit = circuit or breaker.CircuitBreaker()
+
+        self.outstanding = 0
+        self.latency = 0.0
+
+        # Health probes take an upstream out of rotation, a refused request only for a cooldown
+        self.healthy = True
+        self.down_until = 0.0
+
+        self._successes = 0
+        self._failures = 0
+
+        # Smooth weighted round robin state
+        self._current = 0
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(address = {self.address}, weight = {self.weight}, healthy = {self.healthy}, circuit = {self.circuit.state}, outstanding = {self.outstanding}, latency = {self.latency * 1000 :.2f}ms)"
+
+    @property
+    def available(self) -> bool:
+        return self.healthy and time.monotonic() >= self.down_until
+
+class Balancer:
+    def __init__(self, upstreams: list[Upstream], policy: str = "round_robin", cooldown: float = 5.0) -> None:
+        if policy not in POLICIES:
+            raise ValueError(f"{policy!r} is not a balancing policy")
+
+        if not upstreams:
+            raise ValueError("a balancer needs at least one upstream")
+
+        self.upstreams = upstreams
+        self.policy = policy
+        self.cooldown = cooldown
+
+        self._lock = threading.Lock()
+        self._random = random.Random()
+
+        self._checker = None
+        self._stopped = threading.Event()
+
+    @staticmethod
+    def from_route(route: dict[str, typing.Any]) -> "Balancer":
+        # A route either has a single location or a list of upstreams, each a location or {"location": ..., "weight": ...},
+        # "connect_timeout" and "response_timeout" of the route apply to upstreams without their own, "breaker" holds CircuitBreaker settings
+        upstreams = []
+
+        for entry in route.get("upstreams", [route.get("location")]):
+            if isinstance(entry, str):
+                entry = {"location": entry}
+
+            upstreams.append(Upstream(
+                parse_location(entry["location"]),
+                entry.get("weight", 1),
+                entry.get("connect_timeout", route.get("connect_timeout", DEFAULT_CONNECT_TIMEOUT)),
+                entry.get("response_timeout", route.get("response_timeout", DEFAULT_RESPONSE_TIMEOUT)),
+                breaker.CircuitBreaker(**route.get("breaker", {})),
+            ))
+
+        return Balancer(upstreams, route.get("policy", "round_robin"), route.get("cooldown", 5.0))
+
+    def _round_robin(self, candidates: list[Upstream]) -> Upstream:
+        # Every pick raises each candidate by its weight and lowers the chosen one by the total, heavy upstreams get picked more often without bursts
+        total = 0
+        best = None
+
+        for upstream in candidates:
+            upstream._current += upstream.weight
+            total += upstream.weight
+
+            if best is None or upstream._current > best._current:
+                best = upstream
+
+        best._current -= total
+
+        return best
+
+    def _least_outstanding(self, candidates: list[Upstream]) -> Upstream:
+        least = min(upstream.outstanding / upstream.weight for upstream in candidates)
+
+        return self._random.choice([upstream for upstream in candidates if upstream.outstanding / upstream.weight == least])
+
+    def _p2c(self, candidates: list[Upstream]) -> Upstream:
+        if len(candidates) == 1:
+            return candidates[0]
+
+        first, second = self._random.choices(candidates, [upstream.weight for upstream in candidates], k = 2)
+
+        while second is first:
+            second = self._random.choice(candidates)
+
+        # Latency grows with the queue in front of it, so both are weighed
+        cost = lambda upstream: upstream.latency * (upstream.outstanding + 1) / upstream.weight
+
+        return first if cost(first) <= cost(second) else second
+
+    # None once every upstream was tried or has an open circuit, the caller fails over instead of waiting on them
+    def acquire(self, exclude: typing.Collection[Upstream] = (), spare: bool = False) -> Upstream | None:
+        with self._lock:
+            if not (candidates := [upstream for upstream in self.upstreams if upstream not in exclude and upstream.circuit.ready]):
+                return None
+
+            # With every upstream out of rotation one is still tried, a request that may fail beats one that surely does,
+            # a spare request (a hedge) only goes to one in rotation
+            if not (available := [upstream for upstream in candidates if upstream.available]) and spare:
+                return None
+
+            candidates = available or candidates
+
+            upstream = getattr(self, f"_{self.policy}")(candidates)
+
+            upstream.circuit.attempt()
+            upstream.outstanding += 1
+
+        return upstream
+
+    # Without a latency the upstream refused or timed out, `failed` marks an answer that was a server error
+    def release(self, upstream: Upstream, latency: float | None = None, failed: bool = False):
+        with self._lock:
+            upstream.outstanding -= 1
+
+            upstream.circuit.record(failed or latency is None, latency or 0.0)
+
+            if latency is None:
+                # Refused, leave it alone until the cooldown passes or a probe finds it healthy again
+                upstream.down_until = time.monotonic() + self.cooldown
+
+                return
+
+            upstream.latency = latency if upstream.latency == 0.0 else upstream.latency + LATENCY_DECAY * (latency - upstream.latency)
+
+    def _probe(self, upstream: Upstream, path: str, host: str | None) -> bool:
+        try:
+            resp = QSTP_client.QSTP_Client(connect_timeout = upstream.connect_timeout, response_timeout = upstream.response_timeout).request(upstream.address, "GET", path, {"Host": host} if host else None)
+
+        except Exception:
+            return False
+
+        # Connection refused and server errors count as down, any other answer means the upstream serves requests
+        return resp.status_code not in (1, 101)
+
+    def check(self, path: str = "/", host: str | None = None, rise: int = 2, fall: int = 2):
+        for upstream in self.upstreams:
+            ok = self._probe(upstream, path, host)
+
+            with self._lock:
+                if ok:
+                    upstream._successes += 1
+                    upstream._failures = 0
+
+                    if upstream._successes >= rise:
+                        upstream.healthy = True
+                        upstream.down_until = 0.0
+
+                else:
+                    upstream._failures += 1
+                    upstream._successes = 0
+
+                    if upstream._failures >= fall:
+                        upstream.healthy = False
+
+    def start_health_checks(self, interval: float = 2.0, path: str = "/", host: str | None = None, rise: int = 2, fall: int = 2):
+        def run():
+            while not self._stopped.is_set():
+                self.check(path, host, rise, fall)
+
+                self._stopped.wait(interval)
+
+        self._checker = threading.Thread(target = run, name = f"health-check-{host or self.upstreams[0].address}", daemon = True)
+        self._checker.start()
+
+    def close(self):
+        self._stopped.set()
\ No newline at end of file
@@ -0,0 +1,336 @@
+import argparse, json, os, platform, random, socket, subprocess, sys, threading, time, typing
+import oqs, AES_cipher, handshake, server, client, router, QSTP, QSTP_server, QSTP_client, QSTP_reverse_proxy, proxy
+
+KEM_ALGS = ["ML-KEM-512", "ML-KEM-768", "ML-KEM-1024"]
+
+PAYLOAD_SIZES = [0, 1 << 10, 16 << 10, 256 << 10, 1 << 20]
+
+ROUTE_TABLE_SIZES = [10, 100, 1000, 10000]
+
+# Payloads come from a fixed seed so runs compare like with like
+SEED = 0
+
+def free_port() -> int:
+    """Helper function to find a loopback port nothing listens on"""
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+
+        return sock.getsockname()[1]
+
+def start(serve: typing.Callable[[tuple[str, int]], None], kem_alg: str = "ML-KEM-512") -> tuple[str, int]:
+    """Helper function to run `serve` on a fresh loopback port in a daemon thread, returns the address once it answers handshakes"""
+
+    address = ("127.0.0.1", free_port())
+
+    threading.Thread(target = serve, args = (address,), daemon = True).start()
+
+    deadline = time.monotonic() + 10
+
+    while True:
+        try:
+            client.Client(kem_alg).connect(address).close()
+
+            return address
+
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+
+            time.sleep(0.01)
+
+def percentile(samples: list[float], q: float) -> float:
+    """Helper function to read the `q` quantile off a list of samples"""
+
+    ordered = sorted(samples)
+
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def summarize(latencies: list[float], elapsed: float) -> dict[str, float]:
+    """Helper function to turn per operation latencies in seconds into rate and percentiles in milliseconds"""
+
+    return {
+        "count": len(latencies),
+        "per_sec": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+def timed(func: typing.Callable[[], typing.Any], count: int) -> dict[str, float]:
+    """Helper function to call `func` `count` times after a short warm up and summarize the latencies"""
+
+    for _ in range(min(count, 10)):
+        func()
+
+    latencies = []
+
+    start_time = time.perf_counter()
+
+    for _ in range(count):
+        t = time.perf_counter()
+
+        func()
+
+        latencies.append(time.perf_counter() - t)
+
+    return summarize(latencies, time.perf_counter() - start_time)
+
+def echo_server(transport: server.Server | None = None) -> QSTP_server.QSTP_Server:
+    """Helper function to build the QSTP server every request benchmark talks to, `/echo` answers with the request body"""
+
+    sv = QSTP_server.QSTP_Server(transport)
+
+    @sv.route("/echo", ["GET", "POST"])
+    def echo(rq: QSTP.Request, _) -> QSTP.Response:
+        return QSTP.Response(200, data = rq.data)
+
+    return sv
+
+def bench_handshakes(count: int) -> dict[str, dict[str, float]]:
+    results = {}
+
+    for kem_alg in KEM_ALGS:
+        if kem_alg not in oqs.get_enabled_kem_mechanisms():
+            continue
+
+        sv = server.Server(kem_alg)
+
+        address = start(lambda address: sv.serve(address), kem_alg)
+
+        # Every client starts without tickets, so each connect is a full KEM handshake
+        results[kem_alg] = timed(lambda: client.Client(kem_alg).connect(address).close(), count)
+
+        sv.close()
+
+    return results
+
+def bench_requests(count: int, sizes: list[int]) -> dict[str, dict[str, float]]:
+    sv = echo_server()
+
+    address = start(sv.serve)
+
+    cl = QSTP_client.QSTP_Client(keep_alive = True)
+
+    rand = random.Random(SEED)
+
+    results = {}
+
+    for size in sizes:
+        payload = rand.randbytes(size)
+
+        # Large payloads take long enough per request that fewer of them give as steady a number
+        results[str(size)] = timed(lambda: cl.request(address, "POST", "/echo", data = payload), max(10, count * 1024 // max(size, 1024)))
+
+        # The payload goes up and comes back, both count
+        results[str(size)]["mb_per_sec"] = results[str(size)]["per_sec"] * size * 2 / (1 << 20)
+
+    cl.close()
+    sv.close()
+
+    return results
+
+def bench_ciphers(size: int, count: int) -> dict[str, dict[str, float]]:
+    data = random.Random(SEED).randbytes(size)
+    secret = random.Random(SEED).randbytes(32)
+
+    results = {}
+
+    for suite in AES_cipher.SUITES:
+        sender = handshake.session_cipher(suite, secret, False)
+        receiver = handshake.session_cipher(suite, secret, True)
+
+        records = []
+
+        start_time = time.perf_counter()
+
+        for _ in range(count):
+            records.append(sender.encrypt(data))
+
+        encrypt_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+
+        for record in records:
+            receiver.decrypt(record)
+
+        decrypt_time = time.perf_counter() - start_time
+
+        results[suite] = {
+            "encrypt_mb_per_sec": size * count / encrypt_time / (1 << 20),
+            "decrypt_mb_per_sec": size * count / decrypt_time / (1 << 20),
+        }
+
+    return results
+
+def bench_router(lookups: int, sizes: list[int]) -> dict[str, dict[str, float]]:
+    rand = random.Random(SEED)
+
+    results = {}
+
+    for size in sizes:
+        rt = router.Router()
+
+        paths = []
+
+        # A mix of static routes and routes with converted parameters, like a real route table
+        for i in range(size):
+            if i % 2:
+                rt.route(f"/api/v{i % 3}/resource{i}/<int:id>")(lambda rq, args: None)
+
+                paths.append(f"/api/v{i % 3}/resource{i}/{rand.randrange(1 << 16)}")
+
+            else:
+                rt.route(f"/static/section{i % 7}/page{i}")(lambda rq, args: None)
+
+                paths.append(f"/static/section{i % 7}/page{i}")
+
+        queries = [rand.choice(paths) for _ in range(lookups)]
+
+        start_time = time.perf_counter()
+
+        for path in queries:
+            rt.match_route(path, "GET")
+
+        results[str(size)] = {"lookups_per_sec": lookups / (time.perf_counter() - start_time)}
+
+    return results
+
+def bench_proxies(count: int, size: int) -> dict[str, dict[str, float]]:
+    sv = echo_server()
+
+    upstream = start(sv.serve)
+
+    payload = random.Random(SEED).randbytes(size)
+
+    store = proxy.Proxy()
+    relay = proxy.Proxy(relay = True)
+
+    reverse = QSTP_reverse_proxy.QSTP_ReverseProxy()
+    reverse.set_routing({"bench": {"location": f"{upstream[0]}:{upstream[1]}"}})
+
+    targets = {
+        "direct": (upstream, {}),
+        "proxy": (start(lambda address: store.serve(address, upstream)), {}),
+        "proxy_relay": (start(lambda address: relay.serve(address, upstream)), {}),
+        "reverse_proxy": (start(reverse.serve), {"Host": "bench"}),
+    }
+
+    results = {}
+
+    for name, (address, headers) in targets.items():
+        cl = QSTP_client.QSTP_Client(keep_alive = True)
+
+        results[name] = timed(lambda: cl.request(address, "POST", "/echo", headers, payload), count)
+
+        cl.close()
+
+    # What each hop adds on top of talking to the upstream directly
+    for name in ("proxy", "proxy_relay", "reverse_proxy"):
+        results[name]["overhead_p50_ms"] = results[name]["p50_ms"] - results["direct"]["p50_ms"]
+
+    for closeable in (store, relay, reverse, sv):
+        closeable.close()
+
+    return results
+
+def environment() -> dict[str, typing.Any]:
+    """Helper function to describe the machine and code a run measured, results are only comparable between like runs"""
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output = True, text = True, cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+
+    except OSError:
+        commit = None
+
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "commit": commit,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+def compare(baseline: dict[str, typing.Any], report: dict[str, typing.Any], tolerance: float = 0.1) -> list[str]:
+    """Helper function to list the metrics of `report` that are more than `tolerance` worse than in `baseline`, rates should not drop and times should not grow"""
+
+    regressions = []
+
+    for group, entries in report["results"].items():
+        for name, values in entries.items():
+            for metric, value in values.items():
+                if (old := baseline["results"].get(group, {}).get(name, {}).get(metric)) is None or metric == "count" or not old:
+                    continue
+
+                change = (value - old) / abs(old)
+
+                if (change > tolerance if metric.endswith("_ms") else change < -tolerance):
+                    regressions.append(f"{group} {name} {metric}: {old:.2f} -> {value:.2f} ({change:+.0%})")
+
+    return regressions
+
+BENCHMARKS = ("handshakes", "requests", "ciphers", "router", "proxies")
+
+def run(only: typing.Iterable[str] = BENCHMARKS, quick: bool = False) -> dict[str, typing.Any]:
+    """Helper function to run the chosen benchmarks, `quick` trades precision for a run of a few seconds"""
+
+    scale = 10 if quick else 1
+
+    only = set(only)
+
+    results = {}
+
+    if "handshakes" in only:
+        results["handshakes"] = bench_handshakes(200 // scale)
+
+    if "requests" in only:
+        results["requests"] = bench_requests(2000 // scale, PAYLOAD_SIZES)
+
+    if "ciphers" in only:
+        results["ciphers"] = bench_ciphers(1 << 20, 100 // scale)
+
+    if "router" in only:
+        results["router"] = bench_router(200000 // scale, ROUTE_TABLE_SIZES)
+
+    if "proxies" in only:
+        results["proxies"] = bench_proxies(1000 // scale, 1 << 10)
+
+    return {"environment": environment(), "results": results}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Loopback benchmarks for QSTP, results are written as JSON")
+
+    parser.add_argument("-o", "--output", default = "bench_results.json", help = "file to write the results to, - for stdout")
+    parser.add_argument("--only", default = ",".join(BENCHMARKS), help = f"comma separated benchmarks to run, any of {", ".join(BENCHMARKS)}")
+    parser.add_argument("--quick", action = "store_true", help = "fewer iterations, for a smoke test rather than numbers to compare")
+    parser.add_argument("--compare", metavar = "BASELINE", help = "results file of an earlier run, exits with 1 if a metric got worse by more than the tolerance")
+    parser.add_argument("--tolerance", type = float, default = 0.1, help = "relative change a metric may get worse by before it counts as a regression")
+
+    args = parser.parse_args()
+
+    if (unknown := set(args.only.split(",")) - set(BENCHMARKS)):
+        parser.error(f"unknown benchmarks: {", ".join(sorted(unknown))}")
+
+    report = run(args.only.split(","), args.quick)
+
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent = 4)
+
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent = 4)
+
+        for group, entries in report["results"].items():
+            print(f" -- {group} -- ")
+
+            for name, values in entries.items():
+                print(f"{name}: " + ", ".join(f"{k} = {v:.2f}" if isinstance(v, float) else f"{k} = {v}" for k, v in values.items()))
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), report, args.tolerance)
+
+        for line in regressions:
+            print(f"regression: {line}", file = sys.stderr)
+
+        sys.exit(1 if regressions else 0)
\ No newline at end of file
@@ -0,0 +1,143 @@
+import collections, threading, time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+class CircuitBreaker:
+    def __init__(self, error_rate: float = 0.5, slow_rate: float = 0.5, slow_call: float | None = None, window: float = 10.0, min_requests: int = 10, consecutive_failures: int = 5, open_for: float = 5.0, trials: int = 3) -> None:
+        if not 0 < error_rate <= 1 or not 0 < slow_rate <= 1:
+            raise ValueError("breaker rates must be in (0, 1]")
+
+        if trials < 1:
+            raise ValueError(f"a half-open breaker needs at least 1 trial, not {trials}")
+
+        # The circuit opens once, over the last `window` seconds and at least `min_requests` requests, the share of failures
+        # or of calls slower than `slow_call` seconds reaches its rate, or after `consecutive_failures` failures in a row
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_call = slow_call
+        self.window = window
+        self.min_requests = min_requests
+        self.consecutive_failures = consecutive_failures
+
+        # An open circuit turns half-open after `open_for` seconds and lets `trials` requests through, all of them have to succeed to close it
+        self.open_for = open_for
+        self.trials = trials
+
+        self.opened = 0
+
+        self._state = CLOSED
+        self._opened_at = 0.0
+
+        self._attempts = 0
+        self._successes = 0
+        self._streak = 0
+
+        # (time, failed, slow) per finished request, oldest first
+        self._outcomes: collections.deque[tuple[float, bool, bool]] = collections.deque()
+        self._failed = 0
+        self._slow = 0
+
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(state = {self.state}, requests = {len(self._outcomes)}, failed = {self._failed}, slow = {self._slow})"
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current()
+
+    def _current(self) -> str:
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_for:
+            self._state = HALF_OPEN
+
+            self._attempts = 0
+            self._successes = 0
+
+        return self._state
+
+    # Whether a request may go through now, checking it does not use up a half-open trial
+    @property
+    def ready(self) -> bool:
+        with self._lock:
+            if (state := self._current()) == HALF_OPEN:
+                return self._attempts < self.trials
+
+            return state == CLOSED
+
+    # Called for the request picked after checking `ready`
+    def attempt(self):
+        with self._lock:
+            if self._current() == HALF_OPEN:
+                self._attempts += 1
+
+    def _open(self):
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+
+        self.opened += 1
+
+        self._reset()
+
+    def _reset(self):
+        self._outcomes.clear()
+
+        self._failed = 0
+        self._slow = 0
+        self._streak = 0
+
+    def _prune(self, now: float):
+        while self._outcomes and now - self._outcomes[0][0] > self.window:
+            _, failed, slow = self._outcomes.popleft()
+
+            self._failed -= failed
+            self._slow -= slow
+
+    def record(self, failed: bool, latency: float = 0.0):
+        slow = self.slow_call is not None and latency > self.slow_call
+
+        with self._lock:
+            if self._current() == HALF_OPEN:
+                # A trial that fails or is slow shows the upstream has not recovered yet
+                if failed or slow:
+                    self._open()
+
+                elif (successes := self._successes + 1) >= self.trials:
+                    self._state = CLOSED
+
+                    self._reset()
+
+                else:
+                    self._successes = successes
+
+                return
+
+            if self._state == OPEN:
+                return
+
+            now = time.monotonic()
+
+            self._outcomes.append((now, failed, slow))
+            self._failed += failed
+            self._slow += slow
+
+            self._streak = self._streak + 1 if failed else 0
+
+            self._prune(now)
+
+            if self._streak >= self.consecutive_failures:
+                self._open()
+
+            elif len(self._outcomes) >= self.min_requests and (self._failed >= self.error_rate * len(self._outcomes) or self._slow >= self.slow_rate * len(self._outcomes)):
+                self._open()
+
+    def stats(self) -> dict[str, int | str]:
+        return {
+            "state": self.state,
+            "requests": len(self._outcomes),
+            "failed": self._failed,
+            "slow": self._slow,
+            "opened": self.opened,
+        }
\ No newline at end of file
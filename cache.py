@@ -0,0 +1,171 @@
+import collections, threading, time, typing
+import QSTP
+
+# Counted for every entry on top of its frame, keeps many tiny entries from slipping past the budget
+ENTRY_OVERHEAD = 256
+
+def parse_cache_control(value: str | None) -> dict[str, int | None]:
+    """Helper function to parse a cache-control header into {directive: value}, directives without a number map to `None`"""
+
+    directives = {}
+
+    for part in (value or "").split(","):
+        name, _, arg = part.strip().partition("=")
+
+        if name:
+            directives[name.lower()] = int(arg) if arg.strip().isdigit() else None
+
+    return directives
+
+def request_key(host: str, rq: QSTP.Request, key_headers: tuple[str, ...], method: str | None = None) -> tuple:
+    """Helper function to identify a request by host, method, path and the values of `key_headers`"""
+
+    return (host, method or rq.method, rq.path, *(rq.get_header(name) for name in key_headers))
+
+class Entry:
+    def __init__(self, frame: bytes, etag: str | None, max_age: int, revalidate: bool) -> None:
+        self.frame = frame
+        self.etag = etag
+        self.max_age = max_age
+        self.revalidate = revalidate
+
+        self.expires = time.monotonic() + max_age
+        self.size = len(frame) + ENTRY_OVERHEAD
+
+    @property
+    def fresh(self) -> bool:
+        return not self.revalidate and time.monotonic() < self.expires
+
+    def response(self) -> QSTP.Response:
+        # Parsing is lazy, so a hit only indexes the stored frame
+        return QSTP.Response.from_frame(self.frame)
+
+class ResponseCache:
+    def __init__(self, max_bytes: int = 64 << 20, max_entry_bytes: int | None = None, key_headers: typing.Iterable[str] = ("authorization", "accept-encoding")) -> None:
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes if max_entry_bytes is not None else max_bytes // 8
+
+        # Requests that differ in one of these headers get separate entries, a compressed body must not reach a client that cannot read it
+        self.key_headers = tuple(key_headers)
+
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.evictions = 0
+
+        # Least recently used first
+        self._entries: collections.OrderedDict[tuple, Entry] = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        # Keys of the stored entries by (host, method, path), one per combination of key_headers a client sent
+        self._variants: dict[tuple, set[tuple]] = {}
+
+    def key(self, host: str, rq: QSTP.Request, method: str | None = None) -> tuple:
+        return request_key(host, rq, self.key_headers, method)
+
+    # The entry for key, fresh or stale, a stale one can still be revalidated with its etag
+    def lookup(self, key: tuple) -> Entry | None:
+        with self._lock:
+            if (entry := self._entries.get(key)) is None:
+                self.misses += 1
+
+                return None
+
+            self._entries.move_to_end(key)
+
+            if entry.fresh:
+                self.hits += 1
+
+            else:
+                self.misses += 1
+
+            return entry
+
+    def _evict(self, key: tuple):
+        entry = self._entries.pop(key)
+
+        self.size -= entry.size
+
+        variants = self._variants[key[:3]]
+        variants.discard(key)
+
+        if not variants:
+            del self._variants[key[:3]]
+
+    def store(self, key: tuple, resp: QSTP.Response) -> Entry | None:
+        # Only complete OK responses the upstream allows a shared cache to keep are stored
+        if resp.status_code != 200 or resp.streamed or resp.chunked:
+            return None
+
+        directives = parse_cache_control(resp.get_header("cache-control"))
+        etag = resp.get_header("etag")
+
+        if "no-store" in directives or "private" in directives:
+            return None
+
+        # Without a lifetime a response is only worth keeping if it can be revalidated
+        if (max_age := directives.get("max-age")) is None and etag is None:
+            return None
+
+        entry = Entry(resp.to_frame(), etag, max_age or 0, "no-cache" in directives)
+
+        if entry.size > self.max_entry_bytes:
+            return None
+
+        with self._lock:
+            if key in self._entries:
+                self._evict(key)
+
+            while self._entries and self.size + entry.size > self.max_bytes:
+                self._evict(next(iter(self._entries)))
+
+                self.evictions += 1
+
+            self._entries[key] = entry
+            self.size += entry.size
+
+            self._variants.setdefault(key[:3], set()).add(key)
+
+        return entry
+
+    def refresh(self, entry: Entry, resp: QSTP.Response) -> Entry:
+        # A 207 NOT MODIFIED from the upstream confirms the stored body and may carry a new lifetime
+        if (max_age := parse_cache_control(resp.get_header("cache-control")).get("max-age")) is not None:
+            entry.max_age = max_age
+
+        entry.expires = time.monotonic() + entry.max_age
+
+        with self._lock:
+            self.revalidated += 1
+
+        return entry
+
+    def invalidate(self, key: tuple):
+        with self._lock:
+            if key in self._entries:
+                self._evict(key)
+
+    # Every entry for method on host and path whatever the values of key_headers, a write to the path makes all of them out of date
+    def invalidate_path(self, host: str, path: str, method: str = "GET"):
+        with self._lock:
+            for key in list(self._variants.get((host, method, path), ())):
+                self._evict(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._variants.clear()
+
+            self.size = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidated": self.revalidated,
+            "evictions": self.evictions,
+        }
\ No newline at end of file
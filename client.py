@@ -1,54 +1,459 @@
-import typing, socket, oqs, AES_cipher
-import util
+import typing, socket, select, struct, threading, time, os, oqs, AES_cipher
+import util, handshake, tickets, keypool, mux, header_table
 
 class Client:
-    def __init__(self, kem_alg: str = "ML-KEM-512") -> None:
+    def __init__(self, kem_alg: str = "ML-KEM-512", keep_alive: bool = False, tickets: dict[tuple[str, int], tuple[bytes, bytes, float]] | None = None, pinned_keys: dict[tuple[str, int], bytes] | None = None, keypairs: keypool.KeypairPool | None = None, suites: list[str] | None = None, max_frame_size: int | None = util.MAX_FRAME_SIZE, max_streams: int | None = None, stream_window: int = mux.DEFAULT_WINDOW, header_table_size: int | None = header_table.DEFAULT_TABLE_SIZE, connect_timeout: float | None = None, response_timeout: float | None = None) -> None:
+        if keypairs is not None and keypairs.kem_alg != kem_alg:
+            raise ValueError(f"keypair pool is for {keypairs.kem_alg}, not {kem_alg}")
+
         self.kem_alg = kem_alg
+        self.keep_alive = keep_alive
+
+        # Resumption tickets per server address, pass the same dict to several clients to share them
+        self.tickets = tickets if tickets is not None else {}
+
+        # Static server public keys per address, servers listed here get the handshake in the same flight as the first request
+        self.pinned_keys = pinned_keys if pinned_keys is not None else {}
+
+        # Optional stock of pre-generated keypairs, takes keygen off the connect path
+        self.keypairs = keypairs
+
+        # Cipher suites offered to the server in order of preference
+        self.suites = suites or AES_cipher.DEFAULT_SUITES
+
+        self.max_frame_size = max_frame_size
+
+        # With max_streams set the client asks for a multiplexed tunnel, concurrent requests from several threads then share it
+        self.max_streams = max_streams
+        self.stream_window = stream_window
+
+        # Heads go out in the binary header format when the server agrees, repeated headers then shrink to a byte or two
+        self.header_table_size = header_table_size
+
+        # Seconds to wait for the connection and handshake, and for each read of a response, None blocks for as long as it takes
+        self.connect_timeout = connect_timeout
+        self.response_timeout = response_timeout
+
+        self._encoder = None
+        self._decoder = None
+
+        self._mux = None
+        self._connect_lock = threading.Lock()
+
+        self._early = False
+
+        self._cl_socket = None
+        self._requests = 0
+
+        self.last_used = 0.0
     
     def _init_socket_connection(self, remote_address: tuple[str, int]):
         self.remote_address = remote_address
 
         self._cl_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._cl_socket.settimeout(self.connect_timeout)
         self._cl_socket.connect(remote_address)
+
+        # The server's handshake reply is read under the hello limit, the session limit applies once it is keyed
+        self._framer = util.Framer(self._cl_socket, handshake.MAX_HELLO_SIZE)
     
-    def _init_kem_tunnel(self):
-        with oqs.KeyEncapsulation(self.kem_alg) as client:
+    def _recv_reply(self) -> tuple[int, list[bytes]]:
+        try:
+            msg_type, fields = handshake.unpack(self._framer.recv_msg())
+
+        except ConnectionResetError:
+            msg_type, fields = handshake.REFUSED, []
+
+        # An overloaded server sheds connections before the handshake
+        if msg_type == handshake.REFUSED:
+            self.close()
+
+            raise ConnectionRefusedError("server refused the connection")
+
+        return msg_type, fields
+
+    def _store_ticket(self, field: bytes):
+        if (entry := handshake.open_ticket_field(self._sh_secret, field)) is not None:
+            self.tickets[self.remote_address] = entry
+
+    def _set_suite(self, field: bytes):
+        if (suite := field.decode()) not in self.suites:
+            raise Exception(f"server chose cipher suite {suite!r} which was not offered")
+
+        self._suite = suite
+
+    def _hello_tail(self) -> list[bytes]:
+        extensions = {}
+
+        if self.max_streams:
+            extensions.update(mux = self.max_streams, window = self.stream_window)
+
+        if self.header_table_size is not None:
+            extensions["headers"] = self.header_table_size
+
+        if not extensions:
+            return [handshake.encode_suites(self.suites)]
+
+        return [handshake.encode_suites(self.suites), handshake.encode_extensions(extensions)]
+
+    def _set_extensions(self, fields: list[bytes]):
+        self._extensions = handshake.decode_extensions(fields[0]) if fields else {}
+
+    def _resume_kem_tunnel(self) -> bool:
+        if (entry := self.tickets.pop(self.remote_address, None)) is None:
+            return False
+
+        ticket, resumption_secret, expires = entry
+
+        if expires < time.time():
+            return False
+
+        cl_nonce = os.urandom(32)
+
+        # Send ticket to server
+        self._framer.send_msg(handshake.pack(handshake.HELLO_RESUME, ticket, cl_nonce, *self._hello_tail()))
+
+        msg_type, fields = self._recv_reply()
+
+        if msg_type != handshake.RESUMED:
+            return False
+
+        # Derive fresh keys from the ticket secret and both nonces
+        self._sh_secret = tickets.derive_key(resumption_secret, b"qstp resumed", cl_nonce, fields[0])
+
+        self._store_ticket(fields[1])
+        self._set_suite(fields[2])
+        self._set_extensions(fields[3:])
+
+        return True
+
+    # Without resume a held ticket is not tried, the server reads at most two hellos on a connection
+    def _init_kem_tunnel(self, resume: bool = True):
+        if resume and self._resume_kem_tunnel():
+            return
+
+        if self.keypairs is not None:
+            client, public_key_client = self.keypairs.take()
+
+        else:
+            client = oqs.KeyEncapsulation(self.kem_alg)
+
             # Generate key pair
             public_key_client = client.generate_keypair()
 
+        with client:
             # Send public key to server
-            self._cl_socket.sendall(public_key_client)
+            self._framer.send_msg(handshake.pack(handshake.HELLO_KEM, public_key_client, *self._hello_tail()))
 
             # Recv cipher text from server
-            cipher_text = self._cl_socket.recv(768)
+            msg_type, fields = self._recv_reply()
+
+            if msg_type != handshake.ACCEPT:
+                raise Exception(f"unexpected handshake reply {msg_type}")
+
+            cipher_text, ticket_field, suite_field, *extensions = fields
 
             # Decapsulate cipher text to get key
             self._sh_secret = client.decap_secret(cipher_text)
+
+        self._store_ticket(ticket_field)
+        self._set_suite(suite_field)
+        self._set_extensions(extensions)
     
+    def _finish_kem_tunnel(self, resume: bool = True):
+        self._init_kem_tunnel(resume)
+
+        self._cipher = handshake.session_cipher(self._suite, self._sh_secret, False)
+
+        self._encoder, self._decoder = header_table.codec(self._extensions)
+
+        self._framer.max_frame_size = self.max_frame_size
+
+        if "mux" in self._extensions:
+            self._start_mux()
+
+    def _start_mux(self):
+        framer, cipher = self._framer, self._cipher
+
+        def send_record(record: bytes):
+            framer.send_msg(cipher.encrypt(record))
+
+        self._mux = session = mux.Mux(send_record, True, self._extensions["mux"], self._extensions.get("window", mux.DEFAULT_WINDOW), self.response_timeout, self._encoder, self._decoder)
+
+        # The reader waits on an idle tunnel indefinitely, the response deadline applies to each stream instead
+        framer.sock.settimeout(None)
+
+        # One reader per tunnel hands records to the streams waiting for them, it holds its own references so a reconnect does not disturb it
+        def read():
+            try:
+                while (record := framer.recv_msg()) is not None:
+                    session.feed(cipher.decrypt(record))
+
+            except (OSError, ValueError):
+                pass
+
+            finally:
+                session.close()
+
+                framer.sock.close()
+
+        threading.Thread(target = read, name = f"mux-reader-{self.remote_address[0]}:{self.remote_address[1]}", daemon = True).start()
+
     def connect(self, remote_address: tuple[str, int]) -> typing.Self:
-        self._init_socket_connection(remote_address)
-        self._init_kem_tunnel()
+        self._mux = None
+        self._extensions = {}
+        self._encoder = self._decoder = None
+
+        try:
+            self._init_socket_connection(remote_address)
+
+            # With a pinned server key the handshake is deferred and sent together with the first request, multiplexed tunnels always shake hands first
+            self._early = remote_address in self.pinned_keys and not self.max_streams
+
+            if not self._early:
+                self._finish_kem_tunnel()
+
+        except TimeoutError as e:
+            self.close()
+
+            # Nothing of a request was sent yet, so callers can go elsewhere just as for a refused connection
+            raise ConnectionRefusedError(f"connecting to {remote_address[0]}:{remote_address[1]} timed out") from e
+
+        self._requests = 0
+
+        self.last_used = time.monotonic()
 
         return self
 
-    def do_request(self, data: bytes) -> bytes:
+    @property
+    def connected(self) -> bool:
+        return self._cl_socket is not None
+
+    @property
+    def multiplexed(self) -> bool:
+        return self._mux is not None
+
+    def close(self):
+        if self._mux is not None:
+            self._mux.close()
+
+        if self._cl_socket is not None:
+            # Wakes up a mux reader blocked on the socket
+            try:
+                self._cl_socket.shutdown(socket.SHUT_RDWR)
+
+            except OSError:
+                pass
+
+            self._cl_socket.close()
+
+            self._cl_socket = None
+
+    def _send(self, data: bytes):
         # Encrypt using shared secret and send data
-        AES = AES_cipher.AES(self._sh_secret)
+        self._framer.send_msg(self._cipher.encrypt(data))
+
+    def recv(self) -> bytes | None:
+        recv_data = self._framer.recv_msg()
+
+        if recv_data is None:
+            return None
+
+        return self._cipher.decrypt(recv_data)
+
+    # The first message of a request or response is its head, only heads go through the header table
+    def _send_head(self, data: bytes):
+        self._send(self._encoder.encode(data) if self._encoder else data)
+
+    def _recv_head(self) -> bytes | None:
+        if (recv_data := self.recv()) is None or self._decoder is None:
+            return recv_data
+
+        return self._decoder.decode(recv_data)
+
+    def _early_send(self, data: bytes):
+        with oqs.KeyEncapsulation(self.kem_alg) as client:
+            # Encapsulate a secret to the server's pinned static public key
+            cipher_text, secret = client.encap_secret(self.pinned_keys[self.remote_address])
+
+        if self.keypairs is not None:
+            ephemeral, public_key_client = self.keypairs.take()
+
+        else:
+            ephemeral = oqs.KeyEncapsulation(self.kem_alg)
+
+            public_key_client = ephemeral.generate_keypair()
+
+        cl_nonce = os.urandom(32)
+
+        self._sh_secret = tickets.derive_key(secret, b"qstp early", cl_nonce)
+
+        # Early data has to be encrypted before the server can answer, so it uses our most preferred suite
+        self._suite = self.suites[0]
+        self._cipher = handshake.session_cipher(self._suite, self._sh_secret, False)
+
+        with ephemeral:
+            # Send cipher text, the encrypted request and a fresh public key for the server to rekey the session with in one flight
+            self._framer.send_msg(handshake.pack(handshake.HELLO_EARLY, cipher_text, cl_nonce, struct.pack(">d", time.time()), self._cipher.encrypt(data), handshake.encode_suites(self.suites), public_key_client))
+
+            msg_type, fields = self._recv_reply()
+
+            if msg_type == handshake.EARLY_ACCEPTED:
+                ticket_field, suite_field, eph_cipher_text = fields
+
+                # The response and everything after it is keyed with the ephemeral secret too, not with the static key alone
+                self._sh_secret = tickets.derive_key(self._sh_secret, b"qstp early rekey", ephemeral.decap_secret(eph_cipher_text))
+
+        if msg_type != handshake.EARLY_ACCEPTED:
+            # Server refused the early data (no static key, stale or replayed), fall back to a full handshake. A ticket is not
+            # tried first, if it were rejected as well the server would not read the third hello
+            self._finish_kem_tunnel(resume = False)
+
+            self._send_head(data)
+
+        else:
+            self._store_ticket(ticket_field)
+            self._set_suite(suite_field)
+
+            self._cipher = handshake.session_cipher(self._suite, self._sh_secret, False)
+
+            self._framer.max_frame_size = self.max_frame_size
+
+    def _exchange(self, data: bytes | typing.Iterable[bytes], replay_safe: bool) -> bytes | None:
+        # A streamed request is a head message followed by its chunks, only the head can ride in early data
+        msgs = iter([data] if isinstance(data, (bytes, bytearray)) else data)
+
+        first = next(msgs)
 
-        enc_data = AES.encrypt(data)
+        # Also bounds each read of a chunked body, the caller closes the tunnel on TimeoutError
+        self._cl_socket.settimeout(self.response_timeout)
 
-        util.send_msg(self._cl_socket, enc_data)
+        if self._early:
+            self._early = False
 
-        recv_data = util.recv_msg(self._cl_socket)
+            # Early data can be replayed by an attacker, only send requests that are safe to repeat that way
+            if replay_safe and len(first) <= handshake.MAX_EARLY_DATA:
+                self._early_send(first)
 
-        self._cl_socket.close()
+            else:
+                self._finish_kem_tunnel()
+
+                self._send_head(first)
+
+        else:
+            self._send_head(first)
+
+        for msg in msgs:
+            self._send(msg)
+
+        return self._recv_head()
+
+    def _stale(self) -> bool:
+        # An idle tunnel should have nothing to read, readable means the server has closed it
+        readable, _, _ = select.select([self._cl_socket], [], [], 0)
+
+        return bool(readable)
+
+    # Returns the first message of the response, a streamed response continues with recv() until finish()
+    def open_request(self, data: bytes | typing.Iterable[bytes], replay_safe: bool = True) -> bytes:
+        # A streamed body cannot be sent twice and a request that is not replay safe may have run before the tunnel failed,
+        # so neither is retried and both reconnect up front instead
+        retry = replay_safe and isinstance(data, (bytes, bytearray))
+
+        if self._requests and not retry and self._stale():
+            self.connect(self.remote_address)
+
+        try:
+            recv_data = self._exchange(data, replay_safe)
+
+        except (ConnectionResetError, BrokenPipeError):
+            if not self._requests or not retry:
+                raise
+
+            recv_data = None
+
+        if recv_data is None and self._requests and retry:
+            # The server ended a reused session (idle timeout or request limit), retry once on a fresh tunnel
+            self.connect(self.remote_address)
+
+            recv_data = self._exchange(data, replay_safe)
 
         if recv_data is None:
+            self.close()
+
             raise Exception("message length was not defined")
 
-        dec_data = AES.decrypt(recv_data)
+        return recv_data
+
+    def finish(self):
+        self._requests += 1
+        self.last_used = time.monotonic()
+
+        if not self.keep_alive:
+            self.close()
+
+    def open_stream(self) -> mux.Stream:
+        while True:
+            with self._connect_lock:
+                # A tunnel the server is draining takes no new streams, the next one goes over a fresh tunnel
+                if self._mux is None or self._mux.closed or self._mux.goaway is not None:
+                    self.connect(self.remote_address)
+
+                if (session := self._mux) is None:
+                    raise Exception("server did not agree to multiplexing")
+
+            try:
+                # Waits for a free slot outside the lock, the tunnel may start going away meanwhile
+                stream = session.open_stream()
+
+            except ConnectionResetError:
+                continue
+
+            self._requests += 1
+            self.last_used = time.monotonic()
+
+            return stream
+
+    # Multiplexed counterpart of open_request, the returned stream is read with recv() and released with finish()
+    def request_stream(self, data: bytes | typing.Iterable[bytes], replay_safe: bool = True) -> tuple[mux.Stream, bytes]:
+        while True:
+            stream = self.open_stream()
+
+            try:
+                return stream, stream.open_request(data, replay_safe)
+
+            except mux.StreamRefused:
+                stream.finish()
+
+                # A refused stream was never processed and its tunnel is going away, so even a request that is not safe to replay
+                # is sent again on the next one, only a streamed body cannot be sent twice
+                if not isinstance(data, (bytes, bytearray)):
+                    raise
+
+            except BaseException:
+                stream.finish()
+
+                raise
+
+    def do_request(self, data: bytes | typing.Iterable[bytes], replay_safe: bool = True) -> bytes:
+        if self.max_streams:
+            with self._connect_lock:
+                # Only a multiplexed tunnel that is going away is replaced here, a server that did not agree to multiplexing keeps its plain tunnel
+                if not self.connected or (self._mux is not None and (self._mux.closed or self._mux.goaway is not None)):
+                    self.connect(self.remote_address)
+
+            if self.multiplexed:
+                stream, recv_data = self.request_stream(data, replay_safe)
+
+                stream.finish()
+
+                return recv_data
+
+        try:
+            return self.open_request(data, replay_safe)
 
-        return dec_data
+        finally:
+            self.finish()
 
 if __name__ == "__main__":
     class Requester:
@@ -0,0 +1,77 @@
+import threading, typing
+import QSTP, cache
+
+class _Flight:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+
+        self.frame = None
+        self.error = None
+
+class SingleFlight:
+    def __init__(self, key_headers: typing.Iterable[str] = ("authorization", "if-none-match", "accept-encoding")) -> None:
+        # Requests only share a flight when these headers match too, a conditional request may get a 207 and a compressed body the others must not see
+        self.key_headers = tuple(key_headers)
+
+        self.flights = 0
+        self.coalesced = 0
+
+        self._flights: dict[tuple, _Flight] = {}
+        self._lock = threading.Lock()
+
+    def key(self, host: str, rq: QSTP.Request) -> tuple:
+        return cache.request_key(host, rq, self.key_headers)
+
+    # Runs fetch for the first caller of a key, callers that arrive while it is in flight get a copy of its response
+    def do(self, key: tuple, fetch: typing.Callable[[], QSTP.Response]) -> QSTP.Response:
+        with self._lock:
+            if (flight := self._flights.get(key)) is None:
+                flight = self._flights[key] = _Flight()
+
+                self.flights += 1
+
+                leader = True
+
+            else:
+                leader = False
+
+        if not leader:
+            flight.done.wait()
+
+            if flight.error is not None:
+                raise flight.error
+
+            # A streamed response cannot be read twice, every waiter fetches its own
+            if flight.frame is None:
+                return fetch()
+
+            with self._lock:
+                self.coalesced += 1
+
+            return QSTP.Response.from_frame(flight.frame)
+
+        try:
+            resp = fetch()
+
+            if not (resp.streamed or resp.chunked):
+                flight.frame = resp.to_frame()
+
+            return resp
+
+        except Exception as e:
+            flight.error = e
+
+            raise
+
+        finally:
+            with self._lock:
+                del self._flights[key]
+
+            flight.done.set()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "in_flight": len(self._flights),
+            "flights": self.flights,
+            "coalesced": self.coalesced,
+        }
\ No newline at end of file
@@ -0,0 +1,118 @@
+import bz2, lzma, zlib, typing
+import QSTP, util
+
+# (compress, decompressor) per name used in accept-encoding and content-encoding, in order of preference
+CODECS = {
+    "zlib": (zlib.compress, zlib.decompressobj),
+    "lzma": (lzma.compress, lzma.LZMADecompressor),
+    "bz2": (bz2.compress, bz2.BZ2Decompressor),
+}
+
+# Bodies smaller than this are sent as they are, compressing them saves less than the codec header costs
+DEFAULT_MIN_SIZE = 1024
+
+# Content types that are compressed already, another pass only costs CPU
+COMPRESSED_TYPES = (
+    "image/",
+    "video/",
+    "audio/",
+    "font/woff",
+    "application/zip",
+    "application/gzip",
+    "application/x-gzip",
+    "application/x-bzip2",
+    "application/x-xz",
+    "application/x-7z-compressed",
+    "application/zstd",
+)
+
+def parse_accept(value: str | None) -> list[str]:
+    """Helper function to parse an accept-encoding header into the encodings it names, in order"""
+
+    return [name for part in (value or "").split(",") if (name := part.strip().lower())]
+
+def choose(accept: str | None, encodings: typing.Iterable[str]) -> str | None:
+    """Helper function to pick the first encoding of an accept-encoding header that is also in `encodings`, `None` if there is none"""
+
+    for name in parse_accept(accept):
+        if name in encodings and name in CODECS:
+            return name
+
+    return None
+
+def compressed_type(content_type: str | None) -> bool:
+    """Helper function to tell whether a content type is compressed already"""
+
+    return content_type is not None and content_type.strip().lower().startswith(COMPRESSED_TYPES)
+
+def decompress(encoding: str, data: bytes, max_size: int | None = util.MAX_FRAME_SIZE) -> bytes:
+    """Helper function to decompress one body or chunk, raises `ValueError` if it does not decompress or would grow past `max_size`"""
+
+    decompressor = CODECS[encoding][1]()
+
+    try:
+        # Reading one byte past the limit tells an oversized body apart from one that is exactly at it
+        out = decompressor.decompress(data) if max_size is None else decompressor.decompress(data, max_size + 1)
+
+    except (zlib.error, lzma.LZMAError, OSError) as e:
+        raise ValueError(f"body does not decompress with {encoding}") from e
+
+    if max_size is not None and len(out) > max_size:
+        raise ValueError(f"decompressed body is over the {max_size} byte limit")
+
+    if not decompressor.eof:
+        raise ValueError(f"{encoding} body ended early")
+
+    return out
+
+def encode(msg: QSTP.Message, encoding: str, min_size: int = DEFAULT_MIN_SIZE) -> bool:
+    """Helper function to compress the body of a message in place, streamed bodies chunk by chunk, returns whether it did"""
+
+    if msg.get_header("content-encoding") is not None or compressed_type(msg.get_header("content-type")):
+        return False
+
+    compress = CODECS[encoding][0]
+
+    if msg.streamed:
+        if (length := msg.get_header("content-length")) is not None and length.isdigit() and int(length) < min_size:
+            return False
+
+        # Every chunk is compressed on its own, so the receiver can pass each on as soon as it arrives
+        stream = msg.stream
+
+        msg.data = (compress(chunk) for chunk in stream)
+
+        if msg.get_header("content-length") is not None:
+            msg.headers.pop("content-length")
+
+    else:
+        if (data := msg.data) is None or len(data) < min_size or len(packed := compress(data)) >= len(data):
+            return False
+
+        msg.data = packed
+
+        if msg.get_header("content-length") is not None:
+            msg.set_header("content-length", str(len(packed)))
+
+    msg.set_header("content-encoding", encoding)
+
+    return True
+
+def decode(msg: QSTP.Message, max_size: int | None = util.MAX_FRAME_SIZE) -> bool:
+    """Helper function to decompress the body of a message in place, returns whether it was compressed, raises `ValueError` for an encoding it does not know"""
+
+    if (encoding := msg.get_header("content-encoding")) is None:
+        return False
+
+    if encoding not in CODECS:
+        raise ValueError(f"unknown content encoding {encoding!r}")
+
+    if msg.streamed:
+        msg.data = msg.stream.map(lambda chunk: decompress(encoding, chunk, max_size))
+
+    elif msg.data is not None:
+        msg.data = decompress(encoding, msg.data, max_size)
+
+    msg.headers.pop("content-encoding")
+
+    return True
\ No newline at end of file
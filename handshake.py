@@ -0,0 +1,285 @@
+import os, struct, time, threading, typing, collections, concurrent.futures, oqs
+import AES_cipher, tickets, QSTP
+
+# Client hello types
+HELLO_KEM = 0
+HELLO_RESUME = 1
+HELLO_EARLY = 2
+
+# Server reply types
+ACCEPT = 0
+RESUMED = 1
+REJECTED = 2
+EARLY_ACCEPTED = 3
+REFUSED = 4
+
+# Hellos and replies are read under this limit until the session is keyed, an unauthenticated peer cannot make either side
+# buffer more than this
+MAX_HELLO_SIZE = 8192
+
+# Requests over this many bytes do not ride in 0-RTT early data, their hello would not fit under MAX_HELLO_SIZE
+MAX_EARLY_DATA = 4096
+
+def pack(msg_type: int, *fields: bytes) -> bytes:
+    """Helper function to build a handshake message out of a type byte and length prefixed fields"""
+
+    return bytes([msg_type]) + b"".join(struct.pack(">I", len(field)) + field for field in fields)
+
+def unpack(msg: bytes | None) -> tuple[int, list[bytes]]:
+    """Helper function to split a handshake message into its type and fields, raises `ValueError` if it is malformed"""
+
+    if not msg:
+        raise ValueError("empty handshake message")
+
+    # Fields are copied out of the received frame so they can be kept and used as dict keys
+    view = memoryview(msg)
+
+    fields = []
+    i = 1
+
+    while i < len(msg):
+        if i + 4 > len(msg):
+            raise ValueError("truncated handshake field length")
+
+        field_len = struct.unpack_from(">I", view, i)[0]
+
+        i += 4
+
+        if i + field_len > len(msg):
+            raise ValueError("truncated handshake field")
+
+        fields.append(bytes(view[i:i + field_len]))
+
+        i += field_len
+
+    return msg[0], fields
+
+def encapsulate(kem_alg: str, public_key: bytes) -> tuple[bytes, bytes]:
+    """Helper function to encapsulate a fresh secret to `public_key`, returns (cipher text, shared secret)"""
+
+    with oqs.KeyEncapsulation(kem_alg) as server:
+        return server.encap_secret(public_key)
+
+def decapsulate(kem_alg: str, secret_key: bytes, cipher_text: bytes) -> bytes:
+    """Helper function to decapsulate `cipher_text` with a stored secret key, returns the shared secret"""
+
+    with oqs.KeyEncapsulation(kem_alg, secret_key) as server:
+        return server.decap_secret(cipher_text)
+
+def _run(executor: concurrent.futures.Executor | None, func: typing.Callable, *args):
+    if executor is None:
+        return func(*args)
+
+    return executor.submit(func, *args).result()
+
+def generate_static_key(kem_alg: str = "ML-KEM-512") -> tuple[bytes, bytes]:
+    """Helper function to create a long-term server keypair (public key, secret key) for 0-RTT, publish the public key to clients"""
+
+    with oqs.KeyEncapsulation(kem_alg) as server:
+        public_key = server.generate_keypair()
+
+        return public_key, server.export_secret_key()
+
+class ReplayCache:
+    def __init__(self, window: float = 10.0) -> None:
+        self.window = window
+
+        self._seen: dict[bytes, float] = {}
+        self._lock = threading.Lock()
+
+        # (expiry, token) in insertion order, every token lives equally long so the oldest is always the first to expire
+        self._expiries: collections.deque[tuple[float, bytes]] = collections.deque()
+
+    def check(self, token: bytes, timestamp: float) -> bool:
+        # Early data outside the window cannot be checked against the cache so it is always refused
+        if abs(time.time() - timestamp) > self.window:
+            return False
+
+        now = time.monotonic()
+
+        with self._lock:
+            while self._expiries and self._expiries[0][0] <= now:
+                expiry, old = self._expiries.popleft()
+
+                # A token seen again after it expired has a later expiry further back in the queue
+                if self._seen.get(old) == expiry:
+                    del self._seen[old]
+
+            if token in self._seen:
+                return False
+
+            self._seen[token] = expiry = now + 2 * self.window
+
+            self._expiries.append((expiry, token))
+
+        return True
+
+def replay_safe(request: bytes) -> bool:
+    """Helper function to tell from the info line of a request frame whether its method is safe to run more than once"""
+
+    info = bytes(request[:32]).split(b"\n", 1)[0].split(b" ", 2)
+
+    return len(info) >= 2 and info[0] == QSTP.VERSION.encode() and info[1].decode(errors = "replace") in QSTP.IDEMPOTENT_METHODS
+
+def session_cipher(suite: str, secret: bytes, server: bool) -> AES_cipher.AES | AES_cipher.AEAD:
+    """Helper function to build the record cipher for one side of a session from the negotiated suite and shared secret"""
+
+    cls = AES_cipher.SUITES[suite]
+
+    # Legacy suite uses the shared secret directly as the AES key
+    if cls is AES_cipher.AES:
+        return AES_cipher.AES(secret)
+
+    c2s = (tickets.derive_key(secret, b"qstp c2s key"), tickets.derive_key(secret, b"qstp c2s iv")[:12])
+    s2c = (tickets.derive_key(secret, b"qstp s2c key"), tickets.derive_key(secret, b"qstp s2c iv")[:12])
+
+    return cls(*s2c, *c2s) if server else cls(*c2s, *s2c)
+
+def encode_suites(suites: list[str]) -> bytes:
+    return ",".join(suites).encode()
+
+def choose_suite(offered: bytes | None, supported: list[str]) -> str | None:
+    """Helper function to pick the server's most preferred suite out of the ones the client offered, hellos without an offer only speak the legacy suite"""
+
+    offered_suites = offered.decode().split(",") if offered is not None else ["AES-256-CBC"]
+
+    for suite in supported:
+        if suite in offered_suites:
+            return suite
+
+    return None
+
+def encode_extensions(extensions: dict[str, int]) -> bytes:
+    """Helper function to build an extensions field, `name=value` pairs separated by commas"""
+
+    return ",".join(f"{k}={v}" for k, v in extensions.items()).encode()
+
+def decode_extensions(field: bytes | None) -> dict[str, int]:
+    """Helper function to parse an extensions field, unknown or malformed entries are skipped"""
+
+    extensions = {}
+
+    for entry in field.decode().split(",") if field else []:
+        k, _, v = entry.partition("=")
+
+        if v.isdigit():
+            extensions[k] = int(v)
+
+    return extensions
+
+def negotiate_extensions(offered: bytes, supported: dict[str, int] | None) -> dict[str, int]:
+    """Helper function to agree on the extensions both sides support, each setting takes the smaller of the two values"""
+
+    supported = supported or {}
+
+    return {k: min(v, supported[k]) for k, v in decode_extensions(offered).items() if k in supported}
+
+def _ticket_field(session_key: bytes, ticket_keys: tickets.TicketKeys | None, expires: float | None = None) -> bytes:
+    if ticket_keys is None:
+        return b""
+
+    ticket, expires = ticket_keys.issue(tickets.derive_key(session_key, b"qstp resumption"), expires)
+
+    # Ticket is opaque to the client but still sent encrypted so sessions cannot be linked on the wire
+    return AES_cipher.AES(session_key).encrypt(struct.pack(">d", expires) + ticket)
+
+def accept(hello: bytes | None, kem_alg: str, ticket_keys: tickets.TicketKeys | None = None, static_key: tuple[bytes, bytes] | None = None, replay_cache: ReplayCache | None = None, executor: concurrent.futures.Executor | None = None, suites: list[str] = AES_cipher.DEFAULT_SUITES, extensions: dict[str, int] | None = None) -> tuple[bytes, AES_cipher.AES | AES_cipher.AEAD | None, bytes | None, dict[str, int]]:
+    """Build the server reply to a client hello, returns the reply, the session cipher or `None` if the client has to fall back to a full handshake, any 0-RTT early data and the negotiated extensions. KEM operations run on `executor` if one is given"""
+
+    msg_type, fields = unpack(hello)
+
+    # Clients that offer extensions send them after their suites and get the agreed ones after ours
+    def reply(msg_type: int, *reply_fields: bytes, offered: list[bytes]) -> tuple[bytes, dict[str, int]]:
+        if len(offered) < 2:
+            return pack(msg_type, *reply_fields), {}
+
+        agreed = negotiate_extensions(offered[1], extensions)
+
+        return pack(msg_type, *reply_fields, encode_extensions(agreed)), agreed
+
+    if msg_type == HELLO_RESUME and len(fields) in (2, 3, 4):
+        ticket, cl_nonce, *offered = fields
+
+        if ticket_keys is None or (opened := ticket_keys.open(ticket)) is None:
+            return pack(REJECTED), None, None, {}
+
+        if (suite := choose_suite(offered[0] if offered else None, suites)) is None:
+            raise ValueError("no cipher suite in common with the client")
+
+        resumption_secret, expires = opened
+
+        sv_nonce = os.urandom(32)
+
+        # Fresh keys from the ticket secret and both nonces, no KEM operation needed
+        session_key = tickets.derive_key(resumption_secret, b"qstp resumed", cl_nonce, sv_nonce)
+
+        reply_msg, agreed = reply(RESUMED, sv_nonce, _ticket_field(session_key, ticket_keys, expires), suite.encode(), offered = offered)
+
+        return reply_msg, session_cipher(suite, session_key, True), None, agreed
+
+    if msg_type == HELLO_EARLY and len(fields) == 6:
+        cipher_text, cl_nonce, timestamp, early_data, offered, public_key = fields
+
+        if static_key is None or replay_cache is None or len(timestamp) != 8:
+            return pack(REJECTED), None, None, {}
+
+        # Early data is already encrypted with the client's first suite, the server can only take it or refuse it
+        suite = offered.decode().split(",")[0]
+
+        if suite not in suites:
+            return pack(REJECTED), None, None, {}
+
+        # The cipher text is fresh randomness for every encapsulation, seeing it twice means the flight was replayed
+        if not replay_cache.check(cipher_text, struct.unpack(">d", timestamp)[0]):
+            return pack(REJECTED), None, None, {}
+
+        # Server decapsulates the secret the client encapsulated to the static public key
+        secret = _run(executor, decapsulate, kem_alg, static_key[1], cipher_text)
+
+        session_key = tickets.derive_key(secret, b"qstp early", cl_nonce)
+
+        cipher = session_cipher(suite, session_key, True)
+
+        try:
+            early_data = cipher.decrypt(early_data)
+
+        except ValueError:
+            return pack(REJECTED), None, None, {}
+
+        # A replayed flight runs its request again, whatever a client sends only idempotent requests are run from early data
+        if not replay_safe(early_data):
+            return pack(REJECTED), None, None, {}
+
+        # Only the early request depends on the long-lived static key, the response and the rest of the session are keyed
+        # with a secret encapsulated to the client's ephemeral key as well, so they keep forward secrecy
+        eph_cipher_text, eph_secret = _run(executor, encapsulate, kem_alg, public_key)
+
+        session_key = tickets.derive_key(session_key, b"qstp early rekey", eph_secret)
+
+        # Early data is a plain request, so sessions that start with it are never multiplexed
+        return pack(EARLY_ACCEPTED, _ticket_field(session_key, ticket_keys), suite.encode(), eph_cipher_text), session_cipher(suite, session_key, True), early_data, {}
+
+    if msg_type == HELLO_KEM and len(fields) in (1, 2, 3):
+        public_key, *offered = fields
+
+        if (suite := choose_suite(offered[0] if offered else None, suites)) is None:
+            raise ValueError("no cipher suite in common with the client")
+
+        # Server generates and encapsulates secret using client's public key
+        cipher_text, sh_secret = _run(executor, encapsulate, kem_alg, public_key)
+
+        reply_msg, agreed = reply(ACCEPT, cipher_text, _ticket_field(sh_secret, ticket_keys), suite.encode(), offered = offered)
+
+        return reply_msg, session_cipher(suite, sh_secret, True), None, agreed
+
+    raise ValueError(f"unknown handshake message type {msg_type}")
+
+def open_ticket_field(session_key: bytes, field: bytes) -> tuple[bytes, bytes, float] | None:
+    """Helper function for clients to turn the ticket field of a server reply into a cache entry of (ticket, resumption secret, expiry)"""
+
+    if not field:
+        return None
+
+    plaintext = AES_cipher.AES(session_key).decrypt(field)
+
+    return plaintext[8:], tickets.derive_key(session_key, b"qstp resumption"), struct.unpack(">d", plaintext[:8])[0]
\ No newline at end of file
@@ -0,0 +1,294 @@
+import collections
+import QSTP
+
+# Entries every session starts with, a head that only uses these costs one byte per line
+STATIC_TABLE = [
+    (b":info", b"QSTP/1 200 OK"),
+    (b":info", b"QSTP/1 201 MALFORMED"),
+    (b":info", b"QSTP/1 204 UNKNOWN PATH"),
+    (b":info", b"QSTP/1 101 SERVER ERROR"),
+    (b":info", b"QSTP/1 GET /"),
+    (b":info", b"QSTP/1 POST /"),
+    (b"Host", b""),
+    (b"host", b""),
+    (b"authorization", b""),
+    (b"Authorization", b""),
+    (b"Proxied-For", b""),
+    (b"content-type", b"text/plain"),
+    (b"content-type", b"text/html"),
+    (b"content-type", b"application/json"),
+    (b"content-type", b"application/octet-stream"),
+    (b"Content-Type", b"text/plain"),
+    (b"Content-Type", b"application/json"),
+    (b"content-length", b""),
+    (b"transfer-encoding", b"chunked"),
+    (b"content-encoding", b""),
+    (b"cache-control", b"no-cache"),
+    (b"cache-control", b""),
+    (b"etag", b""),
+    (b"if-none-match", b""),
+    (b"request-method", b"GET"),
+    (b"request-method", b"POST"),
+    (b"request-path", b""),
+    (b"origin-method", b""),
+]
+
+DEFAULT_TABLE_SIZE = 4096
+
+# Counted against the table size for every entry on top of its name and value, as in HPACK
+ENTRY_OVERHEAD = 32
+
+# Decoded heads larger than this end the session, a few bytes of indexed lines could otherwise expand to megabytes
+MAX_HEAD_SIZE = 1 << 20
+
+# Line representations, the low bits of the first byte start the index
+INDEXED = 0x80
+LITERAL_INDEXED = 0x40
+LITERAL = 0x00
+
+_static_entries = {entry: i + 1 for i, entry in reversed(list(enumerate(STATIC_TABLE)))}
+_static_names = {name: i + 1 for i, (name, _) in reversed(list(enumerate(STATIC_TABLE)))}
+
+def encode_int(value: int, prefix_bits: int, flags: int = 0) -> bytes:
+    """Helper function to encode an HPACK style integer into the low `prefix_bits` of a first byte carrying `flags`"""
+
+    limit = (1 << prefix_bits) - 1
+
+    if value < limit:
+        return bytes([flags | value])
+
+    out = bytearray([flags | limit])
+
+    value -= limit
+
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+
+        value >>= 7
+
+    out.append(value)
+
+    return bytes(out)
+
+def decode_int(data: bytes | memoryview, pos: int, prefix_bits: int) -> tuple[int, int]:
+    """Helper function to decode an integer written by `encode_int`, returns (value, position after it), raises `ValueError` if the data ends early"""
+
+    limit = (1 << prefix_bits) - 1
+
+    if pos >= len(data):
+        raise ValueError("head ended inside an integer")
+
+    value = data[pos] & limit
+    pos += 1
+
+    if value < limit:
+        return value, pos
+
+    shift = 0
+
+    while True:
+        if pos >= len(data) or shift > 28:
+            raise ValueError("head ended inside an integer")
+
+        byte = data[pos]
+        pos += 1
+
+        value += (byte & 0x7f) << shift
+        shift += 7
+
+        if not byte & 0x80:
+            return value, pos
+
+def encode_str(value: bytes) -> bytes:
+    """Helper function to encode a length prefixed string"""
+
+    return encode_int(len(value), 7) + value
+
+def decode_str(data: bytes | memoryview, pos: int) -> tuple[bytes, int]:
+    """Helper function to decode a string written by `encode_str`, returns (string, position after it)"""
+
+    length, pos = decode_int(data, pos, 7)
+
+    if pos + length > len(data):
+        raise ValueError("head ended inside a string")
+
+    return bytes(data[pos:pos + length]), pos + length
+
+class Table:
+    def __init__(self, max_size: int = DEFAULT_TABLE_SIZE) -> None:
+        self.max_size = max_size
+        self.size = 0
+
+        # Newest entry first, it gets the lowest dynamic index
+        self._entries: collections.deque[tuple[bytes, bytes]] = collections.deque()
+
+        # Entries and names map to the insert count they were last added at, so lookups stay valid as indices shift
+        self._inserted = 0
+        self._by_entry: dict[tuple[bytes, bytes], int] = {}
+        self._by_name: dict[bytes, int] = {}
+
+    def add(self, name: bytes, value: bytes):
+        entry_size = len(name) + len(value) + ENTRY_OVERHEAD
+
+        while self._entries and self.size + entry_size > self.max_size:
+            self._evict()
+
+        # An entry larger than the whole table empties it and is not added
+        if entry_size > self.max_size:
+            return
+
+        self._inserted += 1
+
+        self._entries.appendleft((name, value))
+        self.size += entry_size
+
+        self._by_entry[(name, value)] = self._inserted
+        self._by_name[name] = self._inserted
+
+    def _evict(self):
+        name, value = self._entries.pop()
+
+        self.size -= len(name) + len(value) + ENTRY_OVERHEAD
+
+        oldest = self._inserted - len(self._entries)
+
+        if self._by_entry.get((name, value)) == oldest:
+            del self._by_entry[(name, value)]
+
+        if self._by_name.get(name) == oldest:
+            del self._by_name[name]
+
+    def get(self, index: int) -> tuple[bytes, bytes]:
+        if 0 < index <= len(STATIC_TABLE):
+            return STATIC_TABLE[index - 1]
+
+        if 0 < (index := index - len(STATIC_TABLE)) <= len(self._entries):
+            return self._entries[index - 1]
+
+        raise ValueError(f"header table has no entry {index + len(STATIC_TABLE)}")
+
+    # Index of the entry matching (name, value) and True, else the index of an entry with that name (0 for none) and False
+    def find(self, name: bytes, value: bytes) -> tuple[int, bool]:
+        if (index := _static_entries.get((name, value))) is not None:
+            return index, True
+
+        if (inserted := self._by_entry.get((name, value))) is not None:
+            return len(STATIC_TABLE) + self._inserted - inserted + 1, True
+
+        if (index := _static_names.get(name)) is not None:
+            return index, False
+
+        if (inserted := self._by_name.get(name)) is not None:
+            return len(STATIC_TABLE) + self._inserted - inserted + 1, False
+
+        return 0, False
+
+class Encoder:
+    def __init__(self, table_size: int = DEFAULT_TABLE_SIZE) -> None:
+        self.table = Table(table_size)
+
+    def _line(self, name: bytes, value: bytes) -> bytes:
+        index, exact = self.table.find(name, value)
+
+        if exact:
+            return encode_int(index, 7, INDEXED)
+
+        # Values too large to be worth a table slot are sent as they are
+        if len(name) + len(value) + ENTRY_OVERHEAD > self.table.max_size // 4:
+            return encode_int(index, 4, LITERAL) + (b"" if index else encode_str(name)) + encode_str(value)
+
+        self.table.add(name, value)
+
+        return encode_int(index, 6, LITERAL_INDEXED) + (b"" if index else encode_str(name)) + encode_str(value)
+
+    # Turns the text head of a frame into <line count><lines>, the body follows unchanged
+    def encode(self, frame: bytes) -> bytes:
+        try:
+            info_line, head_end, body_start, header_lines = QSTP.index_frame(frame)
+
+        except (ValueError, UnicodeDecodeError):
+            # Frames the parser cannot read go out as they are behind a line count of 0, the peer rejects them as usual
+            return b"\x00" + frame
+
+        lines = [self._line(b":info", info_line.encode())]
+
+        for start, colon, end in header_lines:
+            lines.append(self._line(bytes(frame[start:colon]).strip(), bytes(frame[colon + 1:end]).strip()))
+
+        return b"".join([encode_int(len(lines), 8), *lines, memoryview(frame)[body_start:]])
+
+class Decoder:
+    def __init__(self, table_size: int = DEFAULT_TABLE_SIZE, max_head_size: int = MAX_HEAD_SIZE) -> None:
+        self.table = Table(table_size)
+        self.max_head_size = max_head_size
+
+    def _line(self, data: memoryview, pos: int) -> tuple[bytes, bytes, int]:
+        if data[pos] & INDEXED:
+            index, pos = decode_int(data, pos, 7)
+
+            name, value = self.table.get(index)
+
+            return name, value, pos
+
+        if not (indexed := data[pos] & LITERAL_INDEXED) and data[pos] & 0xf0:
+            raise ValueError(f"unknown head line representation {data[pos]:#04x}")
+
+        index, pos = decode_int(data, pos, 6 if indexed else 4)
+
+        if index:
+            name = self.table.get(index)[0]
+
+        else:
+            name, pos = decode_str(data, pos)
+
+        value, pos = decode_str(data, pos)
+
+        if indexed:
+            self.table.add(name, value)
+
+        return name, value, pos
+
+    # Rebuilds the text frame from an encoded head, raises ValueError on anything the encoder could not have sent
+    def decode(self, data: bytes) -> bytes:
+        data = memoryview(data)
+
+        count, pos = decode_int(data, 0, 8)
+
+        if count == 0:
+            return bytes(data[pos:])
+
+        info = None
+        lines = []
+        size = 0
+
+        for _ in range(count):
+            if pos >= len(data):
+                raise ValueError("head ended before its last line")
+
+            name, value, pos = self._line(data, pos)
+
+            size += len(name) + len(value) + 3
+
+            if size > self.max_head_size:
+                raise ValueError(f"decoded head is over the {self.max_head_size} byte limit")
+
+            if name == b":info":
+                info = value
+
+            else:
+                lines.append(b"\n" + name + b": " + value)
+
+        if info is None:
+            raise ValueError("head without an info line")
+
+        body = data[pos:]
+
+        return b"".join([info, *lines, b"\n\n" if body else b"", body])
+
+def codec(extensions: dict[str, int]) -> tuple[Encoder, Decoder] | tuple[None, None]:
+    """Helper function to create the header encoder and decoder of a session, `(None, None)` unless both sides agreed on a header table"""
+
+    if "headers" not in extensions:
+        return None, None
+
+    return Encoder(extensions["headers"]), Decoder(extensions["headers"])
\ No newline at end of file
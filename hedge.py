@@ -0,0 +1,158 @@
+import collections, queue, threading, time, typing
+import QSTP
+
+# Answers that do not end a race, the other attempt may still bring a usable one
+FAILED = {1, 101, 303}
+
+class Hedger:
+    def __init__(self, after: float | None = None, quantile: float = 0.95, budget: float = 0.1, burst: float = 10.0, min_samples: int = 20, samples: int = 256) -> None:
+        if not 0 < budget <= 1:
+            raise ValueError(f"hedge budget must be in (0, 1], not {budget}")
+
+        # A second attempt starts once the first has taken `after` seconds, or without it the route's observed `quantile` latency
+        self.after = after
+        self.quantile = quantile
+        self.min_samples = min_samples
+
+        # Every request earns `budget` of a hedge and every hedge costs a whole one, so at most that share of requests is sent twice,
+        # `burst` caps what quiet periods can save up
+        self.budget = budget
+        self.burst = burst
+
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+        self._tokens = 0.0
+        self._latencies: collections.deque[float] = collections.deque(maxlen = samples)
+        self._lock = threading.Lock()
+
+    def threshold(self) -> float | None:
+        if self.after is not None:
+            return self.after
+
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+
+            latencies = sorted(self._latencies)
+
+        return latencies[int(self.quantile * (len(latencies) - 1))]
+
+    def _observe(self, latency: float):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def _spend(self) -> bool:
+        with self._lock:
+            if self._tokens < 1:
+                return False
+
+            self._tokens -= 1
+            self.hedged += 1
+
+            return True
+
+    def _discard(self, resp: QSTP.Response | None):
+        # The body of the loser of a race is not downloaded only to be dropped, closing it closes its tunnel or resets its stream
+        if resp is not None and resp.streamed:
+            resp.stream.close()
+
+    # attempt(False) sends the request, attempt(True) sends the hedge to an upstream the first did not use; the first usable answer is returned
+    def do(self, attempt: typing.Callable[[bool], QSTP.Response]) -> QSTP.Response:
+        with self._lock:
+            self.requests += 1
+
+            self._tokens = min(self.burst, self._tokens + self.budget)
+
+            can_hedge = self._tokens >= 1
+
+        if not can_hedge or (delay := self.threshold()) is None:
+            start = time.monotonic()
+
+            resp = attempt(False)
+
+            if resp.status_code not in FAILED:
+                self._observe(time.monotonic() - start)
+
+            return resp
+
+        results = queue.Queue()
+        lock = threading.Lock()
+        settled = False
+
+        def run(hedge: bool):
+            start = time.monotonic()
+
+            try:
+                resp, error = attempt(hedge), None
+
+            except Exception as e:
+                resp, error = None, e
+
+            if error is None and resp.status_code not in FAILED:
+                self._observe(time.monotonic() - start)
+
+            with lock:
+                if not settled:
+                    results.put((hedge, resp, error))
+
+                    return
+
+            self._discard(resp)
+
+        threading.Thread(target = run, args = (False,), name = "hedge-first", daemon = True).start()
+
+        pending = 1
+        failed = {}
+
+        while True:
+            try:
+                hedge, resp, error = results.get(timeout = delay)
+
+            except queue.Empty:
+                delay = None
+
+                if self._spend():
+                    threading.Thread(target = run, args = (True,), name = "hedge-second", daemon = True).start()
+
+                    pending += 1
+
+                continue
+
+            pending -= 1
+
+            if error is None and resp.status_code not in FAILED:
+                break
+
+            # A failed answer waits for the other attempt, when both fail the first attempt's answer stands
+            failed[hedge] = (resp, error)
+
+            if pending == 0:
+                hedge = False not in failed
+                resp, error = failed[hedge]
+
+                break
+
+        with lock:
+            settled = True
+
+        while not results.empty():
+            self._discard(results.get()[1])
+
+        if error is not None:
+            raise error
+
+        if hedge:
+            with self._lock:
+                self.hedge_wins += 1
+
+        return resp
+
+    def stats(self) -> dict[str, int | float | None]:
+        return {
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "threshold": self.threshold(),
+        }
\ No newline at end of file
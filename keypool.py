@@ -0,0 +1,93 @@
+import collections, threading, oqs
+
+class KeypairPool:
+    def __init__(self, kem_alg: str = "ML-KEM-512", size: int = 32, low_watermark: int = 8) -> None:
+        self.kem_alg = kem_alg
+        self.size = size
+        self.low_watermark = low_watermark
+
+        self.hits = 0
+        self.misses = 0
+
+        self._stock: collections.deque[tuple[oqs.KeyEncapsulation, bytes]] = collections.deque()
+        self._refill = threading.Event()
+        self._closed = False
+
+        # Guards the stock, the counters and _closed, keypairs are generated outside it
+        self._lock = threading.Lock()
+
+        self._refill.set()
+
+        self._thread = threading.Thread(target = self._fill, name = "keypair-pool", daemon = True)
+        self._thread.start()
+
+    def _generate(self) -> tuple[oqs.KeyEncapsulation, bytes]:
+        kem = oqs.KeyEncapsulation(self.kem_alg)
+
+        return kem, kem.generate_keypair()
+
+    def _fill(self):
+        while True:
+            self._refill.wait()
+
+            if self._closed:
+                break
+
+            while len(self._stock) < self.size and not self._closed:
+                keypair = self._generate()
+
+                with self._lock:
+                    # close() may have emptied the stock while this one was being generated, it would never be freed
+                    if not self._closed:
+                        self._stock.append(keypair)
+
+                        keypair = None
+
+                if keypair is not None:
+                    keypair[0].free()
+
+                    return
+
+            self._refill.clear()
+
+            # take() may have drained the stock again while the flag was still set
+            if len(self._stock) < self.low_watermark:
+                self._refill.set()
+
+    def take(self) -> tuple[oqs.KeyEncapsulation, bytes]:
+        """Take a fresh keypair (KEM object, public key), the caller owns it and frees it after a single decapsulation"""
+
+        with self._lock:
+            keypair = self._stock.popleft() if self._stock else None
+
+            if keypair is not None:
+                self.hits += 1
+
+            else:
+                self.misses += 1
+
+            low = len(self._stock) < self.low_watermark
+
+        if low:
+            self._refill.set()
+
+        return keypair or self._generate()
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "stock": len(self._stock),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+
+            stock, self._stock = list(self._stock), collections.deque()
+
+        self._refill.set()
+
+        for kem, _ in stock:
+            kem.free()
\ No newline at end of file
@@ -0,0 +1,196 @@
+import bisect, http.server, threading, typing
+
+# Upper bounds in seconds of the latency histograms, from a tenth of a millisecond for a decrypt to seconds for a slow upstream
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Label values are written between double quotes, these characters are escaped inside them
+LABEL_ESCAPES = str.maketrans({"\\": "\\\\", "\"": "\\\"", "\n": "\\n"})
+
+def format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    """Helper function to format label names and values the way the Prometheus text format writes them"""
+
+    pairs = [f'{name}="{str(value).translate(LABEL_ESCAPES)}"' for name, value in zip(names, values)]
+
+    if extra:
+        pairs.append(extra)
+
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def format_value(value: float) -> str:
+    """Helper function to format a sample value, whole numbers without a fraction"""
+
+    if value == float("inf"):
+        return "+Inf"
+
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+
+        # One entry per combination of label values, created the first time it is recorded
+        self._values: dict[tuple[str, ...], typing.Any] = {}
+        self._lock = threading.Lock()
+
+    def _check(self, labels: tuple[str, ...]):
+        if len(labels) != len(self.label_names):
+            raise ValueError(f"{self.name} takes labels {self.label_names}, not {labels}")
+
+    def samples(self) -> typing.Iterator[str]:
+        with self._lock:
+            values = dict(self._values)
+
+        # A metric without labels has one series from the start, it reads 0 until it is first recorded
+        if not values and not self.label_names:
+            values[()] = 0
+
+        for labels, value in sorted(values.items()):
+            yield f"{self.name}{format_labels(self.label_names, labels)} {format_value(value)}"
+
+    def render(self) -> str:
+        return "\n".join([f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", *self.samples()])
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, labels: tuple[str, ...] = (), amount: float = 1):
+        if amount < 0:
+            raise ValueError("a counter only goes up")
+
+        with self._lock:
+            if (value := self._values.get(labels)) is None:
+                self._check(labels)
+
+                value = 0
+
+            self._values[labels] = value + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, labels: tuple[str, ...] = ()):
+        self._check(labels)
+
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, labels: tuple[str, ...] = (), amount: float = 1):
+        with self._lock:
+            if (value := self._values.get(labels)) is None:
+                self._check(labels)
+
+                value = 0
+
+            self._values[labels] = value + amount
+
+    def dec(self, labels: tuple[str, ...] = (), amount: float = 1):
+        self.inc(labels, -amount)
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = (), buckets: typing.Iterable[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help, label_names)
+
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, labels: tuple[str, ...] = ()):
+        # A sample is counted in its own bucket only, buckets are added up when rendered so recording stays a few list operations
+        i = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            if (entry := self._values.get(labels)) is None:
+                self._check(labels)
+
+                # [count per bucket and one for above the last bound, sum]
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+
+            entry[0][i] += 1
+            entry[1] += value
+
+    def samples(self) -> typing.Iterator[str]:
+        with self._lock:
+            values = {labels: (list(counts), total) for labels, (counts, total) in self._values.items()}
+
+        for labels, (counts, total) in sorted(values.items()):
+            cumulative = 0
+
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+
+                le = 'le="' + format_value(bound) + '"'
+
+                yield f"{self.name}_bucket{format_labels(self.label_names, labels, le)} {cumulative}"
+
+            yield f"{self.name}_sum{format_labels(self.label_names, labels)} {format_value(total)}"
+            yield f"{self.name}_count{format_labels(self.label_names, labels)} {cumulative}"
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls: type[Metric], name: str, help: str, label_names: tuple[str, ...], **kwargs) -> Metric:
+        # Servers and proxies in one process share their metrics, the second to ask for one gets the one the first created
+        with self._lock:
+            if (metric := self._metrics.get(name)) is None:
+                metric = self._metrics[name] = cls(name, help, label_names, **kwargs)
+
+            elif type(metric) is not cls or metric.label_names != tuple(label_names):
+                raise ValueError(f"metric {name} is already registered as a {metric.kind} with labels {metric.label_names}")
+
+            return metric
+
+    def counter(self, name: str, help: str, label_names: tuple[str, ...] = ()) -> Counter:
+        return self._get(Counter, name, help, label_names)
+
+    def gauge(self, name: str, help: str, label_names: tuple[str, ...] = ()) -> Gauge:
+        return self._get(Gauge, name, help, label_names)
+
+    def histogram(self, name: str, help: str, label_names: tuple[str, ...] = (), buckets: typing.Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help, label_names, buckets = buckets)
+
+    # Every metric in the Prometheus text format, this is what a /metrics endpoint answers with
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        return "".join(metric.render() + "\n" for metric in metrics)
+
+# Used by every server and proxy that is not given a registry of its own
+REGISTRY = Registry()
+
+def serve_http(address: tuple[str, int], registry: Registry = REGISTRY, path: str = "/metrics") -> http.server.ThreadingHTTPServer:
+    """Helper function to answer plain HTTP scrapes of `path` with the metrics of `registry` from a daemon thread, returns the server to shut down"""
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != path:
+                self.send_error(404)
+
+                return
+
+            body = registry.render().encode()
+
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args):
+            pass
+
+    httpd = http.server.ThreadingHTTPServer(address, Handler)
+    httpd.daemon_threads = True
+
+    threading.Thread(target = httpd.serve_forever, name = "metrics", daemon = True).start()
+
+    return httpd
\ No newline at end of file
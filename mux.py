@@ -0,0 +1,355 @@
+import struct, threading, queue, typing
+import header_table
+
+# Record types of a multiplexed tunnel, every record starts with <4 byte stream id><type><flags>
+DATA = 0
+WINDOW = 1
+RESET = 2
+GOAWAY = 3
+
+# DATA: last message the sender puts on this stream, RESET: the stream was never processed and can be retried
+END_STREAM = 1
+REFUSED = 1
+
+# DATA: the message is a head in the binary header format
+HEADERS = 2
+
+RECORD = struct.Struct(">IBB")
+INCREMENT = struct.Struct(">I")
+
+DEFAULT_STREAMS = 100
+DEFAULT_WINDOW = 1 << 18
+
+class StreamRefused(ConnectionResetError):
+    pass
+
+class Stream:
+    def __init__(self, mux: "Mux", stream_id: int | None) -> None:
+        self.mux = mux
+        self.id = stream_id
+
+        # Bytes we may still send before the peer grants more, one message may overdraw it
+        self.send_window = mux.window
+        self.refused = False
+
+        # Bytes the peer may still send us, it only sends while its window is open so it overdraws this by one message at most
+        self.recv_window = mux.window
+
+        self._messages: queue.Queue[bytes | None] = queue.Queue()
+        self._consumed = 0
+        self._local_end = False
+        self._remote_end = False
+        self._reset = False
+        self._released = False
+        self._head_sent = False
+
+    # Next message from the peer, None once it ended the stream
+    def recv(self) -> bytes | None:
+        try:
+            msg = self._messages.get(timeout = self.mux.timeout)
+
+        except queue.Empty:
+            raise TimeoutError("no message on the stream in time")
+
+        if msg is None:
+            # Leave the marker for further calls
+            self._messages.put(None)
+
+            if self._remote_end:
+                return None
+
+            raise StreamRefused("stream was refused by the server") if self.refused else ConnectionResetError("stream was reset")
+
+        self.mux._credit(self, len(msg))
+
+        return msg
+
+    def send(self, msg: bytes, end_stream: bool = False):
+        self.mux._send_message(self, msg, end_stream)
+
+    def open_request(self, data: bytes | typing.Iterable[bytes], replay_safe: bool = True) -> bytes:
+        # Same shape as client.Client.open_request so callers can treat a stream like a tunnel of its own
+        msgs = iter([data] if isinstance(data, (bytes, bytearray)) else data)
+
+        msg = next(msgs)
+
+        for next_msg in msgs:
+            self.send(msg)
+
+            msg = next_msg
+
+        self.send(msg, True)
+
+        if (recv_data := self.recv()) is None:
+            raise ConnectionResetError("stream ended without a response")
+
+        return recv_data
+
+    def finish(self):
+        # A response that was not read to the end is cancelled so the peer stops sending it
+        if not self._remote_end and not self._reset:
+            self.mux._reset_stream(self)
+
+        self.mux._release(self)
+
+    def close(self):
+        self.finish()
+
+class Mux:
+    def __init__(self, send_record: typing.Callable[[bytes], None], client: bool, max_streams: int = DEFAULT_STREAMS, window: int = DEFAULT_WINDOW, timeout: float | None = None, encoder: header_table.Encoder | None = None, decoder: header_table.Decoder | None = None) -> None:
+        self._send_record = send_record
+        self.client = client
+        self.max_streams = max_streams
+        self.window = window
+        self.timeout = timeout
+
+        # Header tables change with every head, so heads are encoded in the order they are sent and decoded in the order they arrive
+        self.encoder = encoder
+        self.decoder = decoder
+
+        self.streams: dict[int, Stream] = {}
+
+        # Streams handed out that have not sent anything yet, they only get an id once their first record goes out
+        self._idle = 0
+
+        # Clients open odd streams, the server would use even ones
+        self._next_id = 1 if client else 2
+        self.last_stream = 0
+
+        # Last stream the peer will still process, set once it said it is going away
+        self.goaway: int | None = None
+        self.draining = False
+        self.closed = False
+
+        self._cond = threading.Condition()
+
+        # Records have to be sent in the order they were encrypted, the record nonce is a sequence number
+        self._send_lock = threading.Lock()
+
+    def _record(self, stream_id: int, kind: int, flags: int = 0, payload: bytes = b""):
+        with self._send_lock:
+            if kind == DATA and flags & HEADERS:
+                payload = self.encoder.encode(payload)
+
+            self._send_record(RECORD.pack(stream_id, kind, flags) + payload)
+
+    def open_stream(self) -> Stream:
+        with self._cond:
+            while len(self.streams) + self._idle >= self.max_streams and not (self.closed or self.goaway is not None):
+                self._cond.wait()
+
+            if self.closed or self.goaway is not None:
+                raise ConnectionResetError("tunnel is closing")
+
+            self._idle += 1
+
+        return Stream(self, None)
+
+    def _send_message(self, stream: Stream, msg: bytes, end_stream: bool):
+        with self._cond:
+            while msg and stream.send_window <= 0 and not (self.closed or stream._reset):
+                self._cond.wait()
+
+            if self.closed or stream._reset:
+                raise ConnectionResetError("stream was reset")
+
+            stream.send_window -= len(msg)
+
+        flags = END_STREAM if end_stream else 0
+
+        # The first message of each side of a stream is its head
+        if self.encoder is not None and not stream._head_sent:
+            flags |= HEADERS
+
+        stream._head_sent = True
+
+        if stream.id is not None:
+            self._record(stream.id, DATA, flags, msg)
+
+        else:
+            with self._send_lock:
+                # The peer takes a stream id below the highest it has seen as an old stream, so ids are given out in the order streams go on the wire
+                with self._cond:
+                    if self.closed or self.goaway is not None:
+                        stream.refused = self.goaway is not None
+
+                        raise StreamRefused("tunnel is going away") if stream.refused else ConnectionResetError("tunnel is closed")
+
+                    stream.id, self._next_id = self._next_id, self._next_id + 2
+
+                    self._idle -= 1
+                    self.streams[stream.id] = stream
+
+                try:
+                    self._send_record(RECORD.pack(stream.id, DATA, flags) + (self.encoder.encode(msg) if flags & HEADERS else msg))
+
+                except OSError as e:
+                    # The peer had already hung up, so it never saw this stream either
+                    stream.refused = True
+
+                    raise StreamRefused("tunnel was closed before the stream opened") from e
+
+        if end_stream:
+            stream._local_end = True
+
+            if stream._remote_end:
+                self._release(stream)
+
+    def _credit(self, stream: Stream, size: int):
+        stream._consumed += size
+
+        # Hand back window in batches instead of one update per message
+        if stream._consumed >= self.window // 2 and not (stream._remote_end or self.closed):
+            increment, stream._consumed = stream._consumed, 0
+
+            with self._cond:
+                stream.recv_window += increment
+
+            try:
+                self._record(stream.id, WINDOW, 0, INCREMENT.pack(increment))
+
+            except OSError:
+                pass
+
+    def _reset_stream(self, stream: Stream, flags: int = 0):
+        stream._reset = True
+
+        if not self.closed and stream.id is not None:
+            try:
+                self._record(stream.id, RESET, flags)
+
+            except OSError:
+                pass
+
+    def _release(self, stream: Stream):
+        with self._cond:
+            if stream.id is None:
+                # Never sent anything, only its slot has to be given back
+                if not stream._released:
+                    stream._released = stream._reset = True
+                    self._idle -= 1
+
+                    self._cond.notify_all()
+
+            elif self.streams.pop(stream.id, None) is not None:
+                self._cond.notify_all()
+
+    def _end(self, stream: Stream, refused: bool = False):
+        stream._reset = True
+        stream.refused = refused
+
+        stream._messages.put(None)
+
+        self._release(stream)
+
+    def go_away(self):
+        # No new streams after this one, the ones already open are finished
+        self.draining = True
+
+        self._record(self.last_stream, GOAWAY)
+
+    # Takes every decrypted record from the peer, returns a stream the peer just opened
+    def feed(self, record: bytes) -> Stream | None:
+        if len(record) < RECORD.size:
+            raise ValueError("record is shorter than its stream header")
+
+        stream_id, kind, flags = RECORD.unpack_from(record)
+
+        if kind == GOAWAY:
+            with self._cond:
+                self.goaway = stream_id
+
+                refused = [stream for stream in self.streams.values() if stream.id > stream_id]
+
+                self._cond.notify_all()
+
+            # Streams the peer never saw can safely be sent again on another tunnel
+            for stream in refused:
+                self._end(stream, True)
+
+            return None
+
+        with self._cond:
+            stream = self.streams.get(stream_id)
+
+            if kind == WINDOW:
+                if stream is not None:
+                    stream.send_window += INCREMENT.unpack_from(record, RECORD.size)[0]
+
+                    self._cond.notify_all()
+
+                return None
+
+        if kind == RESET:
+            if stream is not None:
+                self._end(stream, bool(flags & REFUSED))
+
+            return None
+
+        if kind != DATA:
+            raise ValueError(f"unknown record type {kind}")
+
+        payload = record[RECORD.size:]
+
+        # Every head is decoded, even one for a stream that is dropped below, or the header tables would drift apart
+        if flags & HEADERS:
+            if self.decoder is None:
+                raise ValueError("head in the binary header format without a header table")
+
+            payload = self.decoder.decode(payload)
+
+        new = None
+
+        if stream is None:
+            # Only streams opened by the peer that we have not seen yet are new, anything else was reset and is dropped
+            if stream_id % 2 != (0 if self.client else 1) or stream_id <= self.last_stream:
+                return None
+
+            self.last_stream = stream_id
+
+            stream = Stream(self, stream_id)
+
+            with self._cond:
+                if not (refuse := self.draining or len(self.streams) >= self.max_streams):
+                    self.streams[stream_id] = new = stream
+
+            if refuse:
+                self._record(stream_id, RESET, REFUSED)
+
+                return None
+
+        with self._cond:
+            overdrawn = payload and stream.recv_window <= 0
+
+            stream.recv_window -= len(payload)
+
+        if overdrawn:
+            # The peer kept sending after its window ran out, buffering for it would let it use up our memory
+            self._reset_stream(stream)
+            self._end(stream)
+
+            return None
+
+        stream._messages.put(payload)
+
+        if flags & END_STREAM:
+            stream._remote_end = True
+
+            stream._messages.put(None)
+
+            if stream._local_end:
+                self._release(stream)
+
+        return new
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+
+            streams = list(self.streams.values())
+
+            self._cond.notify_all()
+
+        for stream in streams:
+            if not stream._remote_end:
+                self._end(stream)
\ No newline at end of file
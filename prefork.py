@@ -0,0 +1,79 @@
+import signal, socket, threading, multiprocessing, typing
+
+# Linux balances connections across sockets bound with SO_REUSEPORT, elsewhere workers share one inherited socket
+REUSE_PORT = hasattr(socket, "SO_REUSEPORT")
+
+class Supervisor:
+    def __init__(self, processes: int, restart_delay: float = 0.5) -> None:
+        self.processes = processes
+        self.restart_delay = restart_delay
+        self.restarts = 0
+
+        # Handlers and routes are closures, so workers have to be forked rather than spawned
+        self._ctx = multiprocessing.get_context("fork")
+        self._shutdown = self._ctx.Event()
+        self._procs: dict[int, multiprocessing.Process] = {}
+
+        # Set by SIGTERM, the handler cannot set _shutdown itself while the loop below waits on it
+        self._terminated = False
+
+    @property
+    def stopping(self) -> bool:
+        return self._shutdown.is_set()
+
+    def stop(self):
+        # Shared with the workers, so calling this from a handler in any worker stops the whole server
+        self._shutdown.set()
+
+    def _spawn(self, i: int, target: typing.Callable[[], None], stop_worker: typing.Callable[[], None]):
+        def run():
+            # SIGTERM stops only this worker, the supervisor restarts it unless the server is shutting down
+            signal.signal(signal.SIGTERM, lambda *_: stop_worker())
+
+            # Ctrl+C reaches the whole process group, leave it to the supervisor
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+            target()
+
+        proc = self._ctx.Process(target = run, name = f"qstp-worker-{i}")
+        proc.start()
+
+        self._procs[i] = proc
+
+    def _terminate(self, *_):
+        self._terminated = True
+
+    def run(self, target: typing.Callable[[], None], stop_worker: typing.Callable[[], None]):
+        # A service manager stops the server with SIGTERM, it has to take the workers down with it instead of orphaning them
+        previous = signal.signal(signal.SIGTERM, self._terminate) if threading.current_thread() is threading.main_thread() else None
+
+        for i in range(self.processes):
+            self._spawn(i, target, stop_worker)
+
+        try:
+            while not self._shutdown.wait(self.restart_delay):
+                if self._terminated:
+                    self._shutdown.set()
+
+                    break
+
+                for i, proc in list(self._procs.items()):
+                    if not proc.is_alive():
+                        proc.join()
+
+                        self.restarts += 1
+
+                        self._spawn(i, target, stop_worker)
+
+        finally:
+            for proc in self._procs.values():
+                proc.terminate()
+
+            for proc in self._procs.values():
+                proc.join(10)
+
+                if proc.is_alive():
+                    proc.kill()
+
+            if previous is not None:
+                signal.signal(signal.SIGTERM, previous)
\ No newline at end of file
@@ -1,32 +1,136 @@
-import typing
-import server, client
+import itertools, time, typing
+import server, tunnel_pool, QSTP, mux, metrics, handshake
+
+def response_status(head: bytes) -> str:
+    """Helper function to read the status code off the head of a response without parsing the rest of the frame"""
+
+    parts = bytes(head[:64]).split(b"\n", 1)[0].split(b" ", 2)
+
+    return parts[1].decode() if len(parts) == 3 and parts[1].isdigit() else "invalid"
+
+def relay_chunks(pull: typing.Callable[[], bytes | None]) -> typing.Iterator[bytes]:
+    """Helper function to pass on the chunks of a streamed message as they arrive, up to and including the empty message that ends it"""
+
+    while (chunk := pull()):
+        yield chunk
+
+    if chunk is None:
+        raise ConnectionError("tunnel closed in the middle of a chunked body")
+
+    yield b""
 
 class Proxy:
-    def __init__(self, kem_alg: str = "ML-KEM-512") -> None:
+    def __init__(self, kem_alg: str = "ML-KEM-512", pool: tunnel_pool.TunnelPool | None = None, relay: bool = False, registry: metrics.Registry | None = None) -> None:
         self.kem_alg = kem_alg
-        self._server = server.Server(kem_alg)
+        self.pool = pool or tunnel_pool.TunnelPool(kem_alg)
+        self._owns_pool = pool is None
+        self._server = server.Server(kem_alg, registry = registry)
+
+        # Recorded under route "proxy", next to the routes of a reverse proxy sharing the registry
+        self.registry = self._server.registry
+
+        self._upstream_latency = self.registry.histogram("qstp_upstream_seconds", "Time until an upstream answered with the head of its response", ("route", "upstream"))
+        self._upstream_responses = self.registry.counter("qstp_upstream_responses_total", "Upstream answers per status code, 1 for a refused connection and 303 for a timeout", ("route", "status"))
+
+        # In relay mode messages are passed on one at a time as they arrive in both directions, the handlers then only see heads
+        # and time to first byte does not grow with the body
+        self.relay = relay
 
         self._cl_handler = None
         self._sv_handler = None
 
+    def _observe(self, upstream_address: tuple[str, int], head: bytes, start: float):
+        self._upstream_latency.observe(time.perf_counter() - start, ("proxy", f"{upstream_address[0]}:{upstream_address[1]}"))
+        self._upstream_responses.inc(("proxy", response_status(head)))
+
+    def _relay(self, head: bytes, addr: tuple[str, int], session: server.Session | mux.Stream, upstream_address: tuple[str, int]) -> typing.Iterator[bytes]:
+        chunked = QSTP.is_chunked(head)
+
+        if self._cl_handler:
+            head = self._cl_handler(head, addr)
+
+        # The rest of a chunked request is read from the client while it is being sent upstream
+        req = itertools.chain([head], relay_chunks(session.recv)) if chunked else head
+
+        start = time.perf_counter()
+
+        cl = self.pool.acquire(upstream_address)
+
+        try:
+            # Raw frames of any method pass through here, only idempotent ones may be resent on a fresh tunnel
+            resp = cl.open_request(req, handshake.replay_safe(head))
+
+            self._observe(upstream_address, resp, start)
+
+            chunked = QSTP.is_chunked(resp)
+
+            yield self._sv_handler(resp, addr) if self._sv_handler else resp
+
+            if chunked:
+                yield from relay_chunks(cl.recv)
+
+        except BaseException:
+            cl.close()
+
+            raise
+
+        cl.finish()
+
+        self.pool.release(cl)
+
+    def _store_and_forward(self, frame: bytes, addr: tuple[str, int], session: server.Session | mux.Stream, upstream_address: tuple[str, int]) -> list[bytes]:
+        # The chunks of a streamed message are collected before it is passed on, the handlers only see its head
+        chunks = list(relay_chunks(session.recv)) if QSTP.is_chunked(frame) else []
+
+        head = self._cl_handler(frame, addr) if self._cl_handler else frame
+
+        start = time.perf_counter()
+
+        cl = self.pool.acquire(upstream_address)
+
+        try:
+            # Raw frames of any method pass through here, only idempotent ones may be resent on a fresh tunnel
+            resp = cl.open_request(itertools.chain([head], chunks) if chunks else head, handshake.replay_safe(frame))
+
+            self._observe(upstream_address, resp, start)
+
+            resp_chunks = list(relay_chunks(cl.recv)) if QSTP.is_chunked(resp) else []
+
+        except BaseException:
+            cl.close()
+
+            raise
+
+        cl.finish()
+
+        self.pool.release(cl)
+
+        return [self._sv_handler(resp, addr) if self._sv_handler else resp, *resp_chunks]
+
     def serve(self, listen_address: tuple[str, int], upstream_address: tuple[str, int], connections: int = 10):
-        @self._server.handle_data
-        def _data_handler(frame: bytes, addr: tuple[str, int]) -> bytes:
-            if self._cl_handler:
-                frame = self._cl_handler(frame, addr)
+        if self.relay:
+            @self._server.handle_stream
+            def _stream_handler(frame: bytes, addr: tuple[str, int], session: server.Session | mux.Stream) -> typing.Iterator[bytes]:
+                return self._relay(frame, addr, session, upstream_address)
 
-            resp = client.Client(self.kem_alg).connect(upstream_address).do_request(frame)
+            self._server.serve(listen_address, connections)
 
-            if self._sv_handler:
-                resp = self._sv_handler(resp, addr)
+            return
 
-            return resp
+        # Stored and forwarded whole, a stream handler still gets the session so the chunks of a streamed message are not left behind
+        @self._server.handle_stream
+        def _stream_handler(frame: bytes, addr: tuple[str, int], session: server.Session | mux.Stream) -> list[bytes]:
+            return self._store_and_forward(frame, addr, session, upstream_address)
 
         self._server.serve(listen_address, connections)
 
     def close(self):
         self._server.close()
 
+        # A pool handed in by the application may be shared with other proxies, leave it to its owner
+        if self._owns_pool:
+            self.pool.close()
+
     def handle_client_data(self, func: typing.Callable[[bytes, tuple[str, int]], bytes]) -> typing.Callable[[bytes, tuple[str, int]], bytes]:
         self._cl_handler = func
 
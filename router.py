@@ -1,142 +1,240 @@
-import typing
+import re, typing
+import QSTP
 
-METHODS = {
-    "GET",
-    "POST",
-    "DELETE",
-    "PATCH",
+# Segments the int and float converters take, ASCII digits with an optional sign and, for floats, a fraction
+INT_SEGMENT = re.compile(r"-?\d+", re.ASCII)
+FLOAT_SEGMENT = re.compile(r"-?\d+(\.\d+)?", re.ASCII)
+
+def convert_int(segment: str) -> int:
+    """Helper function to convert a segment of plain digits, `int()` alone would also take underscores and surrounding whitespace"""
+
+    if not INT_SEGMENT.fullmatch(segment):
+        raise ValueError(f"{segment!r} is not an int segment")
+
+    return int(segment)
+
+def convert_float(segment: str) -> float:
+    """Helper function to convert a segment of digits with an optional fraction, `float()` alone would also take nan, inf and exponents"""
+
+    if not FLOAT_SEGMENT.fullmatch(segment):
+        raise ValueError(f"{segment!r} is not a float segment")
+
+    return float(segment)
+
+# Converters for <converter:name> segments, a ValueError means the segment does not match
+CONVERTERS: dict[str, typing.Callable[[str], typing.Any]] = {
+    "int": convert_int,
+    "float": convert_float,
+    "str": str,
 }
 
+# Order parameter segments are tried in, the most specific converter first
+CONVERTER_ORDER = ["int", "float", "str"]
+
+class Node:
+    def __init__(self) -> None:
+        self.static: dict[str, Node] = {}
+        self.params: dict[str, Node] = {}
+
+        # Handler and parameter names of the route ending here, and of a <path:...> route catching everything below
+        self.handler: tuple[typing.Callable, list[str]] | None = None
+        self.catch_all: tuple[typing.Callable, list[str]] | None = None
+
+def split_path(path: str) -> list[str]:
+    """Helper function to split a path into its segments, empty segments are ignored"""
+
+    return [part for part in path.split("/") if part]
+
+def parse_segment(part: str) -> tuple[str | None, str]:
+    """Helper function to parse a route segment into (converter, name) for parameters or (None, segment) for static segments"""
+
+    if not (part.startswith("<") and part.endswith(">")):
+        return None, part
+
+    converter, _, name = part[1:-1].rpartition(":")
+
+    converter = converter or "str"
+
+    if converter != "path" and converter not in CONVERTERS:
+        raise Exception(f"Unknown converter {converter!r}")
+
+    return converter, name
+
 class Router:
     def __init__(self) -> None:
-        self.handlers: dict[str, dict[str, typing.Callable]] = {}
+        self.handlers: dict[str, dict[str, typing.Callable[[QSTP.Request, dict[str, typing.Any]], QSTP.Response]]] = {}
 
-        for method in METHODS:
+        # Routes are compiled into one segment trie per method when they are registered
+        self._roots: dict[str, Node] = {}
+
+        for method in QSTP.METHODS:
             self.handlers[method] = {}
+            self._roots[method] = Node()
+
+    def _add(self, method: str, route_descriptor: str, func: typing.Callable):
+        node = self._roots[method]
+        names = []
+
+        parts = split_path(route_descriptor)
+
+        for i, part in enumerate(parts):
+            converter, name = parse_segment(part)
+
+            if converter is None:
+                node = node.static.setdefault(name, Node())
+
+                continue
+
+            names.append(name)
+
+            if converter == "path":
+                if i != len(parts) - 1:
+                    raise Exception(f"<path:{name}> has to be the last segment of {route_descriptor!r}")
+
+                node.catch_all = (func, names)
+
+                return
+
+            node = node.params.setdefault(converter, Node())
+
+        node.handler = (func, names)
 
     def route(self, route_descriptor: str, methods: list[str] | None = None):
-        def decorator(func: typing.Callable[[str], str]):
+        def decorator(func: typing.Callable[[QSTP.Request, dict[str, typing.Any]], QSTP.Response]):
             methods_ = methods or ["GET"]
 
             for method in methods_:
-                if method not in METHODS:
+                if method not in QSTP.METHODS:
                     raise Exception(f"Unknown method {method!r}")
 
                 self.handlers[method][route_descriptor] = func
-            
+
+                self._add(method, route_descriptor, func)
+
             return func
 
         return decorator
 
-    def match_route(self, route_descriptor: str, method: str) -> tuple[typing.Callable, dict[str, str]] | None:
-        if method not in METHODS:
-            raise Exception(f"Unknown method {method!r}")
-        
-        for defined_route, func in self.handlers[method].items():
-            path_defined = []
-            path_try = []
+    def _match(self, node: Node, parts: list[str], i: int, values: list) -> tuple[typing.Callable, list[str]] | None:
+        if i == len(parts):
+            return node.handler
 
-            for part in defined_route.split("/"):
-                if part.startswith("<") and part.endswith(">"):
-                    path_defined.append((1, part[1:-1]))
-                
-                elif part:
-                    path_defined.append((0, part))
+        part = parts[i]
 
-            path_try = list(filter(lambda x: bool(x), route_descriptor.split("/")))
+        # Static segments win over parameters, parameters over a catch-all, a dead end falls back to the next option
+        if (child := node.static.get(part)) is not None and (ret := self._match(child, parts, i + 1, values)):
+            return ret
 
-            if len(path_defined) != len(path_try):
+        for converter in CONVERTER_ORDER:
+            if (child := node.params.get(converter)) is None:
                 continue
-            
-            variables = {}
-
-            for defined, test in zip(path_defined, path_try):
-                if defined[0] == 0 and defined[1] == test:
-                    continue
-                
-                elif defined[0] == 1:
-                    variables[defined[1]] = test
-
-                else:
-                    break
-            
-            else:
-                return func, variables
-
-def test1():
+
+            try:
+                value = CONVERTERS[converter](part)
+
+            except ValueError:
+                continue
+
+            values.append(value)
+
+            if (ret := self._match(child, parts, i + 1, values)):
+                return ret
+
+            values.pop()
+
+        if node.catch_all is not None:
+            values.append("/".join(parts[i:]))
+
+            return node.catch_all
+
+        return None
+
+    def match_route(self, route_descriptor: str, method: str) -> tuple[typing.Callable[[QSTP.Request, dict[str, typing.Any]], QSTP.Response], dict[str, typing.Any]] | None:
+        if method not in QSTP.METHODS:
+            raise Exception(f"Unknown method {method!r}")
+
+        values = []
+
+        if (ret := self._match(self._roots[method], split_path(route_descriptor), 0, values)) is None:
+            return None
+
+        func, names = ret
+
+        return func, dict(zip(names, values))
+
+if __name__ == "__main__":
+    import sys, time, random
+
     router = Router()
 
     @router.route("/", methods = ["GET"])
-    def index(string: str) -> str:
-        return f"input: \"{string}\""
+    def index(rq: QSTP.Request, args: dict) -> str:
+        return "index"
 
     @router.route("/data", methods = ["GET", "POST", "PATCH", "DELETE"])
-    def data(string: str) -> str:
-        return f"input: \"{string}\""
+    def data(rq: QSTP.Request, args: dict) -> str:
+        return "data"
 
     @router.route("/test/<test_data>", methods = ["POST"])
-    def test(string: str) -> str:
-        return f"input: \"{string}\""
+    def test(rq: QSTP.Request, args: dict) -> str:
+        return "test"
+
+    @router.route("/users/<int:user_id>")
+    def user_by_id(rq: QSTP.Request, args: dict) -> str:
+        return "user_by_id"
+
+    @router.route("/users/<name>")
+    def user_by_name(rq: QSTP.Request, args: dict) -> str:
+        return "user_by_name"
+
+    @router.route("/users/me")
+    def me(rq: QSTP.Request, args: dict) -> str:
+        return "me"
+
+    @router.route("/files/<path:rest>")
+    def files(rq: QSTP.Request, args: dict) -> str:
+        return "files"
 
     tests = [
         ("/", "GET"),
         ("/data", "PATCH"),
         ("/test", "POST"),
         ("/test/data", "POST"),
+        ("/users/42", "GET"),
+        ("/users/bwp09", "GET"),
+        ("/users/me", "GET"),
+        ("/files/a/b/c.txt", "GET"),
 
         ("/", "POST"),
-        ("/data", "GET"),
         ("/test", "GET"),
+        ("/users/42/posts", "GET"),
     ]
 
     for route, method in tests:
-        print(router.match_route(route, method))
+        ret = router.match_route(route, method)
 
-test1()
+        print(f"{method} {route} -> {(ret[0](None, ret[1]), ret[1]) if ret else None}")
 
-def match_route(defined_route_descriptor: str, test_route_descriptor: str) -> dict[str, str] | None:
-    path_defined = []
-    path_try = []
+    if "--bench" not in sys.argv:
+        sys.exit()
 
-    for part in defined_route_descriptor.split("/"):
-        if part.startswith("<") and part.endswith(">"):
-            path_defined.append((1, part[1:-1]))
-        
-        elif part:
-            path_defined.append((0, part))
+    # Route count should not change lookup time, only path depth does
+    for count in (1_000, 10_000):
+        router = Router()
+        paths = []
 
-    path_try = list(filter(lambda x: bool(x), test_route_descriptor.split("/")))
+        for i in range(count):
+            router.route(f"/api/v1/resource{i}/<int:id>/item{i % 7}/<name>", methods = ["GET"])(index)
 
-    if len(path_defined) != len(path_try):
-        return
-    
-    variables = {}
+            paths.append(f"/api/v1/resource{i}/{i * 31}/item{i % 7}/name{i}")
 
-    for defined, test in zip(path_defined, path_try):
-        if defined[0] == 0 and defined[1] == test:
-            continue
-        
-        elif defined[0] == 1:
-            variables[defined[1]] = test
+        lookups = random.choices(paths, k = 100_000)
 
-        else:
-            return
+        start = time.perf_counter()
 
-    return variables
+        for path in lookups:
+            router.match_route(path, "GET")
 
-def test2():
-    tests = [
-        ("/test_before/<data>/test_after", "/test_before/data_test_123/test_after"),
-        ("/users/<user>", "/users/bwp09"),
-        ("/users/<user>/comment/<comment>", "/users/bwp09/comment/190283901283"),
-        ("/test", "/test"),
-        ("/post/<post_id>", "/post/01923890/likes"),
-        ("/<one>/<two>/<three>", "/one/two/three/four"),
-        ("/<test>", "/1238901283091283"),
-        ("/test", "/test/123"),
-    ]
+        elapsed = time.perf_counter() - start
 
-    for i, (x, y) in enumerate(tests):
-        print(f"{i} START")
-        print(match_route(x, y))
-        print(f"{i} END")
\ No newline at end of file
+        print(f"{count} routes: {len(lookups) / elapsed :,.0f} lookups/s, {elapsed / len(lookups) * 1e6 :.2f}us per lookup")
\ No newline at end of file
@@ -1,74 +1,549 @@
-import socket, oqs, AES_cipher, threading, typing
-import util
+import socket, select, AES_cipher, threading, queue, traceback, typing, multiprocessing, concurrent.futures, time
+import util, handshake, tickets, prefork, mux, header_table, metrics
+
+# Seconds between checks for connections waiting on a worker while a keep-alive session on one is idle
+IDLE_POLL = 0.05
+
+class Session:
+    def __init__(self, server: "Server", framer: util.Framer, cipher: AES_cipher.AES | AES_cipher.AEAD, extensions: dict[str, int] | None = None) -> None:
+        self._server = server
+        self._framer = framer
+        self._cipher = cipher
+
+        self._encoder, self._decoder = header_table.codec(extensions or {})
+
+        # Whether the head of the current response went out, an error after it is sent as a plain message
+        self.head_sent = False
+
+    def recv(self) -> bytes | None:
+        cipher_text = self._framer.recv_msg()
+
+        if cipher_text is None:
+            return None
+
+        self._server._phases.observe(self._framer.recv_time, ("receive",))
+
+        return self._server._decrypt(self._cipher, cipher_text)
+
+    def send(self, data: bytes):
+        self._server._send(self._framer, self._cipher, data)
+
+    # The first message of a request or response is its head, only heads go through the header table
+    def recv_head(self) -> bytes | None:
+        if (data := self.recv()) is None or self._decoder is None:
+            return data
+
+        return self._decoder.decode(data)
+
+    def send_head(self, data: bytes):
+        self.head_sent = True
+
+        self.send(self._encoder.encode(data) if self._encoder else data)
 
 class Server:
-    def __init__(self, kem_alg: str = "ML-KEM-512") -> None:
+    def __init__(self, kem_alg: str = "ML-KEM-512", idle_timeout: float | None = 5.0, max_requests: int | None = 100, ticket_keys: tickets.TicketKeys | None = None, static_key: tuple[bytes, bytes] | None = None, replay_window: float = 10.0, workers: int | None = None, queue_size: int = 64, overload: str = "delay", queue_timeout: float = 1.0, crypto_processes: int | None = None, offload_threshold: int = 1 << 20, suites: list[str] | None = None, max_frame_size: int | None = util.MAX_FRAME_SIZE, max_streams: int | None = mux.DEFAULT_STREAMS, stream_window: int = mux.DEFAULT_WINDOW, header_table_size: int | None = header_table.DEFAULT_TABLE_SIZE, registry: metrics.Registry | None = None, handshake_timeout: float | None = 5.0, stream_workers: int = 64) -> None:
+        if overload not in ("queue", "shed", "delay"):
+            raise ValueError(f"{overload!r} is not an overload policy")
+
         self.kem_alg = kem_alg
+        self.idle_timeout = idle_timeout
+
+        # Seconds a connection has for its whole handshake, one that never sends its hello does not hold a worker
+        self.handshake_timeout = handshake_timeout
+        self.max_requests = max_requests
+        self.ticket_keys = ticket_keys
+
+        # Long-term (public key, secret key) that enables 0-RTT for clients which pinned the public key
+        self.static_key = static_key
+        self._replay_cache = handshake.ReplayCache(replay_window) if static_key else None
+
+        # Without workers every connection gets its own thread, with workers connections wait in a bounded queue
+        self.workers = workers
+        self.queue_size = queue_size
+        self.overload = overload
+        self.queue_timeout = queue_timeout
+
+        self.shed = 0
+
+        # Cipher suites accepted from clients in order of preference
+        self.suites = suites or AES_cipher.DEFAULT_SUITES
+
+        # Larger frames end the session before their buffer is allocated
+        self.max_frame_size = max_frame_size
+
+        # Clients that ask for it can run up to max_streams concurrent requests over one tunnel
+        self.max_streams = max_streams
+        self.stream_window = stream_window
+
+        # Handler threads shared by the streams of every multiplexed tunnel, further streams wait for one to be free
+        self.stream_workers = stream_workers
+        self._stream_executor = None
+
+        # Clients that ask for it send heads in the binary header format with a table of this many bytes per direction
+        self.header_table_size = header_table_size
+
+        # KEM operations and bulk AES over offload_threshold bytes can run in worker processes, only keys and data cross over
+        self.crypto_processes = crypto_processes
+        self.offload_threshold = offload_threshold
+
+        self._executor = None
+
+        # Latency per phase of a request, live sessions and failures, shared with everything else recording into the same registry
+        self.registry = registry or metrics.REGISTRY
+
+        self._phases = self.registry.histogram("qstp_phase_seconds", "Time spent in each phase of serving a request", ("phase",))
+        self._live_sessions = self.registry.gauge("qstp_sessions", "Sessions open right now")
+        self._shed_total = self.registry.counter("qstp_shed_total", "Connections refused because the accept queue was full")
+        self._errors = self.registry.counter("qstp_server_errors_total", "Requests answered with SERVER ERROR because their handler raised")
+
+        # (socket, address, time it was accepted) per connection waiting for a worker
+        self._queue: queue.Queue[tuple[socket.socket, tuple[str, int], float]] = queue.Queue(queue_size)
+        self._threads: dict[str, threading.Thread] = {}
+        self._sessions: dict[str, threading.Thread] = {}
         self._handler = None
+        self._handler_streams = False
         self._stopped = False
+        self._supervisor = None
 
-    def _init_socket(self, address: tuple[str, int], connections: int):
+    def _init_socket(self, address: tuple[str, int], connections: int, reuse_port: bool = False):
         self.address = address
         self._connections = connections
 
         self._sv_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+        if reuse_port:
+            self._sv_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
         self._sv_socket.bind(self.address)
         self._sv_socket.listen(self._connections)
 
-    def serve(self, address: tuple[str, int], connections: int = 10):
-        self._init_socket(address, connections)
+        # accept() wakes up regularly to notice close(), this works across processes unlike connecting to ourselves
+        self._sv_socket.settimeout(0.5)
 
-        self._threads: dict[str, threading.Thread] = {}
+    @property
+    def static_public_key(self) -> bytes | None:
+        return self.static_key[0] if self.static_key else None
 
-        while True:
-            cl_socket, cl_addr = self._sv_socket.accept()
+    @property
+    def extensions(self) -> dict[str, int]:
+        extensions = {}
 
-            if self._stopped:
-                break
+        if self.max_streams:
+            extensions.update(mux = self.max_streams, window = self.stream_window)
 
-            thread_name = f"{cl_addr[0]}:{cl_addr[1]}"
+        if self.header_table_size is not None:
+            extensions["headers"] = self.header_table_size
+
+        return extensions
+
+    def _init_kem_tunnel(self, framer: util.Framer) -> tuple[AES_cipher.AES | AES_cipher.AEAD | None, bytes | None, dict[str, int]]:
+        # A rejected ticket or early data is followed by a full handshake on the same connection
+        for i in range(2):
+            try:
+                hello = framer.recv_msg()
+
+            except (ValueError, TimeoutError):
+                # A hello over the size limit or one that did not arrive in time
+                return None, None, {}
+
+            if hello is None:
+                return None, None, {}
+
+            # Timed from the first hello on, a retried handshake counts as one
+            if i == 0:
+                start = time.perf_counter()
+
+            reply, cipher, early_data, extensions = handshake.accept(hello, self.kem_alg, self.ticket_keys, self.static_key, self._replay_cache, self._executor, self.suites, self.extensions)
+
+            framer.send_msg(reply)
+
+            if cipher is not None:
+                self._phases.observe(time.perf_counter() - start, ("handshake",))
+
+                return cipher, early_data, extensions
+
+        return None, None, {}
+
+    def _encrypt(self, cipher: AES_cipher.AES | AES_cipher.AEAD, data: bytes) -> bytes:
+        start = time.perf_counter()
+
+        if self._executor is not None and len(data) >= self.offload_threshold:
+            record = self._executor.submit(AES_cipher.encrypt_record, cipher.suite, *cipher.next_send(), data).result()
+
+        else:
+            record = cipher.encrypt(data)
+
+        self._phases.observe(time.perf_counter() - start, ("encrypt",))
+
+        return record
+
+    def _decrypt(self, cipher: AES_cipher.AES | AES_cipher.AEAD, data: bytes) -> bytes:
+        start = time.perf_counter()
+
+        if self._executor is not None and len(data) >= self.offload_threshold:
+            plain_text = self._executor.submit(AES_cipher.decrypt_record, cipher.suite, *cipher.next_recv(), data).result()
+
+        else:
+            plain_text = cipher.decrypt(data)
+
+        self._phases.observe(time.perf_counter() - start, ("decrypt",))
+
+        return plain_text
+
+    def _send(self, framer: util.Framer, cipher: AES_cipher.AES | AES_cipher.AEAD, data: bytes):
+        record = self._encrypt(cipher, data)
+
+        start = time.perf_counter()
+
+        framer.send_msg(record)
+
+        self._phases.observe(time.perf_counter() - start, ("send",))
 
-            def callback(sock: socket.socket, addr: tuple[str, int], name: str):
-                # Recv client public key
-                cl_public_key = sock.recv(800)
+    def _handle_session(self, sock: socket.socket, addr: tuple[str, int]):
+        framer = util.Framer(sock, handshake.MAX_HELLO_SIZE)
 
-                with oqs.KeyEncapsulation(self.kem_alg) as server:
-                    # Server generates and encapsulates secret using client's public key
-                    cipher_text, sh_secret = server.encap_secret(cl_public_key)
+        if self.handshake_timeout is not None:
+            framer.deadline = time.monotonic() + self.handshake_timeout
 
-                # Send cipher text to client
-                sock.sendall(cipher_text)
+        cipher, req, extensions = self._init_kem_tunnel(framer)
 
-                # Recv and decrypt data with shared secret
-                AES = AES_cipher.AES(sh_secret)
+        if cipher is None:
+            return
 
-                cipher_text = util.recv_msg(sock)
+        framer.deadline = None
+        framer.max_frame_size = self.max_frame_size
 
-                if cipher_text is None:
-                    raise Exception("message length was not defined")
+        # Keep the tunnel open for further requests until the client hangs up, goes idle or uses up its request limit
+        sock.settimeout(self.idle_timeout)
 
-                req = AES.decrypt(cipher_text)
+        if "mux" in extensions:
+            self._handle_mux_session(framer, cipher, addr, extensions)
 
+            return
+
+        session = Session(self, framer, cipher, extensions)
+
+        requests = 0
+
+        while self.max_requests is None or requests < self.max_requests:
+            # 0-RTT early data is the first request of the session
+            if req is None:
+                if requests and self.workers and not self._await_request(framer):
+                    break
+
+                # Decrypt data with shared secret
                 try:
-                    if self._handler:
-                        resp = self._handler(req, addr)
+                    req = session.recv_head()
+
+                except TimeoutError:
+                    break
+
+                except ValueError:
+                    # Tampered or out of order record or a head the header table cannot decode, the session cannot be trusted any more
+                    break
+
+                if req is None:
+                    break
+
+            requests += 1
+
+            session.head_sent = False
+
+            try:
+                resp = self._respond(req, addr, session)
+
+                # A streamed response is sent as one message per chunk after its head
+                msgs = iter([resp] if isinstance(resp, (bytes, bytearray)) else resp)
+
+                session.send_head(next(msgs))
+
+                for msg in msgs:
+                    session.send(msg)
+
+            except Exception as e:
+                self._errors.inc()
+
+                try:
+                    if session.head_sent:
+                        session.send(b"SERVER ERROR")
 
                     else:
-                        resp = req
+                        session.send_head(b"SERVER ERROR")
 
-                except Exception as e:
-                    util.send_msg(sock, AES.encrypt(b"SERVER ERROR"))
+                except (ConnectionError, TimeoutError):
+                    # The client hung up part way through the response, like one that stops reading a streamed body, and there is no one left to tell
+                    return
 
-                    del self._threads[name]
+                raise e
+
+            req = None
+
+    # Waits up to idle_timeout for the next record of an idle keep-alive session on a worker, and gives the worker up
+    # early when connections are waiting for one, an idle session would otherwise keep them out until it times out
+    def _await_request(self, framer: util.Framer) -> bool:
+        deadline = None if self.idle_timeout is None else time.monotonic() + self.idle_timeout
+
+        while not framer.buffered:
+            timeout = IDLE_POLL if deadline is None else min(IDLE_POLL, deadline - time.monotonic())
+
+            if timeout <= 0:
+                return False
+
+            if select.select([framer.sock], [], [], timeout)[0]:
+                return True
+
+            if not self._queue.empty():
+                return False
+
+        return True
+
+    def _respond(self, req: bytes, addr: tuple[str, int], session: Session | mux.Stream) -> bytes | typing.Iterable[bytes]:
+        if self._handler_streams:
+            # Stream handlers pull the rest of a chunked request from the session themselves
+            return self._handler(req, addr, session)
+
+        if self._handler:
+            return self._handler(req, addr)
+
+        return req
+
+    def _handle_stream(self, stream: mux.Stream, addr: tuple[str, int]):
+        try:
+            if (req := stream.recv()) is None:
+                return
+
+            resp = self._respond(req, addr, stream)
+
+            msgs = iter([resp] if isinstance(resp, (bytes, bytearray)) else resp)
+
+            # The last message is held back so it can carry the end of the stream
+            msg = next(msgs)
+
+            for next_msg in msgs:
+                stream.send(msg)
+
+                msg = next_msg
+
+            stream.send(msg, True)
+
+        except (ConnectionError, TimeoutError):
+            stream.close()
+
+        except Exception:
+            traceback.print_exc()
 
-                    raise e
+            self._errors.inc()
 
-                util.send_msg(sock, AES.encrypt(resp))
+            try:
+                stream.send(b"SERVER ERROR", True)
 
-                del self._threads[name]
+            except ConnectionError:
+                stream.close()
 
-            # proc = multiprocessing.Process(target = callback, name = thread_name, args = (cl_socket, cl_addr, thread_name))
-            thread = threading.Thread(target = callback, name = thread_name, args = (cl_socket, cl_addr, thread_name))
+    def _handle_mux_session(self, framer: util.Framer, cipher: AES_cipher.AES | AES_cipher.AEAD, addr: tuple[str, int], extensions: dict[str, int]):
+        encoder, decoder = header_table.codec(extensions)
+
+        session = mux.Mux(lambda record: self._send(framer, cipher, record), False, extensions["mux"], extensions.get("window", mux.DEFAULT_WINDOW), self.idle_timeout, encoder, decoder)
+
+        # Streams are handled concurrently on the server-wide pool, a slow response does not hold up the others. Only this
+        # thread touches the list, finished handlers are dropped from it as new ones start
+        handlers: list[concurrent.futures.Future] = []
+
+        requests = 0
+
+        try:
+            while not (session.draining and not session.streams):
+                if requests and self.workers and not session.streams and not self._await_request(framer):
+                    break
+
+                try:
+                    record = framer.recv_msg()
+
+                except TimeoutError:
+                    # Only a tunnel without open streams is idle
+                    if session.streams:
+                        continue
+
+                    break
+
+                if record is None:
+                    break
+
+                self._phases.observe(framer.recv_time, ("receive",))
+
+                try:
+                    stream = session.feed(self._decrypt(cipher, record))
+
+                except ValueError:
+                    break
+
+                if stream is None:
+                    continue
+
+                requests += 1
+
+                handlers = [future for future in handlers if not future.done()]
+
+                handlers.append(self._stream_executor.submit(self._handle_stream, stream, addr))
+
+                if self.max_requests is not None and requests >= self.max_requests:
+                    session.go_away()
+
+            # Tell the client which streams were handled so it can send anything later on a new tunnel
+            if not session.draining:
+                session.go_away()
+
+            # Hang up on our side first, closing with records still unread would reset the tunnel before the client sees the go away
+            framer.sock.shutdown(socket.SHUT_WR)
+
+            while framer.recv_msg() is not None:
+                pass
+
+        except (OSError, ValueError):
+            pass
+
+        finally:
+            session.close()
+
+            # The tunnel's socket is closed once this returns, its handlers have to be done with it
+            concurrent.futures.wait(handlers)
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "sessions": len(self._sessions) if self.workers else len(self._threads),
+            "queue_depth": self.queue_depth,
+            "shed": self.shed,
+        }
+
+    def _refuse(self, sock: socket.socket):
+        self.shed += 1
+
+        self._shed_total.inc()
+
+        # Tell the client before its handshake instead of spending a KEM operation on it
+        try:
+            util.send_msg(sock, handshake.pack(handshake.REFUSED))
+
+            sock.shutdown(socket.SHUT_WR)
+
+        except OSError:
+            pass
+
+        finally:
+            sock.close()
+
+    def _admit(self, sock: socket.socket, addr: tuple[str, int]):
+        accepted = time.perf_counter()
+
+        if self.overload == "delay":
+            # Stop accepting until a worker frees a slot, new connections wait in the kernel backlog
+            while not self._stopped:
+                try:
+                    self._queue.put((sock, addr, accepted), timeout = 0.5)
+
+                    return
+
+                except queue.Full:
+                    continue
+
+            sock.close()
+
+            return
+
+        try:
+            self._queue.put((sock, addr, accepted), self.overload == "queue", self.queue_timeout)
+
+        except queue.Full:
+            self._refuse(sock)
+
+    def _worker(self):
+        while not (self._stopped and self._queue.empty()):
+            try:
+                sock, addr, accepted = self._queue.get(timeout = 0.5)
+
+            except queue.Empty:
+                continue
+
+            self._phases.observe(time.perf_counter() - accepted, ("accept_wait",))
+
+            name = f"{addr[0]}:{addr[1]}"
+
+            self._sessions[name] = threading.current_thread()
+            self._live_sessions.inc()
+
+            try:
+                self._handle_session(sock, addr)
+
+            except Exception:
+                # Keep the worker alive for the next connection
+                traceback.print_exc()
+
+            finally:
+                sock.close()
+
+                del self._sessions[name]
+                self._live_sessions.dec()
+
+    def _serve(self):
+        self._threads: dict[str, threading.Thread] = {}
+        self._sessions: dict[str, threading.Thread] = {}
+
+        if self.crypto_processes:
+            # Spawned rather than forked, forking a process that already runs session threads is unsafe
+            self._executor = concurrent.futures.ProcessPoolExecutor(self.crypto_processes, multiprocessing.get_context("spawn"))
+
+        # Created here rather than in __init__ so every pre-forked worker gets threads of its own
+        self._stream_executor = concurrent.futures.ThreadPoolExecutor(self.stream_workers, "stream")
+
+        for i in range(self.workers or 0):
+            thread = threading.Thread(target = self._worker, name = f"worker-{i}")
+
+            self._threads[thread.name] = thread
+
+            thread.start()
+
+        while True:
+            try:
+                cl_socket, cl_addr = self._sv_socket.accept()
+
+            except TimeoutError:
+                if self._stopped:
+                    break
+
+                continue
+
+            if self._stopped:
+                cl_socket.close()
+
+                break
+
+            if self.workers:
+                self._admit(cl_socket, cl_addr)
+
+                continue
+
+            thread_name = f"{cl_addr[0]}:{cl_addr[1]}"
+
+            def callback(sock: socket.socket, addr: tuple[str, int], name: str, accepted: float):
+                # Without a queue the wait is only for the session thread to start
+                self._phases.observe(time.perf_counter() - accepted, ("accept_wait",))
+
+                self._live_sessions.inc()
+
+                try:
+                    self._handle_session(sock, addr)
+
+                finally:
+                    sock.close()
+
+                    del self._threads[name]
+                    self._live_sessions.dec()
+
+            thread = threading.Thread(target = callback, name = thread_name, args = (cl_socket, cl_addr, thread_name, time.perf_counter()))
 
             self._threads[thread_name] = thread
 
@@ -80,15 +555,60 @@ class Server:
 
             self._sv_socket.close()
 
+            self._stream_executor.shutdown()
+
+            if self._executor is not None:
+                self._executor.shutdown()
+
+    def _stop_worker(self):
+        self._stopped = True
+
+    def serve(self, address: tuple[str, int], connections: int = 10, processes: int | None = None):
+        if not processes:
+            self._init_socket(address, connections)
+            self._serve()
+
+            return
+
+        self.address = address
+        self._supervisor = prefork.Supervisor(processes)
+
+        # Each worker would keep its own replay cache and a flight replayed to another worker would be accepted again,
+        # so pre-forked servers refuse early data and clients fall back to a full handshake
+        if processes > 1:
+            self._replay_cache = None
+
+        if prefork.REUSE_PORT:
+            # Every worker binds its own socket and the kernel spreads connections across them
+            def target():
+                self._init_socket(address, connections, reuse_port = True)
+                self._serve()
+
+            self._supervisor.run(target, self._stop_worker)
+
+        else:
+            self._init_socket(address, connections)
+
+            self._supervisor.run(self._serve, self._stop_worker)
+
+            self._sv_socket.close()
+
     def close(self):
         self._stopped = True
 
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect(self.address)
-        sock.close()
+        # In pre-forked mode this stops every worker, not only the process it is called in
+        if self._supervisor is not None:
+            self._supervisor.stop()
 
     def handle_data(self, func: typing.Callable[[bytes, tuple[str, int]], bytes]) -> typing.Callable[[bytes, tuple[str, int]], bytes]:
         self._handler = func
+        self._handler_streams = False
+
+        return func
+
+    def handle_stream(self, func: typing.Callable[[bytes, tuple[str, int], Session], bytes | typing.Iterable[bytes]]) -> typing.Callable[[bytes, tuple[str, int], Session], bytes | typing.Iterable[bytes]]:
+        self._handler = func
+        self._handler_streams = True
 
         return func
 
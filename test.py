@@ -1 +1,961 @@
-#TODO: remove
\ No newline at end of file
+import os, signal, socket, time, typing, threading, unittest, unittest.mock, multiprocessing
+import prefork, bench, util, keypool, server, async_server, client, handshake, tickets, mux, header_table, balancer, breaker, QSTP, QSTP_server, QSTP_client, QSTP_reverse_proxy, tunnel_pool, cache, coalesce, proxy, hedge, router
+
+def alive(pid: int) -> bool:
+    """Helper function to tell whether a process with `pid` still exists"""
+
+    try:
+        os.kill(pid, 0)
+
+    except ProcessLookupError:
+        return False
+
+    return True
+
+class CipherTest(unittest.TestCase):
+    def pair(self, suite: str) -> tuple:
+        secret = os.urandom(32)
+
+        return handshake.session_cipher(suite, secret, False), handshake.session_cipher(suite, secret, True)
+
+    def test_round_trip(self):
+        for suite in ("AES-256-GCM", "CHACHA20-POLY1305"):
+            cl, sv = self.pair(suite)
+
+            self.assertEqual(sv.decrypt(cl.encrypt(b"request")), b"request")
+            self.assertEqual(cl.decrypt(sv.encrypt(b"response")), b"response")
+
+    def test_tampered_record(self):
+        for suite in ("AES-256-GCM", "CHACHA20-POLY1305"):
+            cl, sv = self.pair(suite)
+
+            record = bytearray(cl.encrypt(b"request"))
+            record[0] ^= 1
+
+            with self.assertRaises(ValueError, msg = suite):
+                sv.decrypt(record)
+
+    def test_reordered_and_replayed_records(self):
+        for suite in ("AES-256-GCM", "CHACHA20-POLY1305"):
+            cl, sv = self.pair(suite)
+
+            cl.encrypt(b"first")
+
+            second = cl.encrypt(b"second")
+
+            # Each record is bound to its sequence number, the second one cannot be read in place of the first
+            with self.assertRaises(ValueError, msg = suite):
+                sv.decrypt(second)
+
+            cl, sv = self.pair(suite)
+
+            first = cl.encrypt(b"first")
+
+            self.assertEqual(sv.decrypt(first), b"first")
+
+            with self.assertRaises(ValueError, msg = suite):
+                sv.decrypt(first)
+
+class SupervisorTest(unittest.TestCase):
+    def test_sigterm_stops_workers(self):
+        ctx = multiprocessing.get_context("fork")
+        pids = ctx.Queue()
+
+        def supervise():
+            stopped = threading.Event()
+
+            def target():
+                pids.put(os.getpid())
+
+                stopped.wait()
+
+            prefork.Supervisor(2).run(target, stopped.set)
+
+        supervisor = ctx.Process(target = supervise)
+        supervisor.start()
+
+        workers = [pids.get(timeout = 10) for _ in range(2)]
+
+        os.kill(supervisor.pid, signal.SIGTERM)
+
+        supervisor.join(10)
+
+        self.assertEqual(supervisor.exitcode, 0)
+
+        # Workers that outlived the supervisor would have been handed to init and kept serving
+        self.assertEqual([pid for pid in workers if alive(pid)], [])
+
+class AdmissionTest(unittest.TestCase):
+    def test_idle_session_gives_up_its_worker(self):
+        sv = QSTP_server.QSTP_Server(server.Server(workers = 1, overload = "delay", idle_timeout = 10))
+
+        @sv.route("/echo", ["GET", "POST"])
+        def echo(rq: QSTP.Request, _) -> QSTP.Response:
+            return QSTP.Response(200, data = rq.data)
+
+        address = bench.start(sv.serve)
+
+        idle = QSTP_client.QSTP_Client(keep_alive = True)
+
+        self.assertEqual(idle.request(address, "GET", "/echo", data = b"first").data, b"first")
+
+        # The only worker holds the idle session above, the next connection gets it without waiting out the idle timeout
+        start = time.monotonic()
+
+        self.assertEqual(QSTP_client.QSTP_Client().request(address, "POST", "/echo", data = b"waiting").data, b"waiting")
+        self.assertLess(time.monotonic() - start, 2)
+
+        # The idle client notices its tunnel was closed and reconnects
+        self.assertEqual(idle.request(address, "POST", "/echo", data = b"again").data, b"again")
+
+        idle.close()
+        sv.close()
+
+class HandshakeTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.static_key = handshake.generate_static_key()
+
+        cls.server = QSTP_server.QSTP_Server(server.Server(ticket_keys = tickets.TicketKeys(), static_key = cls.static_key))
+
+        @cls.server.route("/echo", ["GET", "POST"])
+        def echo(rq: QSTP.Request, _) -> QSTP.Response:
+            return QSTP.Response(200, data = rq.data)
+
+        cls.address = bench.start(cls.server.serve)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.close()
+
+    def request(self, cl: client.Client, method: str, data: bytes) -> bytes:
+        resp = cl.open_request(QSTP.Request(self.address, method, "/echo", data = data).to_frame(), method in QSTP.IDEMPOTENT_METHODS)
+
+        cl.finish()
+
+        return QSTP.Response.from_frame(resp).data
+
+    def test_ticket_resumes_without_kem(self):
+        first = client.Client().connect(self.address)
+
+        self.assertEqual(self.request(first, "GET", b"full"), b"full")
+
+        first.close()
+
+        self.assertIn(self.address, first.tickets)
+
+        with unittest.mock.patch.object(handshake, "encapsulate", wraps = handshake.encapsulate) as kem:
+            second = client.Client(tickets = first.tickets).connect(self.address)
+
+            self.assertEqual(self.request(second, "POST", b"resumed"), b"resumed")
+
+        kem.assert_not_called()
+
+        second.close()
+
+    def test_rejected_ticket_falls_back_to_kem(self):
+        cl = client.Client()
+
+        # Issued under a ticket key the server does not have, like one from before a key rotation
+        cl.tickets[self.address] = (tickets.TicketKeys().issue(os.urandom(32))[0], os.urandom(32), time.time() + 60)
+
+        with unittest.mock.patch.object(handshake, "encapsulate", wraps = handshake.encapsulate) as kem:
+            cl.connect(self.address)
+
+            self.assertEqual(self.request(cl, "POST", b"fallback"), b"fallback")
+
+        self.assertEqual(kem.call_count, 1)
+
+        cl.close()
+
+    def test_early_data_rides_in_the_first_flight(self):
+        cl = client.Client(pinned_keys = {self.address: self.static_key[0]})
+
+        with unittest.mock.patch.object(util.Framer, "send_msg", autospec = True, side_effect = util.Framer.send_msg) as send:
+            cl.connect(self.address)
+
+            self.assertEqual(self.request(cl, "GET", b"early"), b"early")
+
+        # The server runs in this process too, only look at what the client sent
+        sent = [msg for framer, msg in (c.args for c in send.call_args_list) if framer is cl._framer]
+
+        cl.close()
+
+        # The hello carried the request, nothing else was sent before the response came back
+        self.assertEqual([msg[0] for msg in sent], [handshake.HELLO_EARLY])
+
+    def test_replayed_early_data_is_rejected(self):
+        cl = client.Client(pinned_keys = {self.address: self.static_key[0]})
+
+        with unittest.mock.patch.object(util.Framer, "send_msg", autospec = True, side_effect = util.Framer.send_msg) as send:
+            cl.connect(self.address)
+
+            self.assertEqual(self.request(cl, "GET", b"once"), b"once")
+
+        flight = next(msg for framer, msg in (c.args for c in send.call_args_list) if framer is cl._framer)
+
+        cl.close()
+
+        # An attacker resending the recorded flight on a new connection does not get the request run again
+        with socket.create_connection(self.address, timeout = 5) as sock:
+            util.send_msg(sock, flight)
+
+            self.assertEqual(util.recv_msg(sock)[0], handshake.REJECTED)
+
+    def test_early_data_rekeys_the_session(self):
+        cl = client.Client(keep_alive = True, pinned_keys = {self.address: self.static_key[0]}).connect(self.address)
+
+        self.assertEqual(self.request(cl, "GET", b"early"), b"early")
+
+        # Both sides moved to the key from the ephemeral exchange, a POST on the same tunnel still gets through
+        self.assertEqual(self.request(cl, "POST", b"later"), b"later")
+
+        cl.close()
+
+    def test_rejected_early_data_and_ticket(self):
+        # Pinned to a key the server does not have and holding a ticket it never issued, e.g. after a restart
+        cl = client.Client(pinned_keys = {self.address: handshake.generate_static_key()[0]})
+        cl.tickets[self.address] = (b"unknown ticket", os.urandom(32), time.time() + 60)
+
+        cl.connect(self.address)
+
+        self.assertEqual(self.request(cl, "GET", b"fallback"), b"fallback")
+
+        cl.close()
+
+class KeypairPoolTest(unittest.TestCase):
+    def test_counts_every_take(self):
+        pool = keypool.KeypairPool(size = 8, low_watermark = 4)
+
+        def take():
+            for _ in range(25):
+                pool.take()[0].free()
+
+        threads = [threading.Thread(target = take) for _ in range(8)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        stats = pool.stats()
+
+        self.assertEqual(stats["hits"] + stats["misses"], 200)
+
+        pool.close()
+
+    def test_close_stops_refilling(self):
+        pool = keypool.KeypairPool(size = 64, low_watermark = 64)
+
+        pool.close()
+        pool._thread.join(5)
+
+        # A keypair the refiller was generating during close() is freed instead of being stocked
+        self.assertFalse(pool._thread.is_alive())
+        self.assertEqual(pool.stats()["stock"], 0)
+
+class MuxTest(unittest.TestCase):
+    def test_window_exhaustion_resets_the_stream(self):
+        records = []
+
+        session = mux.Mux(records.append, False, window = 100)
+
+        stream = session.feed(mux.RECORD.pack(1, mux.DATA, 0) + b"a" * 150)
+
+        # The first message may overdraw the window, anything after it comes from a peer that ignores it
+        self.assertIsNone(session.feed(mux.RECORD.pack(1, mux.DATA, 0) + b"b" * 10))
+
+        self.assertEqual(records, [mux.RECORD.pack(1, mux.RESET, 0)])
+        self.assertEqual(stream.recv(), b"a" * 150)
+
+        with self.assertRaises(ConnectionResetError):
+            stream.recv()
+
+        self.assertEqual(session.streams, {})
+
+    def test_concurrent_streams(self):
+        sv = QSTP_server.QSTP_Server()
+
+        # Only lets any request through once four are being handled at the same time
+        barrier = threading.Barrier(4, timeout = 5)
+
+        @sv.route("/wait")
+        def wait(rq: QSTP.Request, _) -> QSTP.Response:
+            return QSTP.Response(200, data = str(barrier.wait()).encode())
+
+        address = bench.start(sv.serve)
+
+        cl = QSTP_client.QSTP_Client(multiplex = True)
+
+        statuses = []
+
+        threads = [threading.Thread(target = lambda: statuses.append(cl.request(address, "GET", "/wait").status_code)) for _ in range(4)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(statuses, [200] * 4)
+
+        # All of them went over a single tunnel
+        self.assertEqual(len(cl._tunnels), 1)
+        self.assertTrue(cl._tunnels[address].multiplexed)
+
+        cl.close()
+        sv.close()
+
+    def test_goaway_refuses_later_streams(self):
+        session = mux.Mux(lambda record: None, True)
+
+        first, second = session.open_stream(), session.open_stream()
+
+        first.send(b"first")
+        second.send(b"second")
+
+        # The server will still answer the first stream but never saw the second
+        session.feed(mux.RECORD.pack(first.id, mux.GOAWAY, 0))
+
+        with self.assertRaises(mux.StreamRefused):
+            second.recv()
+
+        session.feed(mux.RECORD.pack(first.id, mux.DATA, mux.END_STREAM) + b"answer")
+
+        self.assertEqual(first.recv(), b"answer")
+
+        with self.assertRaises(ConnectionResetError):
+            session.open_stream()
+
+    def test_draining_server_refuses_new_streams(self):
+        records = []
+
+        session = mux.Mux(records.append, False)
+
+        self.assertIsNotNone(session.feed(mux.RECORD.pack(1, mux.DATA, 0) + b"before"))
+
+        session.go_away()
+
+        self.assertIsNone(session.feed(mux.RECORD.pack(3, mux.DATA, 0) + b"after"))
+
+        self.assertEqual(records, [mux.RECORD.pack(1, mux.GOAWAY, 0), mux.RECORD.pack(3, mux.RESET, mux.REFUSED)])
+        self.assertEqual(list(session.streams), [1])
+
+    def test_plain_fallback(self):
+        sv = QSTP_server.QSTP_Server(server.Server(max_streams = None))
+
+        @sv.route("/echo", ["POST"])
+        def echo(rq: QSTP.Request, _) -> QSTP.Response:
+            return QSTP.Response(200, data = rq.data)
+
+        address = bench.start(sv.serve)
+
+        cl = client.Client(keep_alive = True, max_streams = 4).connect(address)
+
+        # The server does not multiplex, so both requests go over the plain tunnel
+        for data in (b"one", b"two"):
+            self.assertEqual(QSTP.Response.from_frame(cl.do_request(QSTP.Request(address, "POST", "/echo", data = data).to_frame(), False)).data, data)
+
+        self.assertFalse(cl.multiplexed)
+
+        cl.close()
+        sv.close()
+
+class ClientTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = QSTP_server.QSTP_Server()
+
+        @cls.server.route("/echo", ["GET", "POST"])
+        def echo(rq: QSTP.Request, _) -> QSTP.Response:
+            return QSTP.Response(200, data = rq.data)
+
+        @cls.server.route("/chunks")
+        def chunks(rq: QSTP.Request, _) -> QSTP.Response:
+            return QSTP.Response(200, data = (b"x" * 1000 for _ in range(10)))
+
+        cls.address = bench.start(cls.server.serve)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.close()
+
+    def test_keep_alive_after_unread_stream(self):
+        cl = QSTP_client.QSTP_Client(keep_alive = True)
+
+        resp = cl.request(self.address, "GET", "/chunks", stream = True)
+
+        self.assertEqual(resp.status_code, 200)
+
+        # The body above is never read, its chunks must not be taken for this response
+        self.assertEqual(cl.request(self.address, "GET", "/echo", data = b"after").data, b"after")
+
+        cl.close()
+
+    def test_pool_caps_open_tunnels(self):
+        pool = tunnel_pool.TunnelPool(max_tunnels = 1, acquire_timeout = 0.2)
+
+        cl = pool.acquire(self.address)
+
+        # The only tunnel allowed is in use so a second request can not open another one
+        with self.assertRaises(ConnectionRefusedError):
+            pool.acquire(self.address)
+
+        threading.Timer(0.1, pool.release, [cl]).start()
+
+        pool.acquire_timeout = 5.0
+
+        self.assertIs(pool.acquire(self.address), cl)
+
+        pool.release(cl)
+
+        pool.close()
+
+class AsyncServerTest(unittest.TestCase):
+    def test_client_drops_streamed_response(self):
+        transport = async_server.AsyncServer()
+
+        sv = QSTP_server.QSTP_Server(transport)
+
+        @sv.route("/chunks")
+        def chunks(rq: QSTP.Request, _) -> QSTP.Response:
+            return QSTP.Response(200, data = (b"x" * 65536 for _ in range(400)))
+
+        address = bench.start(sv.serve)
+
+        # A session task that ended with an exception would be reported by asyncio once it is dropped
+        with self.assertNoLogs("asyncio", "ERROR"):
+            cl = QSTP_client.QSTP_Client()
+
+            self.assertEqual(cl.request(address, "GET", "/chunks", stream = True).status_code, 200)
+
+            cl.close()
+
+            deadline = time.monotonic() + 5
+
+            while transport._sessions and time.monotonic() < deadline:
+                time.sleep(0.01)
+
+        self.assertFalse(transport._sessions)
+
+        sv.close()
+
+class ProxyTest(unittest.TestCase):
+    def test_store_and_forward_chunked_bodies(self):
+        upstream = QSTP_server.QSTP_Server()
+
+        @upstream.route("/echo", ["POST"])
+        def echo(rq: QSTP.Request, _) -> QSTP.Response:
+            return QSTP.Response(200, data = rq.data)
+
+        @upstream.route("/chunks")
+        def chunks(rq: QSTP.Request, _) -> QSTP.Response:
+            return QSTP.Response(200, data = (b"x" * 1000 for _ in range(10)))
+
+        upstream_address = bench.start(upstream.serve)
+
+        px = proxy.Proxy()
+
+        address = bench.start(lambda listen_address: px.serve(listen_address, upstream_address))
+
+        cl = QSTP_client.QSTP_Client(keep_alive = True, response_timeout = 5)
+
+        self.assertEqual(cl.request(address, "GET", "/chunks").data, b"x" * 10000)
+
+        self.assertEqual(cl.request(address, "POST", "/echo", data = iter([b"a" * 1000, b"b" * 1000])).data, b"a" * 1000 + b"b" * 1000)
+
+        # The pooled upstream tunnel is left clean for the next request
+        self.assertEqual(cl.request(address, "GET", "/chunks").data, b"x" * 10000)
+
+        # A pool that only hands back the head does not keep the tunnel the chunks are still coming in on
+        pool = tunnel_pool.TunnelPool()
+
+        self.assertTrue(QSTP.is_chunked(pool.request(upstream_address, QSTP.Request(None, "GET", "/chunks").to_frame())))
+        self.assertEqual(pool.size(upstream_address), 0)
+
+        pool.close()
+        cl.close()
+        px.close()
+        upstream.close()
+
+class HeaderTableTest(unittest.TestCase):
+    def test_round_trip_with_eviction(self):
+        encoder, decoder = header_table.Encoder(256), header_table.Decoder(256)
+
+        frames = [QSTP.Request(("localhost", 1), "GET", f"/{i % 6}", headers = {"x-request": str(i % 6)}, data = b"body").to_frame() for i in range(24)]
+
+        sizes = []
+
+        for frame in frames:
+            encoded = encoder.encode(frame)
+
+            sizes.append(len(encoded))
+
+            self.assertEqual(decoder.decode(encoded), frame)
+
+            # Both sides add and evict the same entries, so indices keep meaning the same thing
+            self.assertEqual(list(encoder.table._entries), list(decoder.table._entries))
+            self.assertLessEqual(encoder.table.size, encoder.table.max_size)
+
+        # Six requests' worth of lines do not fit in 256 bytes, so each was evicted before it came round again and sent as literals
+        self.assertLess(len(encoder.table._entries), 12)
+        self.assertTrue(all(size > 3 + len(b"body") for size in sizes[6:]))
+
+        # Lines still in the table are sent as an index, a line count and two indices
+        self.assertEqual(len(encoder.encode(frames[-1])), 3 + len(b"body"))
+
+class BalancerTest(unittest.TestCase):
+    def test_weighted_round_robin(self):
+        heavy, light = balancer.Upstream(("heavy", 1), 3), balancer.Upstream(("light", 1))
+
+        lb = balancer.Balancer([heavy, light])
+
+        picks = []
+
+        for _ in range(8):
+            picks.append(upstream := lb.acquire())
+
+            lb.release(upstream, 0.01)
+
+        # Three to one and spread out, never more than three heavy picks in a row
+        self.assertEqual(picks.count(heavy), 6)
+        self.assertEqual(picks[:4].count(light), 1)
+        self.assertEqual(picks[4:].count(light), 1)
+
+    def test_exclude(self):
+        first, second = balancer.Upstream(("first", 1)), balancer.Upstream(("second", 1))
+
+        lb = balancer.Balancer([first, second])
+
+        self.assertIs(lb.acquire(exclude = [first]), second)
+        self.assertIsNone(lb.acquire(exclude = [first, second]))
+
+    def test_refused_upstream_cools_down(self):
+        first, second = balancer.Upstream(("first", 1)), balancer.Upstream(("second", 1))
+
+        lb = balancer.Balancer([first, second], cooldown = 0.2)
+
+        lb.release(lb.acquire(exclude = [second]), None)
+
+        self.assertFalse(first.available)
+        self.assertEqual({lb.acquire() for _ in range(4)}, {second})
+
+        # Only a spare request is turned away when nothing is in rotation, a real one still tries somewhere
+        self.assertIsNone(lb.acquire(exclude = [second], spare = True))
+        self.assertIs(lb.acquire(exclude = [second]), first)
+
+        time.sleep(0.2)
+
+        self.assertTrue(first.available)
+
+    def test_health_checks(self):
+        sv = QSTP_server.QSTP_Server()
+
+        @sv.route("/")
+        def index(rq: QSTP.Request, _) -> QSTP.Response:
+            return QSTP.Response(200)
+
+        with socket.socket() as sock:
+            sock.bind(("localhost", 0))
+
+            # Nothing listens on it once the socket is closed
+            dead_address = sock.getsockname()[:2]
+
+        live, dead = balancer.Upstream(bench.start(sv.serve), connect_timeout = 2), balancer.Upstream(dead_address, connect_timeout = 2)
+
+        lb = balancer.Balancer([live, dead])
+
+        lb.check(fall = 2)
+
+        # One failed probe is not enough to take it out of rotation
+        self.assertTrue(dead.healthy)
+
+        lb.check(fall = 2)
+
+        self.assertTrue(live.healthy)
+        self.assertFalse(dead.healthy)
+        self.assertEqual({lb.acquire() for _ in range(4)}, {live})
+
+        sv.close()
+
+class BreakerTest(unittest.TestCase):
+    def test_opens_after_consecutive_failures(self):
+        circuit = breaker.CircuitBreaker(consecutive_failures = 3)
+
+        for failed in (True, True, False, True, True):
+            circuit.record(failed)
+
+        # The success broke the streak
+        self.assertEqual(circuit.state, breaker.CLOSED)
+
+        circuit.record(True)
+
+        self.assertEqual(circuit.state, breaker.OPEN)
+        self.assertFalse(circuit.ready)
+
+    def test_opens_on_error_and_slow_rate(self):
+        errors = breaker.CircuitBreaker(min_requests = 4, consecutive_failures = 100)
+
+        for failed in (True, False, True):
+            errors.record(failed)
+
+        # Half the requests failed but there are not enough of them to tell yet
+        self.assertEqual(errors.state, breaker.CLOSED)
+
+        errors.record(False)
+
+        self.assertEqual(errors.state, breaker.OPEN)
+
+        slow = breaker.CircuitBreaker(slow_call = 0.5, min_requests = 4)
+
+        for latency in (1.0, 0.1, 1.0, 0.1):
+            slow.record(False, latency)
+
+        self.assertEqual(slow.state, breaker.OPEN)
+
+    def test_half_open_trials(self):
+        circuit = breaker.CircuitBreaker(consecutive_failures = 1, open_for = 0.1, trials = 2)
+
+        circuit.record(True)
+
+        time.sleep(0.1)
+
+        self.assertEqual(circuit.state, breaker.HALF_OPEN)
+
+        # Only as many requests as there are trials get through
+        for _ in range(2):
+            self.assertTrue(circuit.ready)
+
+            circuit.attempt()
+
+        self.assertFalse(circuit.ready)
+
+        circuit.record(False)
+        circuit.record(True)
+
+        # One failed trial opens it again
+        self.assertEqual(circuit.state, breaker.OPEN)
+
+        time.sleep(0.1)
+
+        for _ in range(2):
+            circuit.attempt()
+            circuit.record(False)
+
+        self.assertEqual(circuit.state, breaker.CLOSED)
+        self.assertEqual(circuit.opened, 2)
+
+    def test_balancer_skips_open_circuits(self):
+        failing, healthy = balancer.Upstream(("failing", 1), circuit = breaker.CircuitBreaker(consecutive_failures = 2)), balancer.Upstream(("healthy", 1))
+
+        lb = balancer.Balancer([failing, healthy], cooldown = 0)
+
+        for _ in range(2):
+            lb.release(lb.acquire(exclude = [healthy]), 0.01, failed = True)
+
+        self.assertEqual({lb.acquire() for _ in range(4)}, {healthy})
+
+        # With nothing else left the request fails over instead of going to the open circuit
+        self.assertIsNone(lb.acquire(exclude = [healthy]))
+
+class RouterTest(unittest.TestCase):
+    def setUp(self):
+        self.router = router.Router()
+
+        for descriptor in ("/item/<int:id>", "/price/<float:value>", "/name/<name>", "/files/<path:rest>"):
+            self.router.route(descriptor)(lambda rq, args, descriptor = descriptor: descriptor)
+
+    def match(self, path: str) -> tuple[str, dict] | None:
+        if (ret := self.router.match_route(path, "GET")) is None:
+            return None
+
+        func, args = ret
+
+        return func(None, args), args
+
+    def test_converters(self):
+        self.assertEqual(self.match("/item/-42"), ("/item/<int:id>", {"id": -42}))
+        self.assertEqual(self.match("/price/1.5"), ("/price/<float:value>", {"value": 1.5}))
+        self.assertEqual(self.match("/price/3"), ("/price/<float:value>", {"value": 3.0}))
+        self.assertEqual(self.match("/name/bob"), ("/name/<name>", {"name": "bob"}))
+        self.assertEqual(self.match("/files/a/b/c"), ("/files/<path:rest>", {"rest": "a/b/c"}))
+
+    def test_converters_take_plain_digits_only(self):
+        for path in ("/item/1_000", "/item/ 1", "/item/+1", "/item/١٢", "/price/nan", "/price/inf", "/price/1e5", "/price/1.", "/price/.5"):
+            self.assertIsNone(self.match(path), path)
+
+class HedgeTest(unittest.TestCase):
+    def test_loser_is_closed_not_drained(self):
+        pulled = []
+        aborted = threading.Event()
+
+        def attempt(is_hedge: bool) -> QSTP.Response:
+            if is_hedge:
+                return QSTP.Response(200, data = b"hedge")
+
+            time.sleep(0.2)
+
+            return QSTP.Response(200, data = QSTP.BodyStream(lambda: pulled.append(1) or b"x", on_abort = aborted.set))
+
+        hedger = hedge.Hedger(after = 0.05, budget = 1)
+
+        self.assertEqual(hedger.do(attempt).data, b"hedge")
+
+        self.assertTrue(aborted.wait(2))
+        self.assertEqual(pulled, [])
+        self.assertEqual(hedger.stats()["hedge_wins"], 1)
+
+class CacheTest(unittest.TestCase):
+    def request(self, path: str, headers: dict | None = None) -> QSTP.Request:
+        return QSTP.Request(("localhost", 1), "GET", path, headers)
+
+    def test_hit_and_expiry(self):
+        store = cache.ResponseCache()
+        key = store.key("site", self.request("/"))
+
+        self.assertIsNone(store.lookup(key))
+
+        store.store(key, QSTP.Response(200, {"cache-control": "max-age=60"}, b"page"))
+
+        self.assertEqual(store.lookup(key).response().data, b"page")
+
+        # A response that may only be revalidated is stored but never served as it is
+        store.store(key, QSTP.Response(200, {"cache-control": "no-cache", "etag": "v1"}, b"page"))
+
+        self.assertFalse(store.lookup(key).fresh)
+        self.assertEqual((store.hits, store.misses), (1, 2))
+
+    def test_uncacheable_responses(self):
+        store = cache.ResponseCache()
+        key = store.key("site", self.request("/"))
+
+        for resp in (
+            QSTP.Response(200, {"cache-control": "no-store, max-age=60"}, b"page"),
+            QSTP.Response(200, {"cache-control": "private, max-age=60"}, b"page"),
+            QSTP.Response(200, data = b"no lifetime and no etag"),
+            QSTP.Response(204, {"cache-control": "max-age=60"}),
+        ):
+            self.assertIsNone(store.store(key, resp))
+
+        self.assertEqual(store.stats()["entries"], 0)
+
+    def test_least_recently_used_is_evicted(self):
+        resp = QSTP.Response(200, {"cache-control": "max-age=60"}, b"x" * 1000)
+
+        entry_size = len(resp.to_frame()) + cache.ENTRY_OVERHEAD
+
+        store = cache.ResponseCache(max_bytes = 3 * entry_size, max_entry_bytes = entry_size)
+
+        keys = [store.key("site", self.request(f"/{i}")) for i in range(4)]
+
+        for key in keys[:3]:
+            store.store(key, resp)
+
+        # Touching the oldest makes the second one the least recently used
+        store.lookup(keys[0])
+        store.store(keys[3], resp)
+
+        self.assertIsNone(store.lookup(keys[1]))
+        self.assertTrue(all(store.lookup(key) is not None for key in (keys[0], keys[2], keys[3])))
+        self.assertLessEqual(store.size, store.max_bytes)
+        self.assertEqual(store.evictions, 1)
+
+        # Larger than an entry may be, it is not stored and does not push anything out
+        self.assertIsNone(store.store(keys[1], QSTP.Response(200, {"cache-control": "max-age=60"}, b"x" * 2000)))
+        self.assertEqual(store.stats()["entries"], 3)
+
+    def test_key_headers_separate_variants(self):
+        store = cache.ResponseCache()
+
+        plain, compressed = store.key("site", self.request("/", {"accept-encoding": "identity"})), store.key("site", self.request("/", {"accept-encoding": "gzip"}))
+
+        store.store(plain, QSTP.Response(200, {"cache-control": "max-age=60"}, b"plain"))
+
+        self.assertIsNone(store.lookup(compressed))
+
+        store.store(compressed, QSTP.Response(200, {"cache-control": "max-age=60"}, b"compressed"))
+
+        self.assertEqual(store.lookup(plain).response().data, b"plain")
+
+        store.invalidate_path("site", "/")
+
+        self.assertEqual(store.stats()["entries"], 0)
+
+class CoalesceTest(unittest.TestCase):
+    def concurrent(self, flights: coalesce.SingleFlight, keys: list[tuple], fetch: typing.Callable[[], QSTP.Response]) -> list[QSTP.Response | Exception]:
+        results = []
+
+        def do(key: tuple):
+            try:
+                results.append(flights.do(key, fetch))
+
+            except Exception as e:
+                results.append(e)
+
+        threads = [threading.Thread(target = do, args = (key,)) for key in keys]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        return results
+
+    def test_identical_requests_share_a_flight(self):
+        flights = coalesce.SingleFlight()
+        key = flights.key("site", QSTP.Request(("localhost", 1), "GET", "/"))
+
+        calls = []
+        release = threading.Event()
+
+        def fetch() -> QSTP.Response:
+            calls.append(key)
+
+            # Stays in flight until every caller has joined it
+            release.wait(5)
+
+            return QSTP.Response(200, data = b"page")
+
+        threading.Timer(0.2, release.set).start()
+
+        results = self.concurrent(flights, [key] * 5, fetch)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([resp.data for resp in results], [b"page"] * 5)
+        self.assertEqual(flights.stats(), {"in_flight": 0, "flights": 1, "coalesced": 4})
+
+    def test_different_requests_fly_separately(self):
+        flights = coalesce.SingleFlight()
+
+        first, second = (flights.key("site", QSTP.Request(("localhost", 1), "GET", "/", {"accept-encoding": encoding})) for encoding in ("identity", "gzip"))
+
+        # Each fetch waits for the other one, so this only finishes if both are in flight at once
+        barrier = threading.Barrier(2, timeout = 5)
+
+        def fetch() -> QSTP.Response:
+            barrier.wait()
+
+            return QSTP.Response(200)
+
+        results = self.concurrent(flights, [first, second], fetch)
+
+        self.assertEqual([resp.status_code for resp in results], [200, 200])
+        self.assertEqual(flights.stats()["flights"], 2)
+
+    def test_waiters_get_the_error(self):
+        flights = coalesce.SingleFlight()
+        key = flights.key("site", QSTP.Request(("localhost", 1), "GET", "/"))
+
+        release = threading.Event()
+
+        def fetch() -> QSTP.Response:
+            release.wait(5)
+
+            raise ConnectionRefusedError("upstream is down")
+
+        threading.Timer(0.2, release.set).start()
+
+        results = self.concurrent(flights, [key] * 3, fetch)
+
+        self.assertTrue(all(isinstance(result, ConnectionRefusedError) for result in results))
+        self.assertEqual(flights.flights, 1)
+
+class ReverseProxyTest(unittest.TestCase):
+    def test_write_invalidates_every_cached_variant(self):
+        upstream = QSTP_server.QSTP_Server()
+        version = [b"1"]
+
+        @upstream.route("/page", ["GET", "POST"])
+        def page(rq: QSTP.Request, _) -> QSTP.Response:
+            if rq.method == "POST":
+                version[0] = rq.data
+
+            return QSTP.Response(200, {"cache-control": "max-age=60"}, version[0])
+
+        upstream_address = bench.start(upstream.serve)
+
+        proxy = QSTP_reverse_proxy.QSTP_ReverseProxy(response_cache = cache.ResponseCache())
+        proxy.set_routing({"site": {"location": f"{upstream_address[0]}:{upstream_address[1]}"}})
+
+        address = bench.start(proxy.serve)
+
+        cl = QSTP_client.QSTP_Client()
+
+        self.assertEqual(cl.request(address, "GET", "/page", {"Host": "site", "accept-encoding": "identity"}).data, b"1")
+
+        # Written by a client that sends another accept-encoding, so its requests key a different variant than the cached GET
+        cl.request(address, "POST", "/page", {"Host": "site"}, b"2")
+
+        self.assertEqual(cl.request(address, "GET", "/page", {"Host": "site", "accept-encoding": "identity"}).data, b"2")
+
+        cl.close()
+        proxy.close()
+        upstream.close()
+
+    def test_fresh_entry_is_served_from_cache(self):
+        upstream = QSTP_server.QSTP_Server()
+        calls = []
+
+        @upstream.route("/page")
+        def page(rq: QSTP.Request, _) -> QSTP.Response:
+            calls.append(rq)
+
+            return QSTP.Response(200, {"cache-control": "max-age=60"}, b"page")
+
+        upstream_address = bench.start(upstream.serve)
+
+        proxy = QSTP_reverse_proxy.QSTP_ReverseProxy(response_cache = cache.ResponseCache())
+        proxy.set_routing({"site": {"location": f"{upstream_address[0]}:{upstream_address[1]}"}})
+
+        address = bench.start(proxy.serve)
+
+        cl = QSTP_client.QSTP_Client()
+
+        for _ in range(3):
+            self.assertEqual(cl.request(address, "GET", "/page", {"Host": "site"}).data, b"page")
+
+        self.assertEqual(len(calls), 1)
+
+        cl.close()
+        proxy.close()
+        upstream.close()
+
+    def test_stale_entry_is_revalidated(self):
+        upstream = QSTP_server.QSTP_Server()
+        validators = []
+
+        @upstream.route("/page")
+        def page(rq: QSTP.Request, _) -> QSTP.Response:
+            validators.append(rq.get_header("if-none-match"))
+
+            if rq.get_header("if-none-match") == "v1":
+                return QSTP.Response(207)
+
+            return QSTP.Response(200, {"cache-control": "no-cache", "etag": "v1"}, b"page")
+
+        upstream_address = bench.start(upstream.serve)
+
+        proxy = QSTP_reverse_proxy.QSTP_ReverseProxy(response_cache = cache.ResponseCache())
+        proxy.set_routing({"site": {"location": f"{upstream_address[0]}:{upstream_address[1]}"}})
+
+        address = bench.start(proxy.serve)
+
+        cl = QSTP_client.QSTP_Client()
+
+        for _ in range(2):
+            resp = cl.request(address, "GET", "/page", {"Host": "site"})
+
+            self.assertEqual((resp.status_code, resp.data), (200, b"page"))
+
+        # The second request only asked whether the stored body is current, the client still got the whole body
+        self.assertEqual(validators, [None, "v1"])
+        self.assertEqual(proxy.cache.revalidated, 1)
+
+        cl.close()
+        proxy.close()
+        upstream.close()
+
+if __name__ == "__main__":
+    unittest.main()
\ No newline at end of file
@@ -0,0 +1,77 @@
+import os, time, struct, hmac, hashlib
+import AES_cipher
+
+def derive_key(secret: bytes, label: bytes, *context: bytes) -> bytes:
+    """Helper function to derive a 32 byte key from `secret` bound to a `label` and optional context values"""
+
+    return hmac.new(secret, label + b"".join(context), hashlib.sha256).digest()
+
+class TicketKeys:
+    def __init__(self, keys: list[bytes] | None = None, lifetime: float = 3600, max_keys: int = 3) -> None:
+        self.lifetime = lifetime
+        self.max_keys = max_keys
+
+        # Newest key first, it issues new tickets while the older ones are only accepted
+        self._keys = keys or [os.urandom(32)]
+
+    @staticmethod
+    def _key_name(key: bytes) -> bytes:
+        return hashlib.sha256(key).digest()[:8]
+
+    def rotate(self, key: bytes | None = None) -> bytes:
+        key = key or os.urandom(32)
+
+        self._keys = [key] + self._keys[:self.max_keys - 1]
+
+        return key
+
+    def issue(self, secret: bytes, expires: float | None = None) -> tuple[bytes, float]:
+        key = self._keys[0]
+
+        if expires is None:
+            expires = time.time() + self.lifetime
+
+        enc = AES_cipher.AES(derive_key(key, b"qstp ticket enc")).encrypt(struct.pack(">d", expires) + secret)
+
+        body = self._key_name(key) + enc
+
+        return body + hmac.new(derive_key(key, b"qstp ticket mac"), body, hashlib.sha256).digest(), expires
+
+    def open(self, ticket: bytes) -> tuple[bytes, float] | None:
+        if len(ticket) < 8 + 16 + 32:
+            return None
+
+        name, body, mac = ticket[:8], ticket[:-32], ticket[-32:]
+
+        for key in self._keys:
+            if self._key_name(key) != name:
+                continue
+
+            if not hmac.compare_digest(mac, hmac.new(derive_key(key, b"qstp ticket mac"), body, hashlib.sha256).digest()):
+                return None
+
+            plaintext = AES_cipher.AES(derive_key(key, b"qstp ticket enc")).decrypt(body[8:])
+
+            expires = struct.unpack(">d", plaintext[:8])[0]
+
+            if expires < time.time():
+                return None
+
+            return plaintext[8:], expires
+
+        return None
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            f.write("\n".join(key.hex() for key in self._keys))
+
+    def load(self, path: str):
+        with open(path) as f:
+            self._keys = [bytes.fromhex(line) for line in f.read().split()][:self.max_keys]
+
+    @classmethod
+    def from_file(cls, path: str, lifetime: float = 3600, max_keys: int = 3) -> "TicketKeys":
+        ticket_keys = cls(lifetime = lifetime, max_keys = max_keys)
+        ticket_keys.load(path)
+
+        return ticket_keys
\ No newline at end of file
@@ -0,0 +1,204 @@
+import select, threading, time
+import client, keypool, handshake, QSTP
+
+class TunnelPool:
+    def __init__(self, kem_alg: str = "ML-KEM-512", max_idle: int = 8, idle_timeout: float | None = 4.0, pinned_keys: dict[tuple[str, int], bytes] | None = None, keypairs: keypool.KeypairPool | None = None, connect_timeout: float | None = None, response_timeout: float | None = None, max_tunnels: int | None = None, acquire_timeout: float | None = 5.0) -> None:
+        self.kem_alg = kem_alg
+        self.idle_timeout = idle_timeout
+
+        # Idle tunnels kept per address for reuse, released tunnels over this are closed
+        self.max_idle = max_idle
+
+        # Tunnels open per address, idle or in use, None for no limit. At the limit acquire waits up to acquire_timeout for one
+        # to be released or closed and then raises ConnectionRefusedError, like an upstream that refuses connections
+        self.max_tunnels = max_tunnels
+        self.acquire_timeout = acquire_timeout
+
+        # Used unless acquire is given other deadlines
+        self.connect_timeout = connect_timeout
+        self.response_timeout = response_timeout
+
+        self.tickets: dict[tuple[str, int], tuple[bytes, bytes, float]] = {}
+        self.pinned_keys = pinned_keys if pinned_keys is not None else {}
+        self.keypairs = keypairs
+
+        self._idle: dict[tuple[str, int], list[client.Client]] = {}
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+
+        # Every tunnel handed out per address while max_tunnels is set, one counts until it is closed by whoever holds it
+        self._open: dict[tuple[str, int], set[client.Client]] = {}
+        self._connecting: dict[tuple[str, int], int] = {}
+        self._reaper = None
+        self._closed = False
+
+    def _healthy(self, cl: client.Client) -> bool:
+        if not cl.connected:
+            return False
+
+        # Keep below the server's idle timeout so the server does not close the tunnel under us
+        if self.idle_timeout is not None and time.monotonic() - cl.last_used > self.idle_timeout:
+            return False
+
+        # An idle tunnel should have nothing to read, readable means the server sent EOF or broke the session
+        readable, _, _ = select.select([cl._cl_socket], [], [], 0)
+
+        return not readable
+
+    def _start_reaper(self):
+        def reap():
+            while not self._closed:
+                time.sleep(self.idle_timeout)
+
+                self.evict_idle()
+
+        self._reaper = threading.Thread(target = reap, name = "tunnel-pool-reaper", daemon = True)
+        self._reaper.start()
+
+    def _count(self, address: tuple[str, int]) -> int:
+        tunnels = self._open.setdefault(address, set())
+
+        tunnels.difference_update([cl for cl in tunnels if not cl.connected])
+
+        return len(tunnels) + self._connecting.get(address, 0)
+
+    # deadlines is (connect_timeout, response_timeout) for this use of the tunnel
+    def acquire(self, address: tuple[str, int], deadlines: tuple[float | None, float | None] | None = None) -> client.Client:
+        address = tuple(address)
+
+        connect_timeout, response_timeout = deadlines or (self.connect_timeout, self.response_timeout)
+
+        deadline = time.monotonic() + self.acquire_timeout if self.acquire_timeout is not None else None
+
+        with self._lock:
+            while True:
+                tunnels = self._idle.get(address, [])
+
+                while tunnels:
+                    # Most recently used first, it is the least likely to have been closed by the server
+                    cl = tunnels.pop()
+
+                    if self._healthy(cl):
+                        # Requests to the same address may come with different deadlines
+                        cl.response_timeout = response_timeout
+
+                        return cl
+
+                    cl.close()
+
+                if self.max_tunnels is None or self._count(address) < self.max_tunnels:
+                    break
+
+                if deadline is not None and (remaining := deadline - time.monotonic()) <= 0:
+                    raise ConnectionRefusedError(f"all {self.max_tunnels} tunnels to {address[0]}:{address[1]} are in use")
+
+                # Released tunnels wake us up, ones closed by their holder without a release are noticed on the next check
+                self._released.wait(0.05 if deadline is None else min(remaining, 0.05))
+
+            if self.max_tunnels is not None:
+                self._connecting[address] = self._connecting.get(address, 0) + 1
+
+        cl = client.Client(self.kem_alg, keep_alive = True, tickets = self.tickets, pinned_keys = self.pinned_keys, keypairs = self.keypairs, connect_timeout = connect_timeout, response_timeout = response_timeout)
+
+        if self.max_tunnels is None:
+            return cl.connect(address)
+
+        try:
+            cl.connect(address)
+
+        finally:
+            with self._lock:
+                self._connecting[address] -= 1
+
+                if cl.connected:
+                    self._open[address].add(cl)
+
+                else:
+                    self._released.notify()
+
+        return cl
+
+    def release(self, cl: client.Client):
+        if not cl.connected:
+            # A closed tunnel frees its place under max_tunnels
+            if self.max_tunnels is not None:
+                with self._lock:
+                    self._released.notify()
+
+            return
+
+        if self._closed:
+            cl.close()
+
+            return
+
+        with self._lock:
+            tunnels = self._idle.setdefault(tuple(cl.remote_address), [])
+
+            # Waiters can take the tunnel or the place it leaves when it is closed
+            self._released.notify()
+
+            if len(tunnels) >= self.max_idle:
+                cl.close()
+
+                return
+
+            tunnels.append(cl)
+
+        if self._reaper is None and self.idle_timeout is not None:
+            self._start_reaper()
+
+    def evict_idle(self) -> int:
+        evicted = 0
+
+        with self._lock:
+            for tunnels in self._idle.values():
+                for cl in tunnels.copy():
+                    if not self._healthy(cl):
+                        tunnels.remove(cl)
+                        cl.close()
+
+                        evicted += 1
+
+        return evicted
+
+    # Without replay_safe it is read off the method of the request frame, only idempotent requests are sent twice
+    def request(self, address: tuple[str, int], data: bytes, replay_safe: bool | None = None) -> bytes:
+        if replay_safe is None:
+            replay_safe = handshake.replay_safe(data)
+
+        cl = self.acquire(address)
+
+        try:
+            resp = cl.do_request(data, replay_safe)
+
+        except BaseException:
+            cl.close()
+
+            raise
+
+        # Only the head of a chunked response is handed back, its chunks would be taken for the next response on the tunnel
+        if QSTP.is_chunked(resp):
+            cl.close()
+
+        # A closed tunnel is not kept, releasing it only frees its place under max_tunnels
+        self.release(cl)
+
+        return resp
+
+    def size(self, address: tuple[str, int] | None = None) -> int:
+        with self._lock:
+            if address is not None:
+                return len(self._idle.get(tuple(address), []))
+
+            return sum(len(tunnels) for tunnels in self._idle.values())
+
+    def close(self):
+        self._closed = True
+
+        with self._lock:
+            for tunnels in self._idle.values():
+                for cl in tunnels:
+                    cl.close()
+
+            self._idle.clear()
\ No newline at end of file
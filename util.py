@@ -1,35 +1,171 @@
-import socket, struct
+import socket, struct, time
 
-def send_msg(sock: socket.socket, msg: bytes):
-    """Helper function to send a message (bytes)"""
+# Frames over this many bytes are refused before any memory is allocated for them, big bodies should be streamed in chunks
+MAX_FRAME_SIZE = 1 << 28
 
-    msg = struct.pack(">I", len(msg)) + msg
+# Frame buffers start at most this big and at most double with each read after that, memory follows the bytes that arrived
+# and not the length a peer announced
+GROW_STEP = 1 << 16
 
-    sock.sendall(msg)
+HEADER = struct.Struct(">I")
 
-def recv_msg(sock: socket.socket) -> bytes | None:
+def send_msg(sock: socket.socket, msg: bytes | bytearray | memoryview):
+    """Helper function to send a message (bytes), the length prefix and payload go out in one call without being joined"""
+
+    header = HEADER.pack(len(msg))
+
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(header + msg)
+
+        return
+
+    sent = sock.sendmsg([header, msg])
+
+    # sendmsg may stop early on a full socket buffer, the rest goes out as slices of the original buffers
+    if sent < len(header):
+        sock.sendall(header[sent:])
+
+        sent = len(header)
+
+    if sent - len(header) < len(msg):
+        sock.sendall(memoryview(msg)[sent - len(header):])
+
+def check_frame_size(msg_len: int, max_frame_size: int | None):
+    """Helper function to refuse a frame length over `max_frame_size` with `ValueError`"""
+
+    if max_frame_size is not None and msg_len > max_frame_size:
+        raise ValueError(f"frame of {msg_len} bytes is over the {max_frame_size} byte limit")
+
+def recv_msg(sock: socket.socket, max_frame_size: int | None = MAX_FRAME_SIZE) -> bytearray | None:
     """Helper function to recv a full message (bytes) or return `None` if no length specified or EOF is hit"""
 
     raw_msg_len = recvall(sock, 4)
-    
+
     if not raw_msg_len:
         return None
-    
-    msg_len = struct.unpack(">I", raw_msg_len)[0]
+
+    msg_len = HEADER.unpack(raw_msg_len)[0]
+
+    check_frame_size(msg_len, max_frame_size)
 
     return recvall(sock, msg_len)
 
-def recvall(sock: socket.socket, n: int) -> bytes | None:
+def recv_into(sock: socket.socket, view: memoryview) -> bool:
+    """Helper function to fill `view` from the socket or return `False` if EOF is hit"""
+
+    while view:
+        n = sock.recv_into(view)
+
+        if not n:
+            return False
+
+        view = view[n:]
+
+    return True
+
+def recv_growing(sock: socket.socket, data: bytearray, filled: int, n: int) -> bool:
+    """Helper function to read `data` from `filled` up to `n` bytes, growing it as bytes arrive, or return `False` if EOF is hit"""
+
+    while True:
+        if not recv_into(sock, memoryview(data)[filled:]):
+            return False
+
+        if (filled := len(data)) >= n:
+            return True
+
+        data.extend(bytes(min(n - filled, filled)))
+
+def recvall(sock: socket.socket, n: int) -> bytearray | None:
     """Helper function to recv `n` bytes or return `None` if EOF is hit"""
-    
-    data = b""
-   
-    while len(data) < n:
-        packet = sock.recv(n - len(data))
-        
-        if not packet:
+
+    data = bytearray(min(n, GROW_STEP))
+
+    if not recv_growing(sock, data, 0, n):
+        return None
+
+    return data
+
+class Framer:
+    def __init__(self, sock: socket.socket, max_frame_size: int | None = MAX_FRAME_SIZE, buffer_size: int = 1 << 16) -> None:
+        self.sock = sock
+        self.max_frame_size = max_frame_size
+
+        # Small frames are read several at a time into this buffer, large ones straight into their own bytearray
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+
+        # Seconds the last message took to arrive once its length prefix was in, waiting for a message to start is idle time
+        self.recv_time = 0.0
+
+        # time.monotonic() by which reads have to finish or raise TimeoutError, however a peer spreads out its bytes.
+        # Frames are then read through the buffer, so it only suits frames that fit in it, like handshake messages
+        self.deadline: float | None = None
+
+    @property
+    def buffered(self) -> int:
+        return self._end - self._start
+
+    def _fill(self) -> bool:
+        # Only a split length prefix or a frame read under a deadline is ever left over, move it to the front
+        if self._start:
+            left = bytes(self._view[self._start:self._end])
+
+            self._buffer[:len(left)] = left
+            self._start, self._end = 0, len(left)
+
+        if self.deadline is not None:
+            if (remaining := self.deadline - time.monotonic()) <= 0:
+                raise TimeoutError("deadline passed")
+
+            self.sock.settimeout(remaining)
+
+        n = self.sock.recv_into(self._view[self._end:])
+
+        if not n:
+            return False
+
+        self._end += n
+
+        return True
+
+    def recv_msg(self) -> bytearray | None:
+        while self.buffered < HEADER.size:
+            if not self._fill():
+                return None
+
+        start = time.perf_counter()
+
+        msg_len = HEADER.unpack_from(self._buffer, self._start)[0]
+
+        check_frame_size(msg_len, self.max_frame_size)
+
+        self._start += HEADER.size
+
+        if self.deadline is not None:
+            if msg_len > len(self._buffer):
+                raise ValueError(f"frame of {msg_len} bytes does not fit the {len(self._buffer)} byte buffer")
+
+            while self.buffered < msg_len:
+                if not self._fill():
+                    return None
+
+        # Whatever arrived together with the length prefix is copied once, the rest is read into place
+        part = min(msg_len, self.buffered)
+
+        msg = bytearray(min(msg_len, max(part, GROW_STEP)))
+
+        msg[:part] = self._view[self._start:self._start + part]
+
+        self._start += part
+
+        if part < msg_len and not recv_growing(self.sock, msg, part, msg_len):
             return None
-        
-        data += packet
-    
-    return data
\ No newline at end of file
+
+        self.recv_time = time.perf_counter() - start
+
+        return msg
+
+    def send_msg(self, msg: bytes | bytearray | memoryview):
+        send_msg(self.sock, msg)
\ No newline at end of file